@@ -0,0 +1,65 @@
+import logging
+import threading
+
+from config import ALBUM_WINDOW, ALBUM_MAX_ITEMS
+
+logger = logging.getLogger(__name__)
+
+
+class _Album:
+
+    def __init__(self, on_complete):
+        self.on_complete = on_complete
+        self.updates = []
+        self.timer = None
+
+
+# Telegram delivers an album as one message per photo or file, all sharing a
+# media_group_id. They are held here until none came for `window` seconds
+# (or the album is full), then handed over together, in message order.
+class AlbumBuffer:
+
+    def __init__(self, window=ALBUM_WINDOW, max_items=ALBUM_MAX_ITEMS):
+        self.window = window
+        self.max_items = max_items
+        self._albums = {}
+        self._lock = threading.Lock()
+
+    def add(self, key, update, on_complete):
+        with self._lock:
+            album = self._albums.get(key)
+            if album is None:
+                album = self._albums[key] = _Album(on_complete)
+            album.updates.append(update)
+            if album.timer is not None:
+                album.timer.cancel()
+            if len(album.updates) < self.max_items:
+                album.timer = threading.Timer(self.window, self._flush, (key,))
+                album.timer.daemon = True
+                album.timer.start()
+                return
+        self._flush(key)
+
+    def _flush(self, key):
+        with self._lock:
+            album = self._albums.pop(key, None)
+        if album is None:
+            return
+        try:
+            album.on_complete(sorted(album.updates, key=lambda u: u.message.message_id))
+        except Exception:
+            logger.exception("Could not save the album {}".format(key))
+
+    def flush_all(self):
+        # Hands every album over now, complete or not: on shutdown the timers would die with the process
+        with self._lock:
+            keys = list(self._albums)
+            for key in keys:
+                if self._albums[key].timer is not None:
+                    self._albums[key].timer.cancel()
+        for key in keys:
+            self._flush(key)
+
+    def pending(self):
+        with self._lock:
+            return len(self._albums)
@@ -1,5 +1,5 @@
 import logging
-import pickle
+import threading
 from telegram import ReplyKeyboardMarkup
 from telegram.ext import (
     CommandHandler,
@@ -8,58 +8,144 @@ from telegram.ext import (
     RegexHandler,
     ConversationHandler,
 )
-from trello import Trello
+from trello import TrelloPool, TrelloRateLimited, TrelloUnavailable, TrelloUnauthorized
+from board_cache import BoardListCache
+from user_store import open_user_store, legacy_pickle_path
+from outbox import Outbox, OutboxWorkers, CaptureError
+from albums import AlbumBuffer
+from commands import DEFAULT_CARD_NAME_LEN
+from dedup import DedupIndex, content_digest
+from scheduler import update_key
+from search import SearchIndex, backfill
+from config import TRELLO_ASYNC, DEDUP_ENABLED, SEARCH_ENABLED
+from metrics import CAPTURES, instrumented_handler, observe_delivery
 
 _CONV_STATE_SETUP_TOKEN, _CONV_STATE_SETUP_BOARD = range(2)
 
 DEFAULT_LIST_NAME = 'inbox'
-DEFAULT_CARD_NAME_LEN = 200
+
+_TRELLO_BUSY = "Trello is too busy right now. Try again in a minute"
+_TOKEN_EXPIRED = "Trello token expired. Restart doing /setup and then saving your stuff again."
+
+TRELLO_CARD_URL = 'https://trello.com/c/{}'
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
                     level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+def _file_unique_id(file):
+    # Only in Bot API 4.5 and later
+    return getattr(file, 'file_unique_id', None) or file.file_id
+
+
 class App:
-    _USER_SETUPS = None
 
-    def __init__(self, project_name):
+    def __init__(self, project_name, trello_pool=None, board_lists=None, user_store=None,
+                 aio=None, dedup=None, search_index=None, board_sync=None):
         self.project_name = project_name
+        self.trello_pool = trello_pool if trello_pool is not None else TrelloPool()
+        self.board_lists = board_lists if board_lists is not None else BoardListCache()
+        self.user_store = user_store
+        if aio is None and TRELLO_ASYNC:
+            from trello_async import AsyncTrelloPool, EventLoopThread
+            aio = EventLoopThread(AsyncTrelloPool(breaker=self.trello_pool.breaker))
+        self.aio = aio
+        self.outbox = None
+        self.outbox_workers = None
+        self.outbox_park_only = False
+        self.albums = AlbumBuffer()
+        # The host's, when it dispatches updates in turn
+        self.scheduler = None
+        if dedup is None and DEDUP_ENABLED:
+            dedup = DedupIndex()
+        self.dedup = dedup
+        if search_index is None and SEARCH_ENABLED:
+            search_index = SearchIndex()
+        self.search_index = search_index
+        self.board_sync = board_sync
+        self._backfills = set()
+        self._backfills_lock = threading.Lock()
 
     def load_users(self):
-        try:
-            self._USER_SETUPS = pickle.load(open("./data/{}_user_setup.p".format(self.project_name), "rb"))
-        except FileNotFoundError:
-            self._USER_SETUPS = {}
+        # Records are read lazily on lookup: here we only open the store
+        # and import the legacy pickle the first time we meet it
+        if self.user_store is None:
+            self.user_store = open_user_store()
+        self.user_store.migrate_from_pickle(self.project_name, legacy_pickle_path(self.project_name))
 
     def setup_user(self, tg_id, trello_token, chosen_board_id,
                    chosen_board_name,
                    inbox_list_id=''):
-        self._USER_SETUPS[tg_id] = {
+        self.user_store.put(self.project_name, {
             'telegram_id': tg_id,
             'trello_token': trello_token,
             'board_id': chosen_board_id,
             'board_name': chosen_board_name,
             'inbox_list_id': inbox_list_id,
-        }
-        pickle.dump(self._USER_SETUPS, open("./data/{}_user_setup.p".format(self.project_name), "wb"))
+        })
 
     def get_tg_id(self, update):
         return update.message.from_user.id
 
+    def get_user(self, update):
+        return self.user_store.get(self.project_name, self.get_tg_id(update))
+
     def is_user_setup(self, update):
-        return self.get_tg_id(update) in self._USER_SETUPS
+        return self.get_user(update) is not None
+
+    def get_file(self, message):
+        # (name, Telegram URL, content type, unique ID) of the photo or document of a message.
+        # The unique ID is the same whoever sends the file, and through any bot
+        if len(message.photo) > 0:
+            photo = message.photo[-1]
+            return photo.file_id, photo.get_file().file_path, 'image', _file_unique_id(photo)
+        file = message.document
+        return file.file_name or file.file_id, file.get_file().file_path, 'document', _file_unique_id(file)
+
+    def get_trello(self, update):
+        return self.trello_pool.get(self.get_user(update)['trello_token'])
+
+    def get_board_lists(self, update):
+        try:
+            return self.board_lists.get_lists(self.get_trello(update),
+                                              self.get_user(update)['board_id'])
+        except (TrelloRateLimited, TrelloUnavailable, TrelloUnauthorized):
+            return None
+
+    def find_list_id(self, trello, board_id, list_name):
+        board_index = self.board_lists.get_index(trello, board_id)
+        if board_index is None:
+            return None, False
+        if list_name not in board_index:
+            # The cached lists may be stale: the list could have been created meanwhile
+            board_index = self.board_lists.get_index(trello, board_id, refresh=True)
+            if board_index is None:
+                return None, False
+        return board_index.get(list_name), True
+
+    async def find_list_id_async(self, trello, board_id, list_name):
+        board_index = await self.board_lists.get_index_async(trello, board_id)
+        if board_index is None:
+            return None, False
+        if list_name not in board_index:
+            board_index = await self.board_lists.get_index_async(trello, board_id, refresh=True)
+            if board_index is None:
+                return None, False
+        return board_index.get(list_name), True
 
     def status(self, bot, update):
         logger.info("Got to status")
         update.message.reply_text("I'm here listening.", reply_markup=None)
         return ConversationHandler.END
 
+    @instrumented_handler
     def setup(self, bot, update):
         logger.info("Got to setup")
         update.message.reply_text("Hi there! Welcome. First, tell me your Trello token.")
         return _CONV_STATE_SETUP_TOKEN
 
+    @instrumented_handler
     def process_wong_trello_token_conv(self, bot, update, user_data):
         logger.info("Got to process_wong_trello_token_conv")
         update.message.reply_text("The token is invalid. Restart the process using /setup "
@@ -67,13 +153,19 @@ class App:
         user_data.clear()
         return ConversationHandler.END
 
+    @instrumented_handler
     def process_trello_token_conv(self, bot, update, user_data):
         logger.info("Got to process_trello_token")
 
         trello_token = update.message.text.strip()
 
-        trello = Trello(trello_token)
-        starred_boards = trello.get_starred_boards()
+        trello = self.trello_pool.get(trello_token)
+        try:
+            starred_boards = trello.get_starred_boards()
+        except (TrelloRateLimited, TrelloUnavailable):
+            return self.error(update, user_data, _TRELLO_BUSY)
+        except TrelloUnauthorized:
+            starred_boards = None
 
         if starred_boards is None:
             update.message.reply_text(
@@ -103,6 +195,7 @@ class App:
 
         return _CONV_STATE_SETUP_BOARD
 
+    @instrumented_handler
     def process_wong_trello_board_conv(self, bot, update, user_data):
         logger.info("Got to process_wong_trello_board_conv")
         update.message.reply_text("The board was not in the list. "
@@ -111,6 +204,7 @@ class App:
         user_data.clear()
         return ConversationHandler.END
 
+    @instrumented_handler
     def process_trello_board_conv(self, bot, update, user_data):
         logger.info("Got to process_trello_board")
 
@@ -119,8 +213,13 @@ class App:
         chosen_board_name = update.message.text.split("(")[0].strip()
         chosen_board_id = update.message.text.split("(")[1].replace(")", "")
 
-        trello = Trello(trello_token)
-        starred_boards = trello.get_starred_boards()
+        trello = self.trello_pool.get(trello_token)
+        try:
+            starred_boards = trello.get_starred_boards()
+        except (TrelloRateLimited, TrelloUnavailable):
+            return self.error(update, user_data, _TRELLO_BUSY)
+        except TrelloUnauthorized:
+            starred_boards = None
 
         if starred_boards is None:
             return self.error(update, user_data, "invalid trello token")
@@ -137,10 +236,14 @@ class App:
             chosen_board_id = final_board['id']
             chosen_board_name = final_board['name']
 
-        board_lists = trello.get_board_lists(chosen_board_id)
+        try:
+            board_lists = trello.get_board_lists(chosen_board_id)
+        except (TrelloRateLimited, TrelloUnavailable):
+            return self.error(update, user_data, _TRELLO_BUSY)
+        except TrelloUnauthorized:
+            return self.error(update, {}, _TOKEN_EXPIRED)
         if board_lists is None:
-            return self.error(update, {}, "Trello token expired. Restart doing /setup and "
-                                          "then saving your stuff again.")
+            return self.error(update, {}, _TRELLO_BUSY)
 
         inbox_list_id = None
         for k, l in board_lists.items():
@@ -156,16 +259,98 @@ class App:
                         chosen_board_id=chosen_board_id,
                         chosen_board_name=chosen_board_name,
                         inbox_list_id=inbox_list_id)
+        if self.board_sync is not None:
+            self.board_sync.track(self.project_name, update.message.from_user.id, chosen_board_id)
 
         update.message.reply_text("Setup completed. You can now fully use the bot.")
         return ConversationHandler.END
 
+    @instrumented_handler
+    def search_cards(self, bot, update, args):
+        if not self.is_user_setup(update):
+            update.message.reply_text("You are not authenticated yet. Use /setup please.")
+            return
+        if self.search_index is None:
+            update.message.reply_text("Search is not enabled on this bot.")
+            return
+        user = self.get_user(update)
+        if not self.search_index.is_backfilled(user['board_id']):
+            self.start_backfill(user)
+        terms = ' '.join(args)
+        if not terms.strip():
+            update.message.reply_text("What should I look for? Use /search <words>")
+            return
+        cards = self.search_index.search(user['board_id'], terms)
+        if not cards:
+            update.message.reply_text("Nothing found for: {}".format(terms))
+            return
+        update.message.reply_text('\n'.join(
+            "{}. {} (#{}) {}".format(i, c['name'], c['list_name'], TRELLO_CARD_URL.format(c['card_id']))
+            for i, c in enumerate(cards, 1)), disable_web_page_preview=True)
+
+    def start_backfill(self, user):
+        # Indexes the cards a board had before the bot, once and in background
+        board_id = user['board_id']
+        with self._backfills_lock:
+            if board_id in self._backfills:
+                return
+            self._backfills.add(board_id)
+        trello = self.trello_pool.get(user['trello_token'])
+
+        def run():
+            try:
+                if self.board_sync is not None:
+                    self.board_sync.track(self.project_name, user['telegram_id'], board_id)
+                    self.board_sync.baseline(trello, board_id)
+                backfill(self.search_index, trello, board_id)
+            except Exception:
+                logger.exception("Could not index the cards of board {}".format(board_id))
+            finally:
+                with self._backfills_lock:
+                    self._backfills.discard(board_id)
+
+        threading.Thread(target=run, name='backfill-' + board_id, daemon=True).start()
+
+    def index_card(self, user, card_id, card_name, content, content_type, list_name, list_id):
+        # File contents are Telegram URLs, which hold the bot token: only their card name is indexed
+        if self.search_index is None:
+            return
+        if list_id is not None:
+            list_name = DEFAULT_LIST_NAME
+        elif list_name[0] == "_":
+            list_name = list_name[1:]
+        self.search_index.add(user['board_id'], card_id, card_name,
+                              content if content_type in ('text', 'url') else '', list_name)
+
+    def follow_board(self, user):
+        # Boards set up before the sync existed start being followed at their next capture
+        if self.board_sync is not None:
+            self.board_sync.track(self.project_name, user['telegram_id'], user['board_id'])
+
     def cancel_conv(self, bot, update, user_data):
         logger.info("Cancel")
         update.message.reply_text("I've been obliviated. Fear no more.")
         user_data.clear()
         return ConversationHandler.END
 
+    def in_turn(self, update, fn, *args):
+        # Runs fn after what the user's earlier updates still have to do
+        if self.scheduler is None:
+            return fn(*args)
+        if not self.scheduler.submit((self.project_name, update_key(update)), fn, *args):
+            self.turned_down(update)
+
+    def complete_album(self, updates):
+        # The album buffer hands albums over on a timer thread: they wait for their turn too
+        self.in_turn(updates[0], self.process_album, updates)
+
+    def turned_down(self, update):
+        # The user (or channel) has more updates waiting than the dispatcher keeps for one key
+        logger.info("Too many updates waiting for {}, one turned down".format(update_key(update)))
+        if update.effective_message is not None:
+            update.effective_message.reply_text("Slow down please, I'm still saving your previous messages. "
+                                                "Send this one again in a moment.")
+
     def error(self, update, user_data, error_name):
         logger.info("Error")
         update.message.reply_text("Something wrong happened: {}. "
@@ -197,45 +382,245 @@ class App:
             ]
         )
 
+    def start_outbox(self, bot, outbox=None, park_only=False):
+        # From now on captures are acknowledged as soon as they are queued. With park_only,
+        # only while Trello is not answering: the outbox keeps them until it is back
+        if outbox is None:
+            outbox = Outbox()
+        self.outbox = outbox
+        self.outbox_park_only = park_only
+        self.outbox_workers = OutboxWorkers(self, bot, outbox)
+        self.outbox_workers.start()
+
     def append_card(self, update, content, card_name,
                     list_name=None,
                     list_id=None,
-                    content_type='text'):
+                    content_type='text',
+                    file_unique_id=None):
 
         if (list_name is None) & (list_id is None):
             raise Exception("No list provided!")
 
-        trello = Trello(self._USER_SETUPS[self.get_tg_id(update)]['trello_token'])
+        dedup_key = None
+        if self.dedup is not None:
+            dedup_key = content_digest(content, content_type, list_id or list_name, file_unique_id)
+            duplicate, card_id = self.dedup.claim(self.project_name, self.get_tg_id(update), dedup_key)
+            if duplicate:
+                return self.reply_duplicate(update, card_id)
+
+        payload = {
+            'content': content,
+            'card_name': card_name,
+            'list_name': list_name,
+            'list_id': list_id,
+            'content_type': content_type,
+            'dedup_key': dedup_key,
+        }
+        try:
+            return self._send_card(update, payload)
+        except Exception:
+            # Neither saved nor queued: the claim must not turn a resend away
+            self.forget_capture(self.get_tg_id(update), dedup_key)
+            raise
+
+    def _send_card(self, update, payload):
+        content_type = payload['content_type']
+        if self.outbox is not None:
+            if self.trello_unavailable():
+                CAPTURES.labels(self.project_name, content_type, 'parked').inc()
+                return self.enqueue_card(update, payload, parked=True)
+            if not self.outbox_park_only:
+                CAPTURES.labels(self.project_name, content_type, 'outbox').inc()
+                return self.enqueue_card(update, payload)
+
+        if self.aio is not None:
+            CAPTURES.labels(self.project_name, content_type, 'async').inc()
+            # Captures of one user reach Trello in the order they were sent
+            return self.aio.submit(self.append_card_async(update, **payload), key=self.get_tg_id(update))
+
+        CAPTURES.labels(self.project_name, content_type, 'inline').inc()
+        try:
+            card_id, reply = self.deliver_card(self.get_user(update), **payload)
+        except CaptureError as e:
+            return self.give_up(update, payload['dedup_key'], str(e))
+        except TrelloRateLimited:
+            return self.give_up(update, payload['dedup_key'], _TRELLO_BUSY)
+        except TrelloUnavailable:
+            return self.park_card(update, payload)
+        if card_id is None:
+            return self.give_up(update, payload['dedup_key'], reply)
+        update.message.reply_text(reply)
+
+    async def append_card_async(self, update, dedup_key=None, **payload):
+        try:
+            return await self._append_card_async(update, dedup_key, payload)
+        except Exception:
+            await self.aio.run_blocking(self.forget_capture, self.get_tg_id(update), dedup_key)
+            raise
+
+    async def _append_card_async(self, update, dedup_key, payload):
+        # The stores are SQLite files other processes lock too: they are only touched off the loop
+        user = await self.aio.run_blocking(self.get_user, update)
+        try:
+            with observe_delivery(self.project_name, payload['content_type']) as delivery:
+                card_id, reply = await self.deliver_card_async(user, **payload)
+                delivery.card_id = card_id
+        except CaptureError as e:
+            return await self.aio.run_blocking(self.give_up, update, dedup_key, str(e))
+        except TrelloUnauthorized:
+            return await self.aio.run_blocking(self.give_up, update, dedup_key, _TOKEN_EXPIRED)
+        except TrelloRateLimited:
+            return await self.aio.run_blocking(self.give_up, update, dedup_key, _TRELLO_BUSY)
+        except TrelloUnavailable:
+            return await self.aio.run_blocking(self.park_card, update, dict(payload, dedup_key=dedup_key))
+        if card_id is None:
+            return await self.aio.run_blocking(self.give_up, update, dedup_key, reply)
+        await self.aio.run_blocking(self.card_saved, user, card_id, dedup_key, **payload)
+        await self.aio.run_blocking(update.message.reply_text, reply)
+
+    def give_up(self, update, dedup_key, reason):
+        self.forget_capture(self.get_tg_id(update), dedup_key)
+        return self.error(update, {}, reason)
+
+    def reply_duplicate(self, update, card_id):
+        logger.info("Message {} was already captured".format(update.message.message_id))
+        if card_id is None:
+            update.message.reply_text("Already saving this one into Trello...")
+        else:
+            update.message.reply_text("Already saved it: " + TRELLO_CARD_URL.format(card_id))
+
+    def remember_card(self, tg_id, dedup_key, card_id):
+        if (self.dedup is not None) & (dedup_key is not None):
+            self.dedup.resolve(self.project_name, tg_id, dedup_key, card_id)
+
+    def forget_capture(self, tg_id, dedup_key):
+        # Called once a capture is given up on, so that sending it again isn't seen as a duplicate
+        if (self.dedup is not None) & (dedup_key is not None):
+            self.dedup.release(self.project_name, tg_id, dedup_key)
+
+    def trello_unavailable(self):
+        breaker = self.trello_pool.breaker
+        return breaker is not None and breaker.is_open
+
+    def park_card(self, update, payload):
+        # Trello stopped answering while this capture was on its way
+        if self.outbox is None:
+            self.forget_capture(self.get_tg_id(update), payload['dedup_key'])
+            return self.error(update, {}, _TRELLO_BUSY)
+        CAPTURES.labels(self.project_name, payload['content_type'], 'parked').inc()
+        self.enqueue_card(update, payload, parked=True)
+
+    def enqueue_card(self, update, payload, parked=False):
+        message = update.message
+        item_id = self.outbox.enqueue(self.project_name, self.get_tg_id(update), message.chat_id,
+                                      '{}:{}:{}'.format(self.project_name, message.chat_id, message.message_id),
+                                      payload)
+        if item_id is None:
+            logger.info("Message {} was already queued".format(message.message_id))
+            return
+        if parked:
+            ack = message.reply_text("Got it! Trello is not answering right now: I'll save the {} "
+                                     "as soon as it's back.".format(payload['content_type']))
+        else:
+            ack = message.reply_text("Got it! Saving the {} into Trello...".format(payload['content_type']))
+        self.outbox.set_reply(item_id, ack.message_id)
+
+    def deliver_card(self, user, content, card_name,
+                     list_name=None,
+                     list_id=None,
+                     content_type='text',
+                     dedup_key=None):
+        # Returns the card ID (None if Trello failed) and the text to answer with
+        with observe_delivery(self.project_name, content_type) as delivery:
+            try:
+                card_id, reply = self._deliver_card(user, content, card_name, list_name, list_id, content_type)
+            except TrelloUnauthorized:
+                raise CaptureError(_TOKEN_EXPIRED)
+            delivery.card_id = card_id
+        if card_id is not None:
+            self.card_saved(user, card_id, dedup_key, content, card_name, list_name, list_id, content_type)
+        return card_id, reply
+
+    def card_saved(self, user, card_id, dedup_key, content, card_name, list_name, list_id, content_type):
+        self.remember_card(user['telegram_id'], dedup_key, card_id)
+        self.index_card(user, card_id, card_name, content, content_type, list_name, list_id)
+        self.follow_board(user)
+
+    def _deliver_card(self, user, content, card_name, list_name, list_id, content_type):
+        if self.aio is not None:
+            return self.aio.run(self.deliver_card_async(user, content, card_name,
+                                                        list_name=list_name,
+                                                        list_id=list_id,
+                                                        content_type=content_type))
+
+        trello = self.trello_pool.get(user['trello_token'])
 
         if list_id is not None:
             list_name = DEFAULT_LIST_NAME
         else:
-            board_lists = trello.get_board_lists(self._USER_SETUPS[self.get_tg_id(update)]['board_id'])
-            if board_lists is None:
-                return self.error(update, {}, "Trello token expired. Restart doing /setup and "
-                                              "then saving your stuff again.")
-
-            if list_name[0] == "_":
+            board_id = user['board_id']
+            create_list = list_name[0] == "_"
+            if create_list:
                 list_name = list_name[1:]
-                # Check if it already exists
-                for k, l in board_lists.items():
-                    if l['name'] == list_name:
-                        list_id = l['id']
-                        break
-                else:
+
+            list_id, board_found = self.find_list_id(trello, board_id, list_name)
+            if not board_found:
+                # A refused token raised TrelloUnauthorized: this one may go away on its own
+                return None, "Trello is not answering right now, the lists of your board could not be read"
+
+            if list_id is None:
+                if create_list:
                     # NEW LIST!
-                    list_id = trello.create_list_in_board(list_name,
-                                                          self._USER_SETUPS[self.get_tg_id(update)]['board_id'])
-            else:
-                for k, l in board_lists.items():
-                    if l['name'] == list_name:
-                        list_id = l['id']
-                        break
+                    list_id = trello.create_list_in_board(list_name, board_id)
+                    self.board_lists.invalidate(trello.auth_token, board_id)
+                    if list_id is None:
+                        return self._list_not_created(list_name)
                 else:
-                    return self.error(update, {}, "No list found matching your choice. Restart please.")
+                    raise CaptureError("No list found matching your choice. Restart please.")
 
         result = trello.create_card_in_list(list_id, card_name, content, content_type)
-        logger.info("Done! Created card with ID: {}".format(result))
-        update.message.reply_text("Done! Put the {} into #{} as *{}".format(content_type,
-                                                                            list_name,
-                                                                            card_name))
+        return self._delivered(result, content_type, list_name, card_name)
+
+    async def deliver_card_async(self, user, content, card_name,
+                                 list_name=None,
+                                 list_id=None,
+                                 content_type='text'):
+
+        trello = self.aio.trello_pool.get(user['trello_token'])
+
+        if list_id is not None:
+            list_name = DEFAULT_LIST_NAME
+        else:
+            board_id = user['board_id']
+            create_list = list_name[0] == "_"
+            if create_list:
+                list_name = list_name[1:]
+
+            list_id, board_found = await self.find_list_id_async(trello, board_id, list_name)
+            if not board_found:
+                # A refused token raised TrelloUnauthorized: this one may go away on its own
+                return None, "Trello is not answering right now, the lists of your board could not be read"
+
+            if list_id is None:
+                if create_list:
+                    list_id = await trello.create_list_in_board(list_name, board_id)
+                    self.board_lists.invalidate(trello.auth_token, board_id)
+                    if list_id is None:
+                        return self._list_not_created(list_name)
+                else:
+                    raise CaptureError("No list found matching your choice. Restart please.")
+
+        result = await trello.create_card_in_list(list_id, card_name, content, content_type)
+        return self._delivered(result, content_type, list_name, card_name)
+
+    def _list_not_created(self, list_name):
+        # A card sent without its list would land nowhere: the capture fails as a whole
+        logger.info("Trello refused the list {}".format(list_name))
+        return None, "Trello is not answering right now, the list #{} was not created".format(list_name)
+
+    def _delivered(self, card_id, content_type, list_name, card_name):
+        if card_id is None:
+            logger.info("Trello refused the card")
+            return None, "Trello is not answering right now"
+        logger.info("Done! Created card with ID: {}".format(card_id))
+        return card_id, "Done! Put the {} into #{} as *{}".format(content_type, list_name, card_name)
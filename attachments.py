@@ -0,0 +1,69 @@
+import mimetypes
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+import requests
+
+from config import (
+    ATTACHMENT_SPOOL_THRESHOLD,
+    ATTACHMENT_MAX_CONCURRENT_UPLOADS,
+    ATTACHMENT_CONNECT_TIMEOUT,
+    ATTACHMENT_READ_TIMEOUT,
+)
+
+_CHUNK_SIZE = 64 * 1024
+
+
+def attachment_name(file_url):
+    return os.path.basename(urlsplit(file_url).path) or 'file'
+
+
+def attachment_mime_type(name):
+    return mimetypes.guess_type(name)[0] or 'application/octet-stream'
+
+
+# Moves files from Telegram to Trello with bounded memory: the download is
+# streamed into a buffer that spills to a temp file above `spool_threshold`,
+# and at most `max_concurrent` transfers run at once in the process.
+class AttachmentSpooler:
+
+    def __init__(self, session=None, spool_threshold=ATTACHMENT_SPOOL_THRESHOLD,
+                 max_concurrent=ATTACHMENT_MAX_CONCURRENT_UPLOADS,
+                 connect_timeout=ATTACHMENT_CONNECT_TIMEOUT,
+                 read_timeout=ATTACHMENT_READ_TIMEOUT):
+        self.session = session if session is not None else requests.Session()
+        self.spool_threshold = spool_threshold
+        self.max_concurrent = max_concurrent
+        self.timeout = (connect_timeout, read_timeout)
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+
+    @contextmanager
+    def open(self, file_url):
+        with self.slots:
+            if urlsplit(file_url).scheme in ('', 'file'):
+                # A file already on disk, e.g. from a chat export: no need to spool it
+                with open(urlsplit(file_url).path, 'rb') as f:
+                    yield f
+                return
+            with tempfile.SpooledTemporaryFile(max_size=self.spool_threshold) as spool:
+                with self.session.get(file_url, stream=True, timeout=self.timeout) as r:
+                    r.raise_for_status()
+                    for chunk in r.iter_content(chunk_size=_CHUNK_SIZE):
+                        spool.write(chunk)
+                spool.seek(0)
+                yield spool
+
+
+_default_spooler = None
+_default_spooler_lock = threading.Lock()
+
+
+def default_spooler():
+    global _default_spooler
+    with _default_spooler_lock:
+        if _default_spooler is None:
+            _default_spooler = AttachmentSpooler()
+        return _default_spooler
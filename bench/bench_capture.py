@@ -0,0 +1,106 @@
+"""
+The whole App.append_card path for each content type, from the parsed message
+to the reply, against local stand-ins for Trello, Telegram's file storage and
+the linked web pages. Captures are delivered inline (no outbox), so each
+timing covers every Trello call, download and upload of one card.
+
+    python -m bench.bench_capture [--cards 200]
+"""
+import argparse
+import itertools
+import logging
+import os
+import tempfile
+from types import SimpleNamespace
+
+from app import App
+from attachments import AttachmentSpooler
+from bench.stand_in import FakeTrello, FakeFileServer, trello_api
+from bench.timing import sample
+from dedup import DedupIndex
+from ratelimit import TrelloRateLimiter
+from search import SearchIndex
+from trello import TrelloPool
+from unfurl import Unfurler
+from user_store import SqliteUserStore
+
+CONTENT_TYPES = ('text', 'url', 'image', 'document', 'album')
+
+ALBUM_SIZE = 10
+
+_TOKEN = 'f' * 64
+_TG_ID = 1
+_UNLIMITED = (10 ** 9, 1)
+
+
+def fake_update(tg_id, message_id, replies):
+    message = SimpleNamespace(from_user=SimpleNamespace(id=tg_id),
+                              chat_id=tg_id,
+                              message_id=message_id,
+                              reply_text=lambda text, **kwargs: replies.append(text))
+    return SimpleNamespace(message=message)
+
+
+def _content(content_type, files, i):
+    if content_type == 'url':
+        # A new page each time: the unfurl cache is not what is measured here
+        return '{}/page/{}'.format(files.url, i)
+    if content_type == 'image':
+        return '{}/file/photos/file_{}.jpg'.format(files.url, i)
+    if content_type == 'album':
+        return ['{}/file/photos/file_{}_{}.jpg'.format(files.url, i, n) for n in range(ALBUM_SIZE)]
+    if content_type == 'document':
+        return '{}/file/documents/file_{}.pdf'.format(files.url, i)
+    return 'An idea worth keeping, number {}'.format(i)
+
+
+def run(cards=200, file_size=256 * 1024):
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp, \
+            FakeTrello() as server, FakeFileServer(file_size=file_size) as files, trello_api(server.url):
+        limiter = TrelloRateLimiter(path=os.path.join(tmp, 'ratelimit.sqlite3'),
+                                    key_limit=_UNLIMITED, token_limit=_UNLIMITED)
+        unfurler = Unfurler(cache_path=os.path.join(tmp, 'unfurl.sqlite3'))
+        pool = TrelloPool(rate_limiter=limiter, unfurler=unfurler, spooler=AttachmentSpooler())
+        app = App('bench', trello_pool=pool,
+                  user_store=SqliteUserStore(os.path.join(tmp, 'users.sqlite3')),
+                  dedup=DedupIndex(os.path.join(tmp, 'dedup.sqlite3')),
+                  search_index=SearchIndex(os.path.join(tmp, 'search.sqlite3')))
+        app.setup_user(_TG_ID, _TOKEN, FakeTrello.BOARD_ID, 'Benchmark', inbox_list_id=FakeTrello.INBOX_LIST_ID)
+
+        replies = []
+        message_ids = itertools.count(1)
+        for content_type in CONTENT_TYPES:
+            def capture(i):
+                content = _content(content_type, files, i)
+                app.append_card(fake_update(_TG_ID, next(message_ids), replies), content,
+                                card_name='card {}'.format(i), list_name='ideas', content_type=content_type)
+
+            server.reset_calls()
+            results['append_card.' + content_type] = sample(capture, cards, warmup=5)
+            results['append_card.' + content_type]['trello_calls_per_op'] = \
+                sum(server.calls.values()) / (cards + 5)
+
+        failed = [r for r in replies if not r.startswith('Done!')]
+        if failed:
+            raise SystemExit("{} captures failed, e.g. {!r}".format(len(failed), failed[0]))
+        pool.close()
+        unfurler.close()
+        limiter.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cards', type=int, default=200)
+    parser.add_argument('--file-size', type=int, default=256 * 1024)
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    for name, result in run(args.cards, args.file_size).items():
+        print("{:<24} {:>8.2f} ms/card  p95 {:>8.2f} ms  {:.1f} Trello calls/card".format(
+            name, result['seconds_per_op'] * 1e3, result['p95'] * 1e3, result['trello_calls_per_op']))
+
+
+if __name__ == '__main__':
+    main()
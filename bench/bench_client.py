@@ -0,0 +1,59 @@
+"""
+Overhead of Trello._make_request over a bare call on the same keep-alive
+session, against a local stand-in for the Trello API: what the client adds
+(query string, rate limiter, status handling) without the network.
+
+    python -m bench.bench_client [--calls 2000]
+"""
+import argparse
+import os
+import tempfile
+
+from bench.stand_in import FakeTrello, trello_api
+from bench.timing import sample
+from ratelimit import TrelloRateLimiter
+from trello import Trello, TrelloPool
+
+_TOKEN = 'f' * 64
+_UNLIMITED = (10 ** 9, 1)
+
+
+def run(calls=2000):
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp, FakeTrello() as server, trello_api(server.url):
+        lists_path = '/1/boards/{}/lists'.format(FakeTrello.BOARD_ID)
+        limiter = TrelloRateLimiter(path=os.path.join(tmp, 'ratelimit.sqlite3'),
+                                    key_limit=_UNLIMITED, token_limit=_UNLIMITED)
+        pool = TrelloPool(rate_limiter=limiter)
+        clients = {
+            'no_limiter': Trello(_TOKEN, session=pool.session),
+            'limiter': Trello(_TOKEN, session=pool.session, rate_limiter=limiter),
+        }
+        bare_params = {'key': 'k', 'token': _TOKEN}
+
+        results['client.bare_session.get'] = sample(
+            lambda i: pool.session.get(server.url + lists_path, params=bare_params).json(), calls, warmup=50)
+        for name, trello in clients.items():
+            results['client.make_request.get.' + name] = sample(
+                lambda i: trello._make_request(lists_path), calls, warmup=50)
+            results['client.make_request.post.' + name] = sample(
+                lambda i: trello._make_request('/1/cards', method='POST',
+                                               querystring={'idList': 'list', 'name': str(i), 'pos': 'top'}),
+                calls, warmup=50)
+        pool.close()
+        limiter.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--calls', type=int, default=2000)
+    args = parser.parse_args()
+
+    for name, result in run(args.calls).items():
+        print("{:<40} {:>8.1f} us/call  p95 {:>8.1f} us".format(
+            name, result['seconds_per_op'] * 1e6, result['p95'] * 1e6))
+
+
+if __name__ == '__main__':
+    main()
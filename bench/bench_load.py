@@ -0,0 +1,281 @@
+"""
+End-to-end load: a bot runs as in production (Host, polling dispatcher,
+keyed scheduler, outbox...) in its own process, against local stand-ins of
+the Bot API, Telegram's file storage and Trello, while synthetic users send
+it a mix of messages at a steady rate. Per kind of message:
+
+- latency from the message being available to getUpdates to the bot's
+  final answer (the "Done!" reply, or the edit of the "saving" reply),
+  p50/p95/p99
+- throughput, answered messages per second over the run
+- Trello calls per message
+
+    python -m bench.bench_load [--bot ideas] [--rate 20] [--duration 10] [--users 50]
+        [--mix text=4,shortcut=3,url=1,photo=1,document=1,album=0.2]
+        [--trello-latency 0.05] [--trello-errors 0.01] [--trello-throttle 0.01]
+        [--file-latency 0.02] [--set OUTBOX_ENABLED=false] [--set TRELLO_ASYNC=true]
+
+Messages are open-loop: they keep coming at --rate whether or not the bot
+keeps up, so queues show in the latencies. --set overrides a config value
+in the bot process.
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+
+from bench.stand_in import FakeTelegram, FakeTrello, FakeFileServer
+from bench.timing import summarize
+
+KINDS = ('text', 'shortcut', 'url', 'photo', 'document', 'album')
+DEFAULT_MIX = 'text=4,shortcut=3,url=1,photo=1,document=1,album=0.2'
+
+ALBUM_SIZE = 4
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_TELEGRAM_TOKEN = '123456:load'
+_TRELLO_TOKEN = 'f' * 64
+# Every capture carries its tag in the card name, which the final answer repeats
+_TAG = re.compile(r'\bL(\d+)\b')
+# Answers on the way to the final one: the list question, the "saving" acknowledgement
+_INTERMEDIATE = ('Where do you want to save it?', 'Got it!')
+
+# Run in the child: config is patched before anything imports from it, users are set up
+# directly in the store, and the host runs until stdin is closed
+_CHILD = '''
+import json, sys
+import config
+for name, value in json.loads(sys.argv[1]).items():
+    setattr(config, name, value)
+from bench.stand_in import FakeTrello, trello_api
+from host import Host
+with trello_api(sys.argv[2]):
+    host = Host()
+    app = host.add_bot(sys.argv[3], sys.argv[4], 'load')
+    for tg_id in range(1, int(sys.argv[5]) + 1):
+        app.setup_user(tg_id, sys.argv[6], FakeTrello.BOARD_ID, 'Benchmark', inbox_list_id=FakeTrello.INBOX_LIST_ID)
+    host.start()
+    print('ready', flush=True)
+    sys.stdin.read()
+    host.stop()
+'''
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        kind, _, weight = part.partition('=')
+        if kind not in KINDS:
+            raise ValueError("Unknown kind of message {!r}, expected one of {}".format(kind, ', '.join(KINDS)))
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+def parse_overrides(pairs):
+    # NAME=value, the value read as JSON when it parses (numbers, true/false, lists), else as a string
+    overrides = {}
+    for pair in pairs:
+        name, _, value = pair.partition('=')
+        try:
+            overrides[name] = json.loads(value)
+        except ValueError:
+            overrides[name] = value
+    return overrides
+
+
+# Sends the synthetic messages and matches the bot's answers to them, by tag
+class _Traffic:
+
+    def __init__(self, telegram, files, bot, users, seed=0):
+        self.telegram = telegram
+        self.files = files
+        self.bot = bot
+        self.users = users
+        self._random = random.Random(seed)
+        self._tags = iter(range(1, 10 ** 9))
+        self._lock = threading.Lock()
+        self.pending = {}
+        self.latencies = defaultdict(list)
+        self.sent = Counter()
+        self.unmatched = []
+        self.last_answer_at = None
+        self.done = threading.Event()
+
+    def on_reply(self, method, chat_id, message_id, text):
+        text = text or ''
+        match = _TAG.search(text)
+        now = time.perf_counter()
+        with self._lock:
+            entry = self.pending.pop(int(match.group(1)), None) if match else None
+            if entry is None:
+                if not text.startswith(_INTERMEDIATE):
+                    self.unmatched.append(text)
+                return
+            kind, sent_at = entry
+            self.latencies[kind].append(now - sent_at)
+            self.last_answer_at = now
+            if not self.pending:
+                self.done.set()
+
+    def _file(self, prefix, tag, extension, folder):
+        file_id = '{}{}'.format(prefix, tag)
+        self.telegram.add_file(file_id, '{}/{}{}'.format(folder, file_id, extension))
+        return {'file_id': file_id, 'file_unique_id': 'u' + file_id, 'file_size': self.files.file_size}
+
+    def _photo(self, prefix, tag):
+        photo = self._file(prefix, tag, '.jpg', 'photos')
+        return [dict(photo, width=1280, height=960)]
+
+    def send(self, kind):
+        tag = next(self._tags)
+        user = self._random.randint(1, self.users)
+        with self._lock:
+            self.pending[tag] = (kind, time.perf_counter())
+            self.done.clear()
+        self.sent[kind] += 1
+        name = 'L{}'.format(tag)
+        if kind == 'text':
+            self.telegram.send(user, "An idea worth keeping, {}".format(name))
+            if self.bot == 'ideas':
+                # The bot asks for a list: '.' picks the inbox
+                self.telegram.send(user, '.')
+        elif kind == 'shortcut':
+            # The content has the tag too: the same content in the same list would be a duplicate
+            self.telegram.send(user, "Something to do later, {0} in #todo as *{0}".format(name))
+        elif kind == 'url':
+            self.telegram.send(user, "{}/page/{} as *{}".format(self.files.url, tag, name))
+        elif kind == 'photo':
+            self.telegram.send(user, photo=self._photo('p', tag), caption='as *' + name)
+        elif kind == 'document':
+            document = dict(self._file('d', tag, '.pdf', 'documents'),
+                            file_name='report-{}.pdf'.format(tag), mime_type='application/pdf')
+            self.telegram.send(user, document=document, caption='as *' + name)
+        elif kind == 'album':
+            for n in range(ALBUM_SIZE):
+                fields = {'photo': self._photo('a{}_'.format(n), tag), 'media_group_id': 'g{}'.format(tag)}
+                if n == 0:
+                    fields['caption'] = 'as *' + name
+                self.telegram.send(user, **fields)
+
+    def run(self, mix, rate, duration):
+        # Open loop: the i-th message is due at start + i / rate, late or not
+        kinds, weights = zip(*mix.items())
+        start = time.perf_counter()
+        total = int(rate * duration)
+        for i in range(total):
+            delay = start + i / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            self.send(self._random.choices(kinds, weights)[0])
+        return start
+
+
+def _start_bot(bot, telegram, files, trello, users, overrides, cwd):
+    config = {
+        'TELEGRAM_MODE': 'polling',
+        'TELEGRAM_BASE_URL': telegram.base_url,
+        'TELEGRAM_BASE_FILE_URL': files.url + '/file/bot',
+        'METRICS_ENABLED': False,
+        'TRELLO_WEBHOOK_URL': '',
+        # Our own budgets would be what's measured: Trello's 429s are the stand-in's
+        'TRELLO_RATE_LIMIT_ENABLED': False,
+    }
+    config.update(overrides)
+    env = dict(os.environ, PYTHONPATH=_ROOT)
+    child = subprocess.Popen([sys.executable, '-c', _CHILD, json.dumps(config), trello.url, bot,
+                              _TELEGRAM_TOKEN, str(users), _TRELLO_TOKEN],
+                             cwd=cwd, env=env, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                             stderr=subprocess.DEVNULL)
+    if child.stdout.readline().strip() != b'ready':
+        child.kill()
+        raise SystemExit("The {} bot did not start".format(bot))
+    return child
+
+
+def run(bot='ideas', rate=20.0, duration=10.0, users=50, mix=DEFAULT_MIX, trello_latency=0.05,
+        trello_errors=0.0, trello_throttle=0.0, file_latency=0.02, drain=60.0, overrides=None, seed=0):
+    mix = parse_mix(mix) if isinstance(mix, str) else mix
+    with tempfile.TemporaryDirectory() as tmp, \
+            FakeTrello(latency=trello_latency, error_rate=trello_errors, throttle_rate=trello_throttle,
+                       seed=seed) as trello, \
+            FakeFileServer(latency=file_latency) as files, \
+            FakeTelegram() as telegram:
+        traffic = _Traffic(telegram, files, bot, users, seed)
+        telegram.on_reply = traffic.on_reply
+        child = _start_bot(bot, telegram, files, trello, users, overrides or {}, tmp)
+        try:
+            trello.reset_calls()
+            start = traffic.run(mix, rate, duration)
+            traffic.done.wait(drain)
+        finally:
+            child.stdin.close()
+            try:
+                child.wait(10)
+            except subprocess.TimeoutExpired:
+                child.kill()
+                child.wait()
+
+        answered = sum(len(v) for v in traffic.latencies.values())
+        elapsed = (traffic.last_answer_at or time.perf_counter()) - start
+        results = {}
+        for kind in mix:
+            if traffic.latencies[kind]:
+                results['load.{}.{}'.format(bot, kind)] = dict(summarize(traffic.latencies[kind]),
+                                                               sent=traffic.sent[kind])
+        results['load.{}.all'.format(bot)] = dict(
+            summarize([s for v in traffic.latencies.values() for s in v] or [0.0]),
+            sent=sum(traffic.sent.values()),
+            answered=answered,
+            unanswered=len(traffic.pending),
+            failed=len(traffic.unmatched),
+            throughput=answered / elapsed if elapsed > 0 else 0.0,
+            trello_calls_per_op=sum(trello.calls.values()) / max(1, sum(traffic.sent.values())),
+            trello_calls=dict(trello.calls))
+        if traffic.unmatched:
+            results['load.{}.all'.format(bot)]['failure_example'] = traffic.unmatched[0]
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--bot', default='ideas', choices=('ideas', 'gtd'))
+    parser.add_argument('--rate', type=float, default=20.0, help="messages per second")
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds of sending")
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--mix', default=DEFAULT_MIX, help="relative weights of the kinds of message")
+    parser.add_argument('--trello-latency', type=float, default=0.05)
+    parser.add_argument('--trello-errors', type=float, default=0.0, help="share of Trello calls answered 500")
+    parser.add_argument('--trello-throttle', type=float, default=0.0, help="share of Trello calls answered 429")
+    parser.add_argument('--file-latency', type=float, default=0.02)
+    parser.add_argument('--drain', type=float, default=60.0, help="longest wait for answers after sending")
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE',
+                        help="config value of the bot process")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    results = run(args.bot, args.rate, args.duration, args.users, args.mix, args.trello_latency,
+                  args.trello_errors, args.trello_throttle, args.file_latency, args.drain,
+                  parse_overrides(args.set), args.seed)
+    for name, result in results.items():
+        print("{:<24} {:>6} sent  p50 {:>8.1f} ms  p95 {:>8.1f} ms  p99 {:>8.1f} ms".format(
+            name, result['sent'], result['p50'] * 1e3, result['p95'] * 1e3, result['p99'] * 1e3))
+    total = results['load.{}.all'.format(args.bot)]
+    print("{:.1f} answered/s, {} answered, {} unanswered, {} failed, {:.2f} Trello calls per message".format(
+        total['throughput'], total['answered'], total['unanswered'], total['failed'], total['trello_calls_per_op']))
+    if total['failed']:
+        print("e.g. {!r}".format(total['failure_example']))
+    for route, count in sorted(total['trello_calls'].items()):
+        print("  {:<36} {:>6}".format(route, count))
+
+
+if __name__ == '__main__':
+    main()
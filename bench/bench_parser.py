@@ -0,0 +1,180 @@
+"""
+Micro-benchmark of the shortcut command parser against the implementation it
+replaced, which is kept below as the reference. Before timing, it checks on a
+seeded random corpus of valid messages that both give the same result.
+
+    python -m bench.bench_parser [--messages 20000] [--seed 0]
+"""
+import argparse
+import random
+import re
+import string
+import timeit
+
+from commands import COMMAND_REGEX, SHORTCUT_REGEX, extract_commands_from_groups, extract_commands_from_text
+
+DEFAULT_CARD_NAME_LEN = 200
+
+_HANDLER_REGEX = re.compile(r'^(.*)(( in #((_)?)([^\s]+))|( as \*([^\s]+)))$')
+
+
+def legacy_extract_commands_from_text(message):
+    if message is None:
+        return None, None, message
+
+    extract_commands_regex = r'((in #([^\s]+))$|(as \*([^\s]+))$)|(in #([^\s]+) as *([^\s]+))$'
+    command = ""
+    for finding in re.findall(extract_commands_regex, message):
+        if type(finding) == str:
+            if (finding != '') & (finding != '_') & (finding != ' '):
+                command = finding
+                break
+        elif type(finding) == tuple:
+            for f in finding:
+                if (f != '') & (f != '_') & (f != ' '):
+                    command = f
+                    break
+
+    if command == "":
+        return None, None, message
+
+    message = message.split(command)[0]
+
+    get_list_name_regex = r'in #([^\s]+)'
+    findings = []
+    for finding in re.findall(get_list_name_regex, command):
+        if type(finding) == str:
+            if (finding != '') & (finding != '_') & (finding != ' '):
+                findings.append(finding)
+        elif type(finding) == tuple:
+            for f in finding:
+                if (f != '') & (f != '_') & (f != ' '):
+                    findings.append(f)
+
+    if len(findings) == 0:
+        chosen_list_name = None
+    else:
+        chosen_list_name = findings[-1]
+
+    get_card_name_regex = r'as \*([^\s]+)'
+    findings = []
+    for finding in re.findall(get_card_name_regex, command):
+        if type(finding) == str:
+            if (finding != '') & (finding != ' '):
+                findings.append(finding)
+        elif type(finding) == tuple:
+            for f in finding:
+                if (f != '') & (f != '_') & (f != ' '):
+                    findings.append(f)
+
+    if len(findings) == 0:
+        chosen_card_name = message[:DEFAULT_CARD_NAME_LEN]
+        if chosen_card_name == '':
+            chosen_card_name = None
+    else:
+        chosen_card_name = findings[-1].strip()
+
+    return chosen_list_name, chosen_card_name, message.strip()
+
+
+_TOKEN_CHARS = string.ascii_letters + string.digits + '#*_-.:/àé'
+_TRICKY_WORDS = ['in', 'as', '#', '*', '#x', '*y', 'in #', 'as *', '_', 'https://example.com/a?b=c']
+
+
+def _token(rnd, min_len=1):
+    return ''.join(rnd.choice(_TOKEN_CHARS) for _ in range(rnd.randint(min_len, 12)))
+
+
+def _content(rnd):
+    words = []
+    for _ in range(rnd.randint(0, 40)):
+        words.append(rnd.choice(_TRICKY_WORDS) if rnd.random() < 0.2 else _token(rnd))
+        words.append(rnd.choice([' ', ' ', ' ', '\n', '  ']))
+    return ''.join(words).strip()
+
+
+def generate_corpus(size, seed=0):
+    # Messages the bot accepts: some content, then one of the three commands.
+    # A command whose text also appears earlier in the message is skipped, as
+    # the old parser cut the message at its first occurrence.
+    rnd = random.Random(seed)
+    corpus = []
+    while len(corpus) < size:
+        content = _content(rnd)
+        shape = rnd.randrange(4)
+        list_name = ('_' if rnd.random() < 0.2 else '') + _token(rnd)
+        card_name = _token(rnd)
+        if shape == 0:
+            command = 'in #{}'.format(list_name)
+        elif shape == 1:
+            command = 'as *{}'.format(card_name)
+        elif shape == 2:
+            command = 'in #{} as *{}'.format(list_name, card_name)
+        else:
+            corpus.append(content)
+            continue
+        if command in content:
+            continue
+        corpus.append('{} {}'.format(content, command) if content else command)
+    return corpus
+
+
+def check_equivalence(corpus):
+    # The parser, the shortcut filter, and the groups the filter hands to the handler
+    mismatches = []
+    for message in corpus:
+        expected = legacy_extract_commands_from_text(message)
+        got = extract_commands_from_text(message)
+        if expected != got:
+            mismatches.append((message, expected, got))
+        shortcut = SHORTCUT_REGEX.match(message)
+        if (_HANDLER_REGEX.match(message) is not None) != (shortcut is not None):
+            if '\n' not in message:
+                mismatches.append((message, 'handler filter', 'shortcut filter'))
+        if shortcut is not None:
+            got = extract_commands_from_groups(shortcut.groupdict())
+            if expected != got:
+                mismatches.append((message, expected, got))
+    return mismatches
+
+
+def _time(fn, corpus, repeat):
+    def run():
+        for message in corpus:
+            fn(message)
+    return min(timeit.repeat(run, number=1, repeat=repeat)) / len(corpus)
+
+
+def run(messages=20000, seed=0, repeat=5):
+    corpus = generate_corpus(messages, seed)
+    mismatches = check_equivalence(corpus)
+    if mismatches:
+        for message, expected, got in mismatches[:10]:
+            print("MISMATCH {!r}\n  legacy: {!r}\n  new:    {!r}".format(message, expected, got))
+        raise SystemExit("{} mismatches over {} messages".format(len(mismatches), len(corpus)))
+
+    results = {
+        'parser.legacy': _time(legacy_extract_commands_from_text, corpus, repeat),
+        'parser.single_pass': _time(extract_commands_from_text, corpus, repeat),
+        'filter.legacy_handler': _time(_HANDLER_REGEX.match, corpus, repeat),
+        'filter.shortcut': _time(SHORTCUT_REGEX.match, corpus, repeat),
+        'filter.command': _time(COMMAND_REGEX.match, corpus, repeat),
+    }
+    return corpus, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    corpus, results = run(args.messages, args.seed, args.repeat)
+    print("{} messages, same results as the legacy parser".format(len(corpus)))
+    for name, seconds in results.items():
+        print("{:<24} {:>8.2f} us/message".format(name, seconds * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+Cold start of each bot, as after a deploy: a fresh interpreter imports the
+bot and runs it with the Host, polling a local stand-in of the Bot API where
+a /start is waiting. Two timings per bot:
+
+- import: from the first import to the bot class being loaded
+- first_update: from launching the process to the reply to that /start,
+  interpreter startup included, i.e. the window where messages wait
+
+    python -m bench.bench_startup [--runs 5] [--bots ideas,gtd]
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench.stand_in import FakeTelegram
+from bench.timing import summarize
+
+BOTS = ('ideas', 'gtd')
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_TOKEN = '123456:bench'
+
+# Run in the child: config is patched before anything imports from it
+_CHILD = '''
+import sys, time
+start = time.perf_counter()
+import config
+config.TELEGRAM_BASE_URL = sys.argv[2]
+config.TELEGRAM_MODE = 'polling'
+config.METRICS_ENABLED = False
+config.TRELLO_WEBHOOK_URL = ''
+from host import Host, bot_class
+bot_class(sys.argv[1])
+print(time.perf_counter() - start, flush=True)
+host = Host()
+host.add_bot(sys.argv[1], sys.argv[3], 'bench')
+host.start()
+time.sleep(60)
+'''
+
+
+def _cold_start(kind, timeout=30):
+    # (import seconds, seconds to the first reply) of one fresh process
+    with FakeTelegram() as telegram, tempfile.TemporaryDirectory() as tmp:
+        telegram.send(1, '/start')
+        env = dict(os.environ, PYTHONPATH=_ROOT)
+        launched = time.perf_counter()
+        child = subprocess.Popen([sys.executable, '-c', _CHILD, kind, telegram.base_url, _TOKEN],
+                                 cwd=tmp, env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        try:
+            import_seconds = float(child.stdout.readline())
+            if not telegram.replied.wait(timeout):
+                raise SystemExit("The {} bot did not answer within {}s".format(kind, timeout))
+            return import_seconds, telegram.first_reply_at - launched
+        finally:
+            child.kill()
+            child.wait()
+
+
+def run(runs=5, bots=BOTS):
+    results = {}
+    for kind in bots:
+        timings = [_cold_start(kind) for _ in range(runs)]
+        results['startup.import.' + kind] = summarize([t[0] for t in timings])
+        results['startup.first_update.' + kind] = summarize([t[1] for t in timings])
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--bots', default=','.join(BOTS))
+    args = parser.parse_args()
+
+    for name, result in run(args.runs, args.bots.split(',')).items():
+        print("{:<30} {:>8.1f} ms  p95 {:>8.1f} ms".format(
+            name, result['seconds_per_op'] * 1e3, result['p95'] * 1e3))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""
+User setups at 1k/10k/100k users: App.setup_user one user at a time, and
+App.load_users both when it imports a legacy pickle of that size and when it
+just reopens an existing store, followed by cold lookups.
+
+    python -m bench.bench_users [--sizes 1000,10000,100000]
+"""
+import argparse
+import os
+import pickle
+import random
+import tempfile
+import time
+
+from app import App
+from bench.timing import per_op, sample
+from user_store import legacy_pickle_path
+
+SIZES = (1000, 10000, 100000)
+
+_PROJECT = 'bench'
+_LOOKUPS = 1000
+
+
+def _record(tg_id):
+    return {
+        'telegram_id': tg_id,
+        'trello_token': '{:064x}'.format(tg_id),
+        'board_id': 'board{:019d}'.format(tg_id),
+        'board_name': 'Board {}'.format(tg_id),
+        'inbox_list_id': 'list{:020d}'.format(tg_id),
+    }
+
+
+def _setup_users(app, size):
+    start = time.perf_counter()
+    for tg_id in range(size):
+        r = _record(tg_id)
+        app.setup_user(r['telegram_id'], r['trello_token'], r['board_id'], r['board_name'], r['inbox_list_id'])
+    return per_op(time.perf_counter() - start, size)
+
+
+def _load_users():
+    # The whole call is one operation, whatever the number of users
+    app = App(_PROJECT)
+    start = time.perf_counter()
+    app.load_users()
+    return app, per_op(time.perf_counter() - start, 1)
+
+
+def run(sizes=SIZES, seed=0):
+    # Works in a temp directory: the stores live at their configured relative paths
+    results = {}
+    rnd = random.Random(seed)
+    cwd = os.getcwd()
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            try:
+                os.makedirs('data')
+                with open(legacy_pickle_path(_PROJECT), 'wb') as f:
+                    pickle.dump({tg_id: _record(tg_id) for tg_id in range(size)}, f)
+                app, results['load_users.migrate_pickle.{}'.format(size)] = _load_users()
+                app.user_store.close()
+
+                app, results['load_users.reopen.{}'.format(size)] = _load_users()
+                ids = [rnd.randrange(size) for _ in range(_LOOKUPS)]
+                results['get_user.cold.{}'.format(size)] = sample(
+                    lambda i: app.user_store.get(_PROJECT, ids[i]), _LOOKUPS)
+                app.user_store.close()
+            finally:
+                os.chdir(cwd)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            try:
+                app = App(_PROJECT)
+                app.load_users()
+                results['setup_user.{}'.format(size)] = _setup_users(app, size)
+                app.user_store.close()
+            finally:
+                os.chdir(cwd)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default=','.join(str(s) for s in SIZES))
+    args = parser.parse_args()
+
+    for name, result in run([int(s) for s in args.sizes.split(',')]).items():
+        print("{:<34} {:>12.2f} us/op".format(name, result['seconds_per_op'] * 1e6))
+
+
+if __name__ == '__main__':
+    main()
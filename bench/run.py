@@ -0,0 +1,109 @@
+"""
+Runs the benchmark suites and writes their results as JSON, tagged with the
+commit they were measured on, so that two runs can be compared:
+
+    python -m bench.run --output before.json
+    git checkout my-branch
+    python -m bench.run --output after.json
+    python -m bench.run --compare before.json after.json
+
+Every result is keyed by name and has at least `ops` and `seconds_per_op`.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+
+SUITES = ('parser', 'client', 'capture', 'users', 'startup', 'load')
+
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(name, quick=False):
+    if name == 'parser':
+        from bench import bench_parser
+        corpus, results = bench_parser.run(messages=2000 if quick else 20000)
+        return {key: {'ops': len(corpus), 'seconds_per_op': seconds} for key, seconds in results.items()}
+    if name == 'client':
+        from bench import bench_client
+        return bench_client.run(calls=200 if quick else 2000)
+    if name == 'capture':
+        from bench import bench_capture
+        return bench_capture.run(cards=20 if quick else 200)
+    if name == 'users':
+        from bench import bench_users
+        return bench_users.run(sizes=(1000,) if quick else bench_users.SIZES)
+    if name == 'startup':
+        from bench import bench_startup
+        return bench_startup.run(runs=2 if quick else 5)
+    if name == 'load':
+        from bench import bench_load
+        return bench_load.run(duration=3 if quick else 20)
+    raise ValueError("Unknown benchmark suite: {}".format(name))
+
+
+def run(suites=SUITES, quick=False):
+    results = {}
+    for suite in suites:
+        print("Running {}...".format(suite), file=sys.stderr)
+        results.update(run_suite(suite, quick))
+    return {
+        'commit': _commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'quick': quick,
+        'results': results,
+    }
+
+
+def compare(before, after, threshold=0.05):
+    # Relative change of seconds_per_op: negative is faster
+    print("{:<44} {:>12} {:>12} {:>8}".format('benchmark', 'before', 'after', 'change'))
+    for name in sorted(set(before['results']) | set(after['results'])):
+        old, new = before['results'].get(name), after['results'].get(name)
+        if old is None or new is None:
+            print("{:<44} {:>12} {:>12}".format(name, '-' if old is None else 'present', '-' if new is None else 'present'))
+            continue
+        change = new['seconds_per_op'] / old['seconds_per_op'] - 1
+        flag = '' if abs(change) < threshold else ('  faster' if change < 0 else '  SLOWER')
+        print("{:<44} {:>10.2f}us {:>10.2f}us {:>+7.1%}{}".format(
+            name, old['seconds_per_op'] * 1e6, new['seconds_per_op'] * 1e6, change, flag))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--suites', default=','.join(SUITES), help="comma separated, among " + ', '.join(SUITES))
+    parser.add_argument('--quick', action='store_true', help="smaller runs, for a smoke test")
+    parser.add_argument('--output', help="file for the JSON results (default: stdout)")
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help="compare two results files")
+    parser.add_argument('--threshold', type=float, default=0.05, help="relative change worth flagging")
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as f, open(args.compare[1]) as g:
+            compare(json.load(f), json.load(g), args.threshold)
+        return
+
+    # The captures log every card at INFO
+    logging.disable(logging.INFO)
+    report = json.dumps(run(args.suites.split(','), args.quick), indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
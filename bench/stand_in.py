@@ -0,0 +1,352 @@
+"""
+Local stand-ins for the services the bots talk to, so that benchmarks measure
+our own code: a fake Trello API, a fake Telegram Bot API and a fake file
+server playing both Telegram's file storage and the web pages behind shared
+links.
+"""
+import itertools
+import json
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qsl
+
+from trello import Trello
+
+_PAGE = (b'<html><head><title>Page {}</title>'
+         b'<meta property="og:description" content="A page to unfurl"></head>'
+         b'<body>' + b'lorem ipsum ' * 200 + b'</body></html>')
+
+
+_BODY_HEAD = 1024
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body leave in one segment, instead of waiting on a delayed ACK
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def _read_body(self):
+        # Consumes the body, keeping its first bytes (enough for multipart part headers)
+        head = b''
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            while True:
+                chunk_size = int(self.rfile.readline().split(b';')[0], 16)
+                chunk = self.rfile.read(chunk_size + 2)
+                if len(head) < _BODY_HEAD:
+                    head += chunk[:_BODY_HEAD - len(head)]
+                if chunk_size == 0:
+                    return head
+        remaining = int(self.headers.get('Content-Length') or 0)
+        while remaining > 0:
+            chunk = self.rfile.read(min(remaining, 64 * 1024))
+            remaining -= len(chunk)
+            if len(head) < _BODY_HEAD:
+                head += chunk[:_BODY_HEAD - len(head)]
+        return head
+
+    def _send(self, status, body=b'', content_type='application/json', headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, data):
+        self._send(200, json.dumps(data).encode())
+
+    def do_GET(self):
+        self.server.stand_in.handle(self, 'GET')
+
+    def do_POST(self):
+        self.server.stand_in.handle(self, 'POST')
+
+    def do_PUT(self):
+        self.server.stand_in.handle(self, 'PUT')
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients killed mid-call (the cold start runs) are expected, anything else is reported
+        if not issubclass(sys.exc_info()[0], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class _StandIn:
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self._httpd = None
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self._httpd.server_address[1])
+
+    def count(self, route):
+        with self._lock:
+            self.calls[route] += 1
+
+    def reset_calls(self):
+        with self._lock:
+            self.calls.clear()
+
+    def handle(self, request, method):
+        raise NotImplementedError
+
+    def start(self):
+        self._httpd = _Server(('127.0.0.1', 0), _Handler)
+        self._httpd.stand_in = self
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+# Just enough of the Trello API for the bots: one starred board with a few
+# lists, and cards that are accepted and numbered. It can be slowed down,
+# made to fail (500) or to throttle (429) a share of the calls.
+class FakeTrello(_StandIn):
+
+    # Trello IDs are 24 hex digits
+    BOARD_ID = '{:024x}'.format(0xb0a4d)
+    LISTS = ['inbox', 'ideas', 'todo', 'reading']
+    INBOX_LIST_ID = '{:024x}'.format(0x1157)
+
+    def __init__(self, latency=0.0, error_rate=0.0, throttle_rate=0.0, seed=0):
+        super().__init__(latency)
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self._random = random.Random(seed)
+        self._ids = itertools.count(1)
+        self.lists = {'{:024x}'.format(0x1157 + i): name for i, name in enumerate(self.LISTS)}
+        self.cards = {}
+
+    def _new_id(self):
+        return '{:024x}'.format(0xa77ac4 + next(self._ids))
+
+    def _route(self, method, parts):
+        # '/1/cards/<id>/attachments' counts as 'POST /1/cards/{id}/attachments'
+        if len(parts) > 2 and parts[1] != 'members':
+            parts = parts[:2] + ['{id}'] + parts[3:]
+        return method + ' /' + '/'.join(parts)
+
+    def handle(self, request, method):
+        url = urlsplit(request.path)
+        query = dict(parse_qsl(url.query))
+        parts = url.path.strip('/').split('/')
+        route = self._route(method, parts)
+        self.count(route)
+        body_head = request._read_body()
+        if self.latency:
+            time.sleep(self.latency)
+
+        with self._lock:
+            draw = self._random.random()
+        if draw < self.throttle_rate:
+            return request._send(429, b'API_TOKEN_LIMIT_EXCEEDED', 'text/plain', {'Retry-After': '0'})
+        if draw < self.throttle_rate + self.error_rate:
+            return request._send(500, b'Internal error', 'text/plain')
+
+        if route == 'GET /1/members/me/boards':
+            return request._send_json([{'id': self.BOARD_ID, 'name': 'Benchmark', 'starred': True}])
+        if route == 'GET /1/boards/{id}/lists':
+            return request._send_json([{'id': list_id, 'name': name, 'closed': False}
+                                       for list_id, name in self.lists.items()])
+        if route == 'GET /1/boards/{id}/cards':
+            with self._lock:
+                cards = sorted(self.cards.values(), key=lambda c: c['id'], reverse=True)
+            if 'before' in query:
+                cards = [c for c in cards if c['id'] < query['before']]
+            return request._send_json(cards[:int(query.get('limit', len(cards)))])
+        if route == 'GET /1/lists/{id}/cards':
+            with self._lock:
+                return request._send_json([c for c in self.cards.values() if c['idList'] == parts[2]])
+        if route == 'POST /1/lists':
+            list_id = '{:024x}'.format(0x1157000 + next(self._ids))
+            self.lists[list_id] = query.get('name', '')
+            return request._send_json({'id': list_id})
+        if route == 'POST /1/cards':
+            card_id = '{:024x}'.format(0xca4d000 + next(self._ids))
+            # Like Trello, an image attached on creation becomes the cover
+            cover = b'Content-Type: image/' in body_head or _is_image(query.get('urlSource', ''))
+            card = {'id': card_id, 'idList': query.get('idList'), 'name': query.get('name', ''),
+                    'desc': query.get('desc', ''), 'idAttachmentCover': self._new_id() if cover else None}
+            with self._lock:
+                self.cards[card_id] = card
+            return request._send_json(dict(card, shortLink=card_id[-8:]))
+        if route == 'POST /1/cards/{id}/attachments':
+            cover = query.get('setCover') != 'false' and (b'Content-Type: image/' in body_head or
+                                                          _is_image(query.get('url', '')))
+            attachment_id = self._new_id()
+            with self._lock:
+                if cover and parts[2] in self.cards:
+                    self.cards[parts[2]]['idAttachmentCover'] = attachment_id
+            return request._send_json({'id': attachment_id})
+        if route == 'PUT /1/cards/{id}':
+            with self._lock:
+                if parts[2] in self.cards and 'idAttachmentCover' in query:
+                    self.cards[parts[2]]['idAttachmentCover'] = None
+            return request._send_json({'id': parts[2]})
+        request._send(404, b'Not found', 'text/plain')
+
+
+def _is_image(url):
+    return url.lower().endswith(('.jpg', '.jpeg', '.png', '.gif', '.webp'))
+
+
+# Telegram's file storage (/file/<name>, `file_size` bytes) and the web pages
+# behind shared links (/page/<n>, a small HTML document with a title)
+class FakeFileServer(_StandIn):
+
+    def __init__(self, latency=0.0, file_size=256 * 1024):
+        super().__init__(latency)
+        self.file_size = file_size
+        self._file = b'\0' * file_size
+
+    def handle(self, request, method):
+        path = request.path.split('?')[0]
+        if self.latency:
+            time.sleep(self.latency)
+        if path.startswith('/file/'):
+            self.count('GET /file')
+            return request._send(200, self._file, 'application/octet-stream')
+        if path.startswith('/page/'):
+            self.count('GET /page')
+            return request._send(200, _PAGE.replace(b'{}', path[6:].encode()), 'text/html')
+        request._send(404, b'Not found', 'text/plain')
+
+
+# The Bot API as seen by a polling bot: getUpdates hands out the updates given
+# to `send`, sendMessage records the replies (with the time the first came),
+# getFile points at the files given to `add_file`. Replies and edits are also
+# passed to `on_reply(method, chat_id, message_id, text)` when given.
+class FakeTelegram(_StandIn):
+
+    def __init__(self, latency=0.0, poll_wait=0.1, on_reply=None):
+        super().__init__(latency)
+        self.poll_wait = poll_wait
+        self.on_reply = on_reply
+        self.updates = []
+        self.replies = []
+        self.files = {}
+        self.first_reply_at = None
+        self.replied = threading.Event()
+        self._message_ids = itertools.count(1)
+
+    @property
+    def base_url(self):
+        # What the bots take as their base_url; the token and method follow
+        return self.url + '/bot'
+
+    def send(self, tg_id, text=None, **fields):
+        # Queues a private message from `tg_id`, commands and leading links marked as Telegram
+        # does; `fields` are added to the message (photo, document, caption, media_group_id...)
+        message = {'message_id': next(self._message_ids), 'date': int(time.time()),
+                   'chat': {'id': tg_id, 'type': 'private'},
+                   'from': {'id': tg_id, 'is_bot': False, 'first_name': 'User {}'.format(tg_id)}}
+        if text is not None:
+            message['text'] = text
+            first = text.split()[0] if text.split() else ''
+            if first.startswith('/'):
+                message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(first)}]
+            elif first.startswith(('http://', 'https://')):
+                message['entities'] = [{'type': 'url', 'offset': 0, 'length': len(first)}]
+        message.update(fields)
+        with self._lock:
+            update_id = len(self.updates) + 1
+            self.updates.append({'update_id': update_id, 'message': message})
+        return message['message_id']
+
+    def add_file(self, file_id, file_path):
+        # getFile answers with `file_path`, which the bot appends to its base_file_url
+        self.files[file_id] = file_path
+
+    def _params(self, request):
+        length = int(request.headers.get('Content-Length') or 0)
+        body = request.rfile.read(length) if length else b''
+        if request.headers.get('Content-Type', '').startswith('application/json'):
+            return json.loads(body.decode() or '{}')
+        return dict(parse_qsl(body.decode()))
+
+    def handle(self, request, method):
+        params = self._params(request)
+        bot_method = request.path.split('?')[0].rsplit('/', 1)[-1]
+        self.count(bot_method)
+        if self.latency:
+            time.sleep(self.latency)
+
+        if bot_method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+        elif bot_method == 'getMyCommands':
+            result = []
+        elif bot_method == 'getUpdates':
+            offset = int(params.get('offset') or 0)
+            with self._lock:
+                result = self.updates[max(0, offset - 1):][:int(params.get('limit') or 100)]
+            if not result:
+                time.sleep(self.poll_wait)
+        elif bot_method == 'getFile':
+            file_id = params.get('file_id')
+            result = {'file_id': file_id, 'file_unique_id': file_id, 'file_path': self.files.get(file_id)}
+        elif bot_method == 'sendMessage':
+            with self._lock:
+                if self.first_reply_at is None:
+                    self.first_reply_at = time.perf_counter()
+                self.replies.append(params.get('text'))
+            self.replied.set()
+            result = {'message_id': next(self._message_ids), 'date': int(time.time()), 'text': params.get('text'),
+                      'chat': {'id': int(params.get('chat_id')), 'type': 'private'}}
+            if self.on_reply is not None:
+                self.on_reply(bot_method, result['chat']['id'], result['message_id'], result['text'])
+        elif bot_method == 'editMessageText':
+            result = True
+            if self.on_reply is not None:
+                self.on_reply(bot_method, int(params.get('chat_id')), int(params.get('message_id')),
+                              params.get('text'))
+        else:
+            result = True
+        request._send_json({'ok': True, 'result': result})
+
+
+@contextmanager
+def trello_api(url):
+    # Points the Trello clients created inside the block at `url`
+    try:
+        from trello_async import AsyncTrello
+    except ImportError:
+        AsyncTrello = None
+    previous = Trello._URL_PREFIX
+    Trello._URL_PREFIX = url
+    if AsyncTrello is not None:
+        AsyncTrello._URL_PREFIX = url
+    try:
+        yield
+    finally:
+        Trello._URL_PREFIX = previous
+        if AsyncTrello is not None:
+            AsyncTrello._URL_PREFIX = previous
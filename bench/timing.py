@@ -0,0 +1,30 @@
+import time
+
+
+def summarize(samples):
+    # Per-operation timings, in seconds, as stored in the results file
+    samples = sorted(samples)
+    n = len(samples)
+    return {
+        'ops': n,
+        'seconds_per_op': sum(samples) / n,
+        'p50': samples[n // 2],
+        'p95': samples[min(n - 1, int(n * 0.95))],
+        'p99': samples[min(n - 1, int(n * 0.99))],
+    }
+
+
+def per_op(seconds, ops):
+    # For loops timed as a whole: no percentiles, just the mean
+    return {'ops': ops, 'seconds_per_op': seconds / ops}
+
+
+def sample(fn, ops, warmup=0):
+    for i in range(warmup):
+        fn(i)
+    samples = []
+    for i in range(ops):
+        start = time.perf_counter()
+        fn(warmup + i)
+        samples.append(time.perf_counter() - start)
+    return summarize(samples)
@@ -0,0 +1,97 @@
+import threading
+import time
+from collections import OrderedDict
+
+from config import BOARD_LISTS_TTL, BOARD_LISTS_CACHE_SIZE
+
+
+# Open lists of a board, and the name->id index built from them, keyed by
+# (token, board_id). Entries expire after `ttl` seconds and the least recently
+# used ones are evicted once `max_size` boards are cached.
+class BoardListCache:
+
+    def __init__(self, ttl=BOARD_LISTS_TTL, max_size=BOARD_LISTS_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _lookup(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def _store(self, trello, board_id, board_lists):
+        if board_lists is None:
+            return None
+        index = {}
+        for k, l in board_lists.items():
+            index.setdefault(l['name'], l['id'])
+        entry = (time.monotonic() + self.ttl, board_lists, index)
+        with self._lock:
+            self._entries[(trello.auth_token, board_id)] = entry
+            self._entries.move_to_end((trello.auth_token, board_id))
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return entry
+
+    def _get(self, trello, board_id, refresh=False):
+        entry = None if refresh else self._lookup((trello.auth_token, board_id))
+        if entry is None:
+            entry = self._store(trello, board_id, trello.get_board_lists(board_id))
+        return entry
+
+    async def _get_async(self, trello, board_id, refresh=False):
+        entry = None if refresh else self._lookup((trello.auth_token, board_id))
+        if entry is None:
+            entry = self._store(trello, board_id, await trello.get_board_lists(board_id))
+        return entry
+
+    def get_lists(self, trello, board_id, refresh=False):
+        entry = self._get(trello, board_id, refresh)
+        return None if entry is None else entry[1]
+
+    def get_index(self, trello, board_id, refresh=False):
+        entry = self._get(trello, board_id, refresh)
+        return None if entry is None else entry[2]
+
+    async def get_index_async(self, trello, board_id, refresh=False):
+        entry = await self._get_async(trello, board_id, refresh)
+        return None if entry is None else entry[2]
+
+    def invalidate(self, token, board_id=None):
+        with self._lock:
+            if board_id is not None:
+                self._entries.pop((token, board_id), None)
+            else:
+                for key in [k for k in self._entries if k[0] == token]:
+                    del self._entries[key]
+
+    def update_list(self, board_id, list_id, name, closed=False):
+        # A list was created, renamed or archived: patch the cached boards instead of refetching them
+        with self._lock:
+            for key, (expires, board_lists, _) in list(self._entries.items()):
+                if key[1] != board_id:
+                    continue
+                board_lists = dict(board_lists)
+                if closed:
+                    board_lists.pop(list_id, None)
+                else:
+                    board_lists[list_id] = {'name': name, 'id': list_id}
+                index = {}
+                for k, l in board_lists.items():
+                    index.setdefault(l['name'], l['id'])
+                self._entries[key] = (expires, board_lists, index)
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
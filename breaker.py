@@ -0,0 +1,69 @@
+import logging
+import threading
+import time
+
+from config import TRELLO_BREAKER_FAILURES, TRELLO_BREAKER_PROBE_INTERVAL
+from metrics import BREAKER_OPEN, BREAKER_REJECTED
+
+logger = logging.getLogger(__name__)
+
+
+# Stops calling a service that keeps failing. After `failures` failures in a
+# row (timeouts, refused connections, server errors) the breaker opens: calls
+# are turned down at once, and a background thread runs `probe` every
+# `probe_interval` seconds until one succeeds, which closes the breaker again.
+class CircuitBreaker:
+
+    def __init__(self, probe, failures=TRELLO_BREAKER_FAILURES, probe_interval=TRELLO_BREAKER_PROBE_INTERVAL,
+                 name='trello'):
+        self.probe = probe
+        self.failures = failures
+        self.probe_interval = probe_interval
+        self.name = name
+        self._failed = 0
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._closed.set()
+
+    @property
+    def is_open(self):
+        return not self._closed.is_set()
+
+    def allow(self):
+        if self._closed.is_set():
+            return True
+        BREAKER_REJECTED.labels(self.name).inc()
+        return False
+
+    def wait_closed(self, timeout=None):
+        return self._closed.wait(timeout)
+
+    def record(self, ok):
+        with self._lock:
+            if ok:
+                self._failed = 0
+                return
+            self._failed += 1
+            if self._failed < self.failures or not self._closed.is_set():
+                return
+            self._closed.clear()
+        logger.warning("Calls to {} failed {} times in a row, stopping them until it answers again".format(
+            self.name, self.failures))
+        BREAKER_OPEN.labels(self.name).set(1)
+        threading.Thread(target=self._probe_until_closed, name=self.name + '-probe', daemon=True).start()
+
+    def _probe_until_closed(self):
+        while True:
+            time.sleep(self.probe_interval)
+            try:
+                ok = self.probe()
+            except Exception as e:
+                logger.info("{} probe failed: {}".format(self.name, e))
+                ok = False
+            if ok:
+                break
+        with self._lock:
+            self._failed = 0
+            self._closed.set()
+        logger.info("{} answers again, calls resume".format(self.name))
+        BREAKER_OPEN.labels(self.name).set(0)
@@ -0,0 +1,59 @@
+import re
+from collections import namedtuple
+
+DEFAULT_CARD_NAME_LEN = 200
+
+# The trailing command of a message: "in #list", "as *card" or "in #list as *card".
+# It has to start the text or follow a space, and the earliest one reaching the end wins.
+_COMMAND = r'(?:in #(?P<list_name>\S+)(?: as \*(?P<card_name>\S+))?|as \*(?P<only_card_name>\S+))$'
+
+# Parses any text, including a bare "in #list" (list choices, captions)
+COMMAND_REGEX = re.compile(r'(?P<content>(?:.*?\s)??)' + _COMMAND, re.DOTALL)
+
+# Dispatcher filter for the shortcut mode: the text has to end with a command that
+# follows a space, i.e. some content or a bare "in #list as *card". The groups are
+# those of COMMAND_REGEX, so a command alone is parsed as a command.
+SHORTCUT_REGEX = re.compile(r'(?=.*\s(?:in #|as \*)\S+$)' + COMMAND_REGEX.pattern, re.DOTALL)
+
+ParsedCommand = namedtuple('ParsedCommand', ['list_name', 'card_name', 'content', 'create_list'])
+
+
+def command_from_groups(groups):
+    content = groups['content']
+    list_name = groups['list_name']
+    card_name = groups['card_name'] or groups['only_card_name']
+
+    create_list = False
+    if list_name == '_':
+        list_name = None
+    elif list_name is not None and list_name[0] == '_':
+        list_name = list_name[1:]
+        create_list = True
+
+    if card_name is None:
+        card_name = content[:DEFAULT_CARD_NAME_LEN] or None
+
+    return ParsedCommand(list_name, card_name, content.strip(), create_list)
+
+
+def parse_command(text):
+    if text is None:
+        return ParsedCommand(None, None, None, False)
+    match = COMMAND_REGEX.match(text)
+    if match is None:
+        return ParsedCommand(None, None, text, False)
+    return command_from_groups(match.groupdict())
+
+
+def _as_tuple(command):
+    # (list name, card name, content), the list keeping its "_" prefix when it has to be created
+    list_name = ('_' + command.list_name) if command.create_list else command.list_name
+    return list_name, command.card_name, command.content
+
+
+def extract_commands_from_groups(groups):
+    return _as_tuple(command_from_groups(groups))
+
+
+def extract_commands_from_text(message):
+    return _as_tuple(parse_command(message))
@@ -3,5 +3,158 @@ TG_TOKEN_GDT = "your_telegram_gdt_bot_key"
 
 TRELLO_KEY = "your_trello_key"
 
+# Connections kept alive towards api.trello.com, shared by every token
+TRELLO_POOL_SIZE = 32
+TRELLO_MAX_RETRIES = 3
+TRELLO_RETRY_BACKOFF = 0.5
+
+# Longest wait for a Trello call as (connect, read) seconds, by 'METHOD endpoint' (IDs
+# replaced by {id}). Cards may carry a file, listings may be long pages
+TRELLO_TIMEOUT = (3.05, 10)
+TRELLO_TIMEOUTS = {
+    'POST /1/cards': (3.05, 60),
+    'POST /1/cards/{id}/attachments': (3.05, 60),
+    'GET /1/boards/{id}/cards': (3.05, 30),
+    'GET /1/boards/{id}/actions': (3.05, 30),
+}
+
+# After TRELLO_BREAKER_FAILURES calls in a row time out or fail on Trello's side, calls stop:
+# captures are parked in the outbox and answered at once, and Trello is probed every
+# TRELLO_BREAKER_PROBE_INTERVAL seconds until it answers again
+TRELLO_BREAKER_ENABLED = True
+TRELLO_BREAKER_FAILURES = 5
+TRELLO_BREAKER_PROBE_INTERVAL = 15
+
+# Trello budgets as (requests, seconds), per API key and per user token. The state is
+# kept in a SQLite file, so that every bot process using this key shares the budgets
+TRELLO_RATE_LIMIT_ENABLED = True
+TRELLO_RATE_LIMIT_PATH = './data/trello_ratelimit.sqlite3'
+TRELLO_KEY_RATE_LIMIT = (300, 10)
+TRELLO_TOKEN_RATE_LIMIT = (100, 10)
+# Longest a call waits in line for a slot before giving up
+TRELLO_RATE_LIMIT_MAX_WAIT = 60
+
+# Run captures on an asyncio event loop instead of blocking dispatcher threads (needs aiohttp)
+TRELLO_ASYNC = False
+
+# Board lists are cached per (token, board) for this many seconds
+BOARD_LISTS_TTL = 300
+BOARD_LISTS_CACHE_SIZE = 1024
+
+# 'sqlite' (default) or 'pickle', the historical one-file-per-project store
+USER_STORE_BACKEND = 'sqlite'
+USER_STORE_PATH = './data/users.sqlite3'
+USER_STORE_CACHE_SIZE = 4096
+
+# Titles of shared links: only the first bytes of a page are read, results cached on disk
+UNFURL_MAX_BYTES = 64 * 1024
+UNFURL_CONNECT_TIMEOUT = 3.05
+UNFURL_READ_TIMEOUT = 5
+UNFURL_CACHE_PATH = './data/unfurl.sqlite3'
+UNFURL_CACHE_TTL = 24 * 60 * 60
+
+# CPU-bound work (parsing the pages of shared links) runs in CPU_POOL_WORKERS processes, or
+# in the calling thread with 0. Callers wait CPU_TASK_TIMEOUT seconds at most, and once
+# CPU_POOL_MAX_PENDING tasks are waiting new ones are turned down (the link keeps its URL as name)
+CPU_POOL_WORKERS = 2
+CPU_POOL_MAX_PENDING = 32
+CPU_TASK_TIMEOUT = 5
+
+# Updates are handled on DISPATCH_WORKERS threads, those of one user one after the other in
+# the order they came, different users side by side. Past DISPATCH_MAX_PENDING_PER_USER
+# updates waiting for a user, the next ones are turned down (keep it above ALBUM_MAX_ITEMS)
+DISPATCH_WORKERS = 8
+DISPATCH_MAX_PENDING_PER_USER = 50
+
+# Files are streamed from Telegram to Trello, buffered in memory up to the threshold
+ATTACHMENT_SPOOL_THRESHOLD = 1024 * 1024
+ATTACHMENT_MAX_CONCURRENT_UPLOADS = 4
+ATTACHMENT_CONNECT_TIMEOUT = 3.05
+ATTACHMENT_READ_TIMEOUT = 60
+
+# Photos and files sent as an album become one card: an album is complete when no new
+# item came for ALBUM_WINDOW seconds, or when it has ALBUM_MAX_ITEMS (Telegram's limit)
+ALBUM_WINDOW = 1.5
+ALBUM_MAX_ITEMS = 10
+
+# The same content sent again to the same list within DEDUP_WINDOW seconds (double sends,
+# redelivered updates) is answered with a link to the card already made
+DEDUP_ENABLED = True
+DEDUP_PATH = './data/dedup.sqlite3'
+DEDUP_WINDOW = 60 * 60
+
+# Local full-text index of the cards made, for /search. A board's older cards are
+# pulled from Trello once, SEARCH_BACKFILL_PAGE at a time, on its first search
+SEARCH_ENABLED = True
+SEARCH_PATH = './data/search.sqlite3'
+SEARCH_RESULTS = 5
+SEARCH_BACKFILL_PAGE = 1000
+
+# Boards are kept in step with Trello (list cache, search and dedup indexes) by reading
+# their actions since a per-board cursor every SYNC_INTERVAL seconds
+SYNC_ENABLED = True
+SYNC_PATH = './data/sync.sqlite3'
+SYNC_INTERVAL = 5 * 60
+SYNC_PAGE = 1000
+# Optional: public URL where Trello pushes board changes, for a sync right away. Calls
+# are signed with the app secret (https://trello.com/app-key). Leave it empty to only poll
+TRELLO_WEBHOOK_URL = ''
+TRELLO_WEBHOOK_LISTEN = '127.0.0.1'
+TRELLO_WEBHOOK_PORT = 8444
+TRELLO_APP_SECRET = "your_trello_app_secret"
+TRELLO_WEBHOOK_MAX_BODY = 1024 * 1024
+
+# Captures are acknowledged once written here, then delivered to Trello in background
+OUTBOX_ENABLED = True
+OUTBOX_PATH = './data/outbox.sqlite3'
+OUTBOX_WORKERS = 4
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_RETRY_BACKOFF = 2
+
+# Bot API server the bots talk to: None for Telegram's, or e.g. 'http://localhost:8081/bot'
+# for a local one, with where it serves files, e.g. 'http://localhost:8081/file/bot'
+TELEGRAM_BASE_URL = None
+TELEGRAM_BASE_FILE_URL = None
+
+# How bots receive updates: 'polling', or 'webhook' through a local HTTP server (put it
+# behind a TLS proxy) where Telegram posts them to WEBHOOK_URL/<project>
+TELEGRAM_MODE = 'polling'
+WEBHOOK_LISTEN = '127.0.0.1'
+WEBHOOK_PORT = 8443
+# Public base URL registered with Telegram at startup; leave it empty to skip that (local tests)
+WEBHOOK_URL = ''
+# Telegram sends it back in every request, anything without it is rejected
+WEBHOOK_SECRET_TOKEN = "your_webhook_secret_token"
+WEBHOOK_MAX_BODY = 1024 * 1024
+
+# Imports of Telegram Desktop exports (python -m importer): messages delivered at once,
+# how often progress is saved, and the pause when the rate limiter turns calls down
+IMPORT_CONCURRENCY = 4
+IMPORT_CHECKPOINT_EVERY = 100
+IMPORT_RATE_LIMITED_PAUSE = 30
+
+# Handler, Trello and capture metrics, served at http://METRICS_LISTEN:METRICS_PORT/metrics
+# for Prometheus. When disabled, instrumentation is skipped altogether
+METRICS_ENABLED = False
+METRICS_LISTEN = '127.0.0.1'
+METRICS_PORT = 9108
+
+# Sharded deployment (python -m shards): the ingress routes each user's updates to one of
+# these worker addresses, on a hash ring with SHARD_REPLICAS points per worker. Adding a
+# worker moves about 1/N of the users. Each worker syncs the boards of its own users, and
+# only the first one receives Trello's webhook calls. The ingress keeps up to SHARD_QUEUE_SIZE
+# updates per worker while it is unreachable, and turns down the next ones
+SHARDS = [('127.0.0.1', 8601), ('127.0.0.1', 8602)]
+SHARD_AUTHKEY = "your_shard_authkey"
+SHARD_REPLICAS = 100
+SHARD_RETRY_INTERVAL = 1
+SHARD_QUEUE_SIZE = 10000
+
 PROJECT_NAME_COLLECTOR = "the_collector"
 PROJECT_NAME_GTD = "gtd"
+
+# Bots run together by host.py. `kind` is 'ideas', 'gtd' or the 'module:Class' of another App
+BOTS = [
+    {'kind': 'ideas', 'token': TG_TOKEN_IDEAS, 'project': PROJECT_NAME_COLLECTOR},
+    {'kind': 'gtd', 'token': TG_TOKEN_GDT, 'project': PROJECT_NAME_GTD},
+]
@@ -0,0 +1,134 @@
+import logging
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from config import CPU_POOL_WORKERS, CPU_POOL_MAX_PENDING, CPU_TASK_TIMEOUT
+from metrics import CPU_PENDING, CPU_TASK_SECONDS, CPU_TASKS
+
+logger = logging.getLogger(__name__)
+
+
+def _warm_up():
+    # Each worker pays for the parser imports once, not on its first page
+    import bs4
+    import lxml.etree
+
+
+def _context():
+    # forkserver children don't inherit the bots' threads and locks; spawn where it's missing
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+
+# CPU-bound stages run in a few processes, so that a heavy page doesn't hold
+# the GIL every dispatcher thread needs: callers only wait for the result.
+# The processes start on the first task. A task gets None as result when it
+# fails, takes longer than `timeout`, or finds `max_pending` tasks ahead of it.
+# A task past its timeout can't be cancelled once running: the processes are
+# killed instead, and the next task starts new ones.
+class CpuPool:
+
+    def __init__(self, workers=CPU_POOL_WORKERS, max_pending=CPU_POOL_MAX_PENDING, timeout=CPU_TASK_TIMEOUT):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.pending = 0
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _new_executor(self):
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=_context(), initializer=_warm_up)
+
+    def _submit(self, fn, args):
+        # (executor, future) of the task, None when the pool is full
+        with self._lock:
+            if self.pending >= self.max_pending:
+                return None
+            if self._executor is None:
+                self._executor = self._new_executor()
+            try:
+                future = self._executor.submit(fn, *args)
+            except BrokenProcessPool:
+                # A worker died (killed for memory, say): start over with new ones
+                logger.warning("CPU pool broken, restarting it")
+                self._executor.shutdown(wait=False)
+                self._executor = self._new_executor()
+                future = self._executor.submit(fn, *args)
+            executor = self._executor
+            self.pending += 1
+        CPU_PENDING.inc()
+        future.add_done_callback(self._done)
+        return executor, future
+
+    def _recycle(self, executor):
+        # Tasks running alongside the stuck one fail too, as if their process had died
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        kill_workers = getattr(executor, 'kill_workers', None)
+        if kill_workers is not None:
+            kill_workers()
+        else:
+            for process in list((executor._processes or {}).values()):
+                process.kill()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def _done(self, future):
+        # Timed out tasks still count until their process is done with them
+        with self._lock:
+            self.pending -= 1
+        CPU_PENDING.dec()
+
+    def run(self, name, fn, *args):
+        if self.workers == 0:
+            return fn(*args)
+        start = time.perf_counter()
+        submitted = self._submit(fn, args)
+        if submitted is None:
+            logger.info("CPU pool full, {} turned down".format(name))
+            CPU_TASKS.labels(name, 'rejected').inc()
+            return None
+        executor, future = submitted
+        try:
+            result = future.result(timeout=self.timeout)
+            outcome = 'ok'
+        except TimeoutError:
+            if not future.cancel():
+                logger.warning("{} took more than {}s, restarting the CPU pool".format(name, self.timeout))
+                self._recycle(executor)
+            else:
+                logger.info("{} waited more than {}s".format(name, self.timeout))
+            result, outcome = None, 'timeout'
+        except Exception:
+            logger.exception("{} failed".format(name))
+            result, outcome = None, 'error'
+        CPU_TASK_SECONDS.labels(name).observe(time.perf_counter() - start)
+        CPU_TASKS.labels(name, outcome).inc()
+        return result
+
+    def close(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+
+_default_cpu_pool = None
+_default_cpu_pool_lock = threading.Lock()
+
+
+def default_cpu_pool():
+    global _default_cpu_pool
+    with _default_cpu_pool_lock:
+        if _default_cpu_pool is None:
+            _default_cpu_pool = CpuPool()
+        return _default_cpu_pool
+
+
+def close_default_cpu_pool():
+    with _default_cpu_pool_lock:
+        if _default_cpu_pool is not None:
+            _default_cpu_pool.close()
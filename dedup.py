@@ -0,0 +1,97 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+from config import DEDUP_PATH, DEDUP_WINDOW
+from unfurl import normalize_url
+
+_PURGE_EVERY = 1000
+
+
+def content_digest(content, content_type, list_target, file_unique_id=None):
+    # What makes two captures the same: the content, normalized, sent to the same list.
+    # Files are told apart by Telegram's file_unique_id, stable across resends and bots.
+    if content_type in ('image', 'document', 'album') and file_unique_id:
+        body = file_unique_id
+    elif content_type == 'url' and len(content.split()) == 1:
+        body = normalize_url(content)
+    elif isinstance(content, list):
+        body = '\n'.join(content)
+    else:
+        body = ' '.join(content.split())
+    key = '\0'.join((content_type, str(list_target), body))
+    return hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+
+
+# Recent captures of each user by content digest, so that a redelivered update
+# or a double send doesn't become a second card. A capture is claimed before
+# any Trello work and gets its card ID once saved; entries older than
+# `window` seconds no longer count and are purged now and then.
+class DedupIndex:
+
+    def __init__(self, path=DEDUP_PATH, window=DEDUP_WINDOW):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.window = window
+        self._claims = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS captures ("
+            " project TEXT NOT NULL,"
+            " telegram_id INTEGER NOT NULL,"
+            " digest BLOB NOT NULL,"
+            " card_id TEXT,"
+            " created_at REAL NOT NULL,"
+            " PRIMARY KEY (project, telegram_id, digest)) WITHOUT ROWID"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS captures_age ON captures (created_at)")
+
+    def claim(self, project, tg_id, digest):
+        # (True, card ID or None while it's being saved) for a duplicate, else (False, None)
+        now = time.time()
+        key = (project, tg_id, bytes.fromhex(digest))
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute("SELECT card_id, created_at FROM captures"
+                                         " WHERE project = ? AND telegram_id = ? AND digest = ?", key).fetchone()
+                if row is not None and row[1] > now - self.window:
+                    self._conn.execute("COMMIT")
+                    return True, row[0]
+                self._conn.execute("INSERT OR REPLACE INTO captures (project, telegram_id, digest, card_id,"
+                                   " created_at) VALUES (?, ?, ?, NULL, ?)", key + (now,))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._claims += 1
+            if self._claims % _PURGE_EVERY == 0:
+                self._conn.execute("DELETE FROM captures WHERE created_at < ?", (now - self.window,))
+        return False, None
+
+    def resolve(self, project, tg_id, digest, card_id):
+        with self._lock:
+            self._conn.execute("UPDATE captures SET card_id = ?"
+                               " WHERE project = ? AND telegram_id = ? AND digest = ?",
+                               (card_id, project, tg_id, bytes.fromhex(digest)))
+
+    def release(self, project, tg_id, digest):
+        # The capture was never saved: the next identical one must go through
+        with self._lock:
+            self._conn.execute("DELETE FROM captures"
+                               " WHERE project = ? AND telegram_id = ? AND digest = ? AND card_id IS NULL",
+                               (project, tg_id, bytes.fromhex(digest)))
+
+    def forget_card(self, card_id):
+        # The card was archived or deleted: sending its content again makes a new one
+        with self._lock:
+            self._conn.execute("DELETE FROM captures WHERE card_id = ?", (card_id,))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,197 @@
+import importlib
+import signal
+import threading
+
+from telegram import Update
+from telegram.ext import Updater
+
+from app import logger
+from board_cache import BoardListCache
+from cpu import close_default_cpu_pool
+from dedup import DedupIndex
+from search import SearchIndex
+from sync import BoardSync, SyncWorker, TrelloWebhookReceiver
+from config import (BOTS, DISPATCH_WORKERS, OUTBOX_ENABLED, DEDUP_ENABLED, SEARCH_ENABLED, SYNC_ENABLED, TRELLO_ASYNC,
+                    TELEGRAM_MODE, TELEGRAM_BASE_URL, TELEGRAM_BASE_FILE_URL, WEBHOOK_URL, WEBHOOK_SECRET_TOKEN,
+                    TRELLO_WEBHOOK_URL, METRICS_PORT, SHARDS)
+from metrics import REGISTRY, MetricsServer
+from outbox import Outbox
+from scheduler import KeyedScheduler, update_key
+from shards import HashRing, shard_name
+from trello import TrelloPool
+from user_store import open_user_store
+
+_BOT_KINDS = {
+    'ideas': 'tg_ideas:IdeasBot',
+    'gtd': 'tg_gtd:GtdBot',
+}
+
+
+def bot_class(kind):
+    module_name, class_name = _BOT_KINDS.get(kind, kind).split(':')
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+# Several bots in one process: each keeps its own updater and handlers, while
+# the Trello connection pool, board list cache, user store, outbox, dedup
+# and search indexes are shared, and so is the sync keeping them in step with Trello.
+# Updates of all bots are handled by one keyed scheduler, in order per user.
+# As a shard (see shards.py) the host gets its updates from the ingress.
+class Host:
+
+    def __init__(self, mode=TELEGRAM_MODE, shard=None):
+        self.mode = 'shard' if shard is not None else mode
+        self.shard = shard
+        self.trello_pool = TrelloPool()
+        self.board_lists = BoardListCache()
+        self.user_store = open_user_store()
+        # Without OUTBOX_ENABLED, the outbox only parks captures while Trello is down
+        self.outbox = None
+        if OUTBOX_ENABLED or self.trello_pool.breaker is not None:
+            self.outbox = Outbox(owner='' if shard is None else shard_name(SHARDS[shard]))
+        self.dedup = DedupIndex() if DEDUP_ENABLED else None
+        self.search_index = SearchIndex() if SEARCH_ENABLED else None
+        self.board_sync = None
+        self.sync_worker = None
+        self.trello_webhook = None
+        if SYNC_ENABLED:
+            follows = None
+            if shard is not None:
+                # The list cache being synced is this shard's: it follows the boards of its own
+                # users, and each board cursor is moved by a single shard
+                ring, name = HashRing(shard_name(a) for a in SHARDS), shard_name(SHARDS[shard])
+                follows = lambda tg_id: ring.node_for(tg_id) == name
+            self.board_sync = BoardSync(self.trello_pool, self.user_store, board_lists=self.board_lists,
+                                        search_index=self.search_index, dedup=self.dedup, follows=follows)
+            self.sync_worker = SyncWorker(self.board_sync)
+            if TRELLO_WEBHOOK_URL and shard in (None, 0):
+                # Trello calls a single URL: the other shards see their boards' changes at the next sync
+                self.trello_webhook = TrelloWebhookReceiver(self.sync_worker)
+        self.aio = None
+        if TRELLO_ASYNC:
+            from trello_async import AsyncTrelloPool, EventLoopThread
+            self.aio = EventLoopThread(AsyncTrelloPool(breaker=self.trello_pool.breaker))
+        self.webhook = None
+        if self.mode == 'webhook':
+            from webhook import WebhookServer
+            self.webhook = WebhookServer()
+        elif self.mode == 'shard':
+            from shards import ShardListener
+            self.webhook = ShardListener(SHARDS[shard])
+        self.scheduler = KeyedScheduler() if DISPATCH_WORKERS else None
+        self.metrics = None
+        if REGISTRY.enabled:
+            self.metrics = MetricsServer(port=METRICS_PORT if shard is None else METRICS_PORT + 1 + shard)
+        self.bots = []
+        self._stopped = threading.Event()
+
+    def add_bot(self, kind, token, project):
+        app = bot_class(kind)(project,
+                              trello_pool=self.trello_pool,
+                              board_lists=self.board_lists,
+                              user_store=self.user_store,
+                              aio=self.aio,
+                              dedup=self.dedup,
+                              search_index=self.search_index,
+                              board_sync=self.board_sync)
+        app.load_users()
+
+        # Telegram messages handler
+        updater = Updater(token=token, base_url=TELEGRAM_BASE_URL, base_file_url=TELEGRAM_BASE_FILE_URL)
+        app.register(updater.dispatcher)
+        if self.scheduler is not None:
+            app.scheduler = self.scheduler
+            self._dispatch_in_turn(app, updater.dispatcher)
+        if self.outbox is not None:
+            app.start_outbox(updater.bot, self.outbox, park_only=not OUTBOX_ENABLED)
+        if self.webhook is not None:
+            self.webhook.add_bot(project, updater.bot, updater.update_queue)
+
+        self.bots.append((app, updater))
+        return app
+
+    def _dispatch_in_turn(self, app, dispatcher):
+        # The dispatcher thread only hands updates over to the scheduler, keyed by user
+        process_update = dispatcher.process_update
+
+        def hand_over(update):
+            if not isinstance(update, Update):
+                # Polling errors, which belong to no one
+                return process_update(update)
+            if not self.scheduler.submit((app.project_name, update_key(update)), process_update, update):
+                app.turned_down(update)
+
+        dispatcher.process_update = hand_over
+
+    def start(self):
+        if self.scheduler is not None:
+            self.scheduler.start()
+        if self.metrics is not None:
+            self.metrics.start()
+        if self.trello_webhook is not None:
+            self.trello_webhook.start()
+        if self.sync_worker is not None:
+            self.sync_worker.start()
+        if self.webhook is None:
+            for app, updater in self.bots:
+                updater.start_polling()
+            return
+
+        # Updates come from the webhook server or the ingress: only the dispatchers have to run
+        for app, updater in self.bots:
+            threading.Thread(target=updater.dispatcher.start,
+                             name='dispatcher-' + app.project_name,
+                             daemon=True).start()
+        self.webhook.start()
+        if WEBHOOK_URL and self.mode == 'webhook':
+            for app, updater in self.bots:
+                updater.bot.set_webhook(url='{}/{}'.format(WEBHOOK_URL.rstrip('/'), app.project_name),
+                                        secret_token=WEBHOOK_SECRET_TOKEN)
+
+    def stop(self, signum=None, frame=None):
+        if self.webhook is not None:
+            self.webhook.stop()
+        if self.metrics is not None:
+            self.metrics.stop()
+        if self.trello_webhook is not None:
+            self.trello_webhook.stop()
+        if self.sync_worker is not None:
+            self.sync_worker.stop()
+        for app, updater in self.bots:
+            updater.stop()
+            if updater.dispatcher.running:
+                updater.dispatcher.stop()
+        # Telegram won't send the albums being gathered again: they are saved as they are
+        for app, updater in self.bots:
+            app.albums.flush_all()
+        if self.scheduler is not None:
+            # What users already sent is handled before the outbox workers go
+            self.scheduler.stop()
+        for app, updater in self.bots:
+            # Albums begun by the updates just drained, with no turn left to wait for
+            app.scheduler = None
+            app.albums.flush_all()
+            if app.outbox_workers is not None:
+                app.outbox_workers.stop()
+        close_default_cpu_pool()
+        self._stopped.set()
+
+    def idle(self):
+        # Run the bots until Ctrl-C or SIGINT, SIGTERM or SIGABRT, then stop them gracefully
+        for sig in (signal.SIGINT, signal.SIGTERM, signal.SIGABRT):
+            signal.signal(sig, self.stop)
+        logger.info("Bots are idle, listening")
+        while not self._stopped.is_set():
+            self._stopped.wait(1)
+
+
+def run_bots(bot_defs=BOTS, shard=None):
+    host = Host(shard=shard)
+    for bot_def in bot_defs:
+        host.add_bot(**bot_def)
+    host.start()
+    host.idle()
+
+
+if __name__ == '__main__':
+    run_bots()
@@ -0,0 +1,266 @@
+"""
+Imports the history of a chat exported by Telegram Desktop (JSON format) into
+a user's Trello board, as if each message had been sent to the bot: commands
+route it ("in #list", "as *card"), links and files get their content type.
+
+    python -m importer result.json --project the_collector --telegram-id 123456
+
+The export is streamed, so its size doesn't matter. Progress is saved to a
+checkpoint file next to it: running the same command again resumes where the
+previous run stopped. Messages Trello kept refusing are listed in
+<checkpoint>.failed.jsonl.
+"""
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from app import App, DEFAULT_CARD_NAME_LEN
+from commands import extract_commands_from_text
+from config import IMPORT_CONCURRENCY, IMPORT_CHECKPOINT_EVERY, IMPORT_RATE_LIMITED_PAUSE
+from outbox import CaptureError
+from trello import TrelloRateLimited, TrelloUnavailable, TrelloNoAnswer
+
+logger = logging.getLogger(__name__)
+
+# Where the messages are: a single chat export, or one chat of a full account export
+SINGLE_CHAT_ITEMS = 'messages.item'
+_NOT_INCLUDED = '(File not included'
+_NO_INBOX = ("The user has no inbox list: messages without an 'in #list' command can't be imported. "
+             "Run /setup again on a board with at least one list")
+
+
+def message_text(message):
+    # Formatted texts are lists mixing plain strings and entities with a 'text'
+    text = message.get('text', '')
+    if isinstance(text, list):
+        return ''.join(part if isinstance(part, str) else part.get('text', '') for part in text)
+    return text
+
+
+def _first_entity_type(message):
+    # Like a Bot API message, whose entities leave plain text out
+    entities = message.get('text_entities')
+    if entities is None:
+        text = message.get('text')
+        entities = [part for part in text if isinstance(part, dict)] if isinstance(text, list) else []
+    for entity in entities:
+        if entity.get('type') != 'plain':
+            return entity.get('type')
+    return None
+
+
+def capture_from_message(message, export_dir):
+    # The capture the bot would have made of this message, as deliver_card kwargs, or None
+    if message.get('type') != 'message':
+        return None
+    text = message_text(message)
+
+    media = message.get('photo') or message.get('file')
+    if media is not None and not media.startswith(_NOT_INCLUDED):
+        content_type = 'image' if message.get('photo') else 'document'
+        content = os.path.join(export_dir, media)
+        command = text or None
+        if command is not None:
+            command = ('in ' + command) if command[0] == "#" else command
+        list_name, card_name, _ = extract_commands_from_text(command)
+        if card_name is None:
+            card_name = os.path.basename(media)[:10]
+    elif text.strip():
+        content_type = 'url' if _first_entity_type(message) == 'link' else 'text'
+        list_name, card_name, content = extract_commands_from_text(text)
+        if card_name is None:
+            card_name = content if content_type == 'url' else content[:DEFAULT_CARD_NAME_LEN]
+    else:
+        return None
+
+    return {
+        'content': content,
+        'card_name': card_name,
+        'list_name': list_name,
+        'content_type': content_type,
+    }
+
+
+def iter_messages(path, items=SINGLE_CHAT_ITEMS):
+    import ijson
+
+    with open(path, 'rb') as f:
+        for message in ijson.items(f, items, use_float=True):
+            yield message
+
+
+# Which messages are done. Messages complete out of order, so the checkpoint
+# keeps the ID up to which all are done, plus the few done past it.
+class Checkpoint:
+
+    def __init__(self, path):
+        self.path = path
+        self.done_through = 0
+        self.done_above = set()
+        self.imported = 0
+        self.failed = 0
+        self._in_flight = set()
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            self.done_through = state['done_through']
+            self.done_above = set(state['done_above'])
+            self.imported = state['imported']
+            self.failed = state['failed']
+
+    def is_done(self, message_id):
+        return message_id <= self.done_through or message_id in self.done_above
+
+    def started(self, message_id):
+        with self._lock:
+            self._in_flight.add(message_id)
+
+    def finished(self, message_id, imported):
+        with self._lock:
+            self._in_flight.discard(message_id)
+            self.done_above.add(message_id)
+            if imported:
+                self.imported += 1
+            else:
+                self.failed += 1
+
+    def skipped(self, message_id):
+        # Messages without anything to import still move the checkpoint forward
+        with self._lock:
+            self.done_above.add(message_id)
+
+    def save(self):
+        with self._lock:
+            floor = min(self._in_flight) if self._in_flight else None
+            done = sorted(self.done_above)
+            for message_id in done:
+                if floor is not None and message_id > floor:
+                    break
+                self.done_through = max(self.done_through, message_id)
+            self.done_above = {m for m in done if m > self.done_through}
+            state = {
+                'done_through': self.done_through,
+                'done_above': sorted(self.done_above),
+                'imported': self.imported,
+                'failed': self.failed,
+            }
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.replace(self.path + '.tmp', self.path)
+
+
+class Importer:
+
+    def __init__(self, app, user, checkpoint, concurrency=IMPORT_CONCURRENCY,
+                 checkpoint_every=IMPORT_CHECKPOINT_EVERY, failures_path=None):
+        self.app = app
+        self.user = user
+        self.checkpoint = checkpoint
+        self.concurrency = concurrency
+        self.checkpoint_every = checkpoint_every
+        self.failures_path = failures_path or checkpoint.path + '.failed.jsonl'
+        # At most this many messages read ahead of the ones being imported
+        self._slots = threading.BoundedSemaphore(concurrency * 2)
+        self._failures_lock = threading.Lock()
+
+    def _failed(self, message_id, capture, error):
+        with self._failures_lock, open(self.failures_path, 'a') as f:
+            f.write(json.dumps({'id': message_id, 'error': error, 'capture': capture}) + '\n')
+
+    def _deliver(self, message_id, capture):
+        try:
+            card_id, reply = self._deliver_card(message_id, capture)
+            if card_id is None:
+                self._failed(message_id, capture, reply)
+            self.checkpoint.finished(message_id, card_id is not None)
+        finally:
+            self._slots.release()
+
+    def _deliver_card(self, message_id, capture):
+        try:
+            while True:
+                try:
+                    return self.app.deliver_card(self.user, **capture)
+                except TrelloRateLimited:
+                    # The whole import is ahead of the limiter: wait for it rather than skip messages
+                    logger.info("Trello is throttling the import, pausing")
+                    time.sleep(IMPORT_RATE_LIMITED_PAUSE)
+                except TrelloNoAnswer as e:
+                    return None, str(e)
+                except TrelloUnavailable:
+                    logger.info("Trello is not answering, pausing the import until it does")
+                    self.app.trello_pool.breaker.wait_closed()
+        except CaptureError as e:
+            return None, str(e)
+        except Exception as e:
+            logger.exception("Could not import message {}".format(message_id))
+            return None, repr(e)
+
+    def run(self, messages, export_dir):
+        seen = 0
+        no_inbox = False
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for message in messages:
+                message_id = message.get('id')
+                if message_id is None or self.checkpoint.is_done(message_id):
+                    continue
+                capture = capture_from_message(message, export_dir)
+                if capture is None:
+                    self.checkpoint.skipped(message_id)
+                elif capture['list_name'] is None and not self.user['inbox_list_id']:
+                    # Nowhere to put it: said once, then recorded with the other failures
+                    if not no_inbox:
+                        logger.error(_NO_INBOX)
+                        no_inbox = True
+                    self._failed(message_id, capture, _NO_INBOX)
+                    self.checkpoint.finished(message_id, False)
+                else:
+                    if capture['list_name'] is None:
+                        capture['list_id'] = self.user['inbox_list_id']
+                    self._slots.acquire()
+                    self.checkpoint.started(message_id)
+                    executor.submit(self._deliver, message_id, capture)
+
+                seen += 1
+                if seen % self.checkpoint_every == 0:
+                    self.checkpoint.save()
+                    logger.info("{} cards imported, {} failed".format(self.checkpoint.imported,
+                                                                       self.checkpoint.failed))
+        self.checkpoint.save()
+        return self.checkpoint.imported, self.checkpoint.failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('export', help="result.json written by Telegram Desktop")
+    parser.add_argument('--project', required=True, help="project of the bot the user set up")
+    parser.add_argument('--telegram-id', type=int, required=True, help="Telegram ID of that user")
+    parser.add_argument('--items', default=SINGLE_CHAT_ITEMS,
+                        help="path of the messages in the export, e.g. 'chats.list.item.messages.item' "
+                             "for a full account export")
+    parser.add_argument('--concurrency', type=int, default=IMPORT_CONCURRENCY)
+    parser.add_argument('--checkpoint', help="default: <export>.checkpoint")
+    args = parser.parse_args()
+
+    app = App(args.project)
+    app.load_users()
+    user = app.user_store.get(args.project, args.telegram_id)
+    if user is None:
+        raise SystemExit("User {} has not run /setup on {}".format(args.telegram_id, args.project))
+
+    checkpoint = Checkpoint(args.checkpoint or args.export + '.checkpoint')
+    if checkpoint.done_through:
+        logger.info("Resuming after message {}".format(checkpoint.done_through))
+    importer = Importer(app, user, checkpoint, concurrency=args.concurrency)
+    imported, failed = importer.run(iter_messages(args.export, args.items),
+                                    os.path.dirname(os.path.abspath(args.export)))
+    logger.info("Done: {} cards imported, {} failed (see {})".format(imported, failed, importer.failures_path))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,358 @@
+import bisect
+import functools
+import logging
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from config import METRICS_ENABLED, METRICS_LISTEN, METRICS_PORT
+
+logger = logging.getLogger(__name__)
+
+# Seconds, from a cached Telegram reply to a Trello upload
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_TRELLO_ID = re.compile(r'/[0-9a-f]{24}(?=/|$)')
+
+
+def trello_endpoint(path):
+    # '/1/cards/5f.../attachments' -> '/1/cards/{id}/attachments', so that labels stay few
+    return _TRELLO_ID.sub('/{id}', path)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels_text(names, values, extra=''):
+    pairs = ['{}="{}"'.format(n, _escape(v)) for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class _CounterChild:
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class _HistogramChild:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+
+
+class _GaugeChild:
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value):
+        with self._lock:
+            self.value = value
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} {}'.format(self.name, self.kind)]
+        for values, child in sorted(self._children.items()):
+            lines.extend(self._render_child(values, child))
+        return lines
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def _render_child(self, values, child):
+        return ['{}{} {}'.format(self.name, _labels_text(self.labelnames, values), child.value)]
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def _new_child(self):
+        return _GaugeChild()
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def _render_child(self, values, child):
+        with child._lock:
+            counts, total = list(child.counts), child.sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            le = 'le="{}"'.format('+Inf' if bound == float('inf') else bound)
+            lines.append('{}_bucket{} {}'.format(self.name, _labels_text(self.labelnames, values, le), cumulative))
+        labels = _labels_text(self.labelnames, values)
+        lines.append('{}_sum{} {}'.format(self.name, labels, total))
+        lines.append('{}_count{} {}'.format(self.name, labels, cumulative))
+        return lines
+
+
+class _NullMetric:
+    # What every metric is when they are disabled: labels() and the updates do nothing
+
+    def labels(self, *values):
+        return self
+
+    def inc(self, amount=1):
+        pass
+
+    def dec(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    def observe(self, value):
+        pass
+
+
+_NULL = _NullMetric()
+
+
+class Registry:
+
+    def __init__(self, enabled=METRICS_ENABLED):
+        self.enabled = enabled
+        self._metrics = []
+
+    def _register(self, metric):
+        if not self.enabled:
+            return _NULL
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+HANDLER_SECONDS = REGISTRY.histogram(
+    'bot_handler_seconds', "Time spent in a Telegram update handler", ('bot', 'handler'))
+HANDLER_CALLS = REGISTRY.counter(
+    'bot_handler_calls_total', "Telegram update handler calls, by outcome", ('bot', 'handler', 'outcome'))
+
+TRELLO_REQUEST_SECONDS = REGISTRY.histogram(
+    'trello_request_seconds', "Duration of a Trello API call, retries included", ('method', 'endpoint'))
+TRELLO_REQUESTS = REGISTRY.counter(
+    'trello_requests_total', "Trello API calls, by final status code", ('method', 'endpoint', 'status'))
+TRELLO_RETRIES = REGISTRY.counter(
+    'trello_retries_total', "Trello API calls replayed after a throttle or a server error", ('method', 'endpoint'))
+TRELLO_BYTES = REGISTRY.counter(
+    'trello_bytes_total', "Bytes exchanged with the Trello API", ('method', 'endpoint', 'direction'))
+TRELLO_CALLS_PER_CARD = REGISTRY.histogram(
+    'trello_calls_per_card', "Trello API calls made to create one card", ('content_type',),
+    buckets=(1, 2, 3, 4, 6, 8, 11, 16))
+
+CAPTURES = REGISTRY.counter(
+    'captures_total', "Captures received, by content type and delivery path", ('bot', 'content_type', 'path'))
+CAPTURE_SECONDS = REGISTRY.histogram(
+    'capture_delivery_seconds', "Time to turn a capture into a Trello card", ('bot', 'content_type'))
+CAPTURE_RESULTS = REGISTRY.counter(
+    'capture_deliveries_total', "Capture deliveries, by outcome", ('bot', 'content_type', 'outcome'))
+
+CPU_PENDING = REGISTRY.gauge(
+    'cpu_pool_pending', "CPU tasks queued or running in the process pool")
+CPU_TASK_SECONDS = REGISTRY.histogram(
+    'cpu_task_seconds', "Time from handing a CPU task to the pool to getting its result", ('task',))
+CPU_TASKS = REGISTRY.counter(
+    'cpu_tasks_total', "CPU tasks, by outcome", ('task', 'outcome'))
+
+SCHEDULER_PENDING = REGISTRY.gauge(
+    'scheduler_pending', "Tasks queued or running in a keyed scheduler", ('scheduler',))
+SCHEDULER_REJECTED = REGISTRY.counter(
+    'scheduler_rejected_total', "Tasks turned down because their key had too many waiting", ('scheduler',))
+
+BREAKER_OPEN = REGISTRY.gauge(
+    'circuit_breaker_open', "1 while calls to the service are stopped", ('service',))
+BREAKER_REJECTED = REGISTRY.counter(
+    'circuit_breaker_rejected_total', "Calls turned down because the breaker was open", ('service',))
+
+
+def observe_trello_call(method, path, status, seconds, retries=0, sent=0, received=0):
+    endpoint = trello_endpoint(path)
+    TRELLO_REQUEST_SECONDS.labels(method, endpoint).observe(seconds)
+    TRELLO_REQUESTS.labels(method, endpoint, str(status)).inc()
+    if retries:
+        TRELLO_RETRIES.labels(method, endpoint).inc(retries)
+    TRELLO_BYTES.labels(method, endpoint, 'sent').inc(sent)
+    TRELLO_BYTES.labels(method, endpoint, 'received').inc(received)
+
+
+class _Delivery:
+    # Times a capture delivery; the caller sets `card_id` once Trello answered
+
+    def __init__(self, bot, content_type):
+        self.bot = bot
+        self.content_type = content_type
+        self.card_id = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            outcome = exc_type.__name__
+        else:
+            outcome = 'ok' if self.card_id is not None else 'failed'
+        CAPTURE_SECONDS.labels(self.bot, self.content_type).observe(time.perf_counter() - self._start)
+        CAPTURE_RESULTS.labels(self.bot, self.content_type, outcome).inc()
+        return False
+
+
+class _NullDelivery:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL_DELIVERY = _NullDelivery()
+
+
+def observe_delivery(bot, content_type):
+    if not REGISTRY.enabled:
+        return _NULL_DELIVERY
+    return _Delivery(bot, content_type)
+
+
+def instrumented_handler(fn):
+    # Times an App handler method; it's returned as is when metrics are off
+    if not REGISTRY.enabled:
+        return fn
+    name = fn.__name__
+
+    @functools.wraps(fn)
+    def wrapper(self, *args, **kwargs):
+        start = time.perf_counter()
+        outcome = 'error'
+        try:
+            result = fn(self, *args, **kwargs)
+            outcome = 'ok'
+            return result
+        finally:
+            HANDLER_SECONDS.labels(self.project_name, name).observe(time.perf_counter() - start)
+            HANDLER_CALLS.labels(self.project_name, name, outcome).inc()
+
+    return wrapper
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = self.server.registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Serves /metrics in the Prometheus text format
+class MetricsServer:
+
+    def __init__(self, listen=METRICS_LISTEN, port=METRICS_PORT, registry=REGISTRY):
+        self.listen = listen
+        self.port = port
+        self.registry = registry
+        self._httpd = None
+        self._thread = None
+
+    def start(self):
+        self._httpd = ThreadingHTTPServer((self.listen, self.port), _MetricsHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.registry = self.registry
+        self.port = self._httpd.server_address[1]
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name='metrics', daemon=True)
+        self._thread.start()
+        logger.info("Metrics on http://{}:{}/metrics".format(self.listen, self.port))
+
+    def stop(self):
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._thread.join()
+            self._httpd = None
@@ -0,0 +1,262 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from config import OUTBOX_PATH, OUTBOX_WORKERS, OUTBOX_MAX_ATTEMPTS, OUTBOX_RETRY_BACKOFF
+from trello import TrelloUnavailable, TrelloNoAnswer
+
+logger = logging.getLogger(__name__)
+
+_PENDING, _INFLIGHT = 'pending', 'inflight'
+
+
+class CaptureError(Exception):
+    # A capture that can never succeed as is (expired token, unknown list...):
+    # it goes straight to the dead letters instead of being retried
+    pass
+
+
+# Captures waiting to reach Trello, in a SQLite table. Rows are claimed in
+# order, one user at a time, so a _newlist is created before the following
+# message of the same user targets it. Delivered rows are deleted, rows that
+# keep failing are moved to `dead_letters`. Shards share the file: each claims
+# rows under its `owner` name, and after a crash takes back only its own.
+class Outbox:
+
+    def __init__(self, path=OUTBOX_PATH, max_attempts=OUTBOX_MAX_ATTEMPTS,
+                 backoff=OUTBOX_RETRY_BACKOFF, owner=''):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.owner = owner
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " idempotency_key TEXT NOT NULL UNIQUE,"
+            " project TEXT NOT NULL,"
+            " telegram_id INTEGER NOT NULL,"
+            " chat_id INTEGER,"
+            " reply_message_id INTEGER,"
+            " payload TEXT NOT NULL,"
+            " status TEXT NOT NULL,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " next_attempt_at REAL NOT NULL,"
+            " last_error TEXT,"
+            " created_at REAL NOT NULL,"
+            " owner TEXT)"
+        )
+        # Outboxes created before the owner column
+        if 'owner' not in {row[1] for row in self._conn.execute("PRAGMA table_info(outbox)")}:
+            self._conn.execute("ALTER TABLE outbox ADD COLUMN owner TEXT")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS outbox_user ON outbox (project, telegram_id, id)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS dead_letters ("
+            " id INTEGER PRIMARY KEY,"
+            " idempotency_key TEXT NOT NULL,"
+            " project TEXT NOT NULL,"
+            " telegram_id INTEGER NOT NULL,"
+            " chat_id INTEGER,"
+            " payload TEXT NOT NULL,"
+            " attempts INTEGER NOT NULL,"
+            " last_error TEXT,"
+            " failed_at REAL NOT NULL)"
+        )
+
+    def enqueue(self, project, telegram_id, chat_id, idempotency_key, payload):
+        # Returns None when the same key was already queued (e.g. a redelivered update)
+        with self._lock:
+            now = time.time()
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO outbox (idempotency_key, project, telegram_id, chat_id, payload,"
+                " status, next_attempt_at, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (idempotency_key, project, telegram_id, chat_id, json.dumps(payload), _PENDING, now, now)
+            )
+            self._wakeup.notify_all()
+            return cursor.lastrowid if cursor.rowcount == 1 else None
+
+    def set_reply(self, item_id, message_id):
+        with self._lock:
+            self._conn.execute("UPDATE outbox SET reply_message_id = ? WHERE id = ?", (message_id, item_id))
+
+    def recover(self, project):
+        # Rows this owner left in flight when it crashed are handed out again. Those
+        # of other owners may still be in the works, unless no owner ever claimed them
+        with self._lock:
+            self._conn.execute("UPDATE outbox SET status = ? WHERE project = ? AND status = ?"
+                               " AND (owner = ? OR owner IS NULL)",
+                               (_PENDING, project, _INFLIGHT, self.owner))
+
+    def claim(self, project, timeout=None):
+        with self._lock:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while True:
+                now = time.time()
+                self._conn.execute("BEGIN IMMEDIATE")
+                row = self._conn.execute(
+                    "SELECT id, telegram_id, chat_id, reply_message_id, payload, attempts FROM outbox o"
+                    " WHERE project = ? AND status = ? AND next_attempt_at <= ?"
+                    " AND id = (SELECT MIN(id) FROM outbox WHERE project = o.project"
+                    "           AND telegram_id = o.telegram_id)"
+                    " ORDER BY id LIMIT 1",
+                    (project, _PENDING, now)
+                ).fetchone()
+                if row is not None:
+                    self._conn.execute("UPDATE outbox SET status = ?, owner = ? WHERE id = ?",
+                                       (_INFLIGHT, self.owner, row[0]))
+                self._conn.execute("COMMIT")
+                if row is not None:
+                    return {
+                        'id': row[0],
+                        'telegram_id': row[1],
+                        'chat_id': row[2],
+                        'reply_message_id': row[3],
+                        'payload': json.loads(row[4]),
+                        'attempts': row[5],
+                    }
+                next_due = self._conn.execute(
+                    "SELECT MIN(next_attempt_at) FROM outbox WHERE project = ? AND status = ?",
+                    (project, _PENDING)
+                ).fetchone()[0]
+                wait = 1.0 if next_due is None else max(0.0, min(1.0, next_due - now))
+                if deadline is not None:
+                    wait = min(wait, deadline - time.monotonic())
+                    if wait <= 0:
+                        return None
+                self._wakeup.wait(wait)
+
+    def complete(self, item_id):
+        with self._lock:
+            self._conn.execute("DELETE FROM outbox WHERE id = ?", (item_id,))
+            self._wakeup.notify_all()
+
+    def retry(self, item_id, error):
+        # Returns True if the item will be tried again, False if it was dead-lettered
+        with self._lock:
+            attempts = self._conn.execute("SELECT attempts FROM outbox WHERE id = ?",
+                                          (item_id,)).fetchone()[0] + 1
+            if attempts >= self.max_attempts:
+                self._bury(item_id, attempts, error)
+                return False
+            self._conn.execute(
+                "UPDATE outbox SET status = ?, attempts = ?, last_error = ?, next_attempt_at = ? WHERE id = ?",
+                (_PENDING, attempts, error, time.time() + self.backoff * (2 ** (attempts - 1)), item_id)
+            )
+            return True
+
+    def postpone(self, item_id, error):
+        # Hands the item out again without counting an attempt: it was never tried
+        with self._lock:
+            self._conn.execute("UPDATE outbox SET status = ?, last_error = ? WHERE id = ?",
+                               (_PENDING, error, item_id))
+            self._wakeup.notify_all()
+
+    def fail(self, item_id, error):
+        with self._lock:
+            attempts = self._conn.execute("SELECT attempts FROM outbox WHERE id = ?",
+                                          (item_id,)).fetchone()[0] + 1
+            self._bury(item_id, attempts, error)
+
+    def _bury(self, item_id, attempts, error):
+        self._conn.execute("BEGIN IMMEDIATE")
+        self._conn.execute(
+            "INSERT INTO dead_letters (id, idempotency_key, project, telegram_id, chat_id, payload,"
+            " attempts, last_error, failed_at)"
+            " SELECT id, idempotency_key, project, telegram_id, chat_id, payload, ?, ?, ?"
+            " FROM outbox WHERE id = ?",
+            (attempts, error, time.time(), item_id)
+        )
+        self._conn.execute("DELETE FROM outbox WHERE id = ?", (item_id,))
+        self._conn.execute("COMMIT")
+        self._wakeup.notify_all()
+
+    def pending(self, project):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM outbox WHERE project = ?",
+                                      (project,)).fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+# Background threads draining the outbox of one app into Trello. Once a
+# capture is delivered (or given up on), the "saving" reply is edited in place.
+# While Trello's circuit breaker is open the workers wait, and captures pile up.
+class OutboxWorkers:
+
+    def __init__(self, app, bot, outbox, workers=OUTBOX_WORKERS):
+        self.app = app
+        self.bot = bot
+        self.outbox = outbox
+        self._stopping = threading.Event()
+        self._threads = [threading.Thread(target=self._run, name='outbox-{}'.format(i), daemon=True)
+                         for i in range(workers)]
+
+    def start(self):
+        self.outbox.recover(self.app.project_name)
+        for t in self._threads:
+            t.start()
+
+    def stop(self):
+        self._stopping.set()
+        for t in self._threads:
+            t.join()
+
+    def _run(self):
+        breaker = self.app.trello_pool.breaker
+        while not self._stopping.is_set():
+            if breaker is not None and not breaker.wait_closed(1.0):
+                continue
+            item = self.outbox.claim(self.app.project_name, timeout=1.0)
+            if item is not None:
+                self._process(item)
+
+    def _process(self, item):
+        try:
+            user = self.app.user_store.get(self.app.project_name, item['telegram_id'])
+            if user is None:
+                raise CaptureError("user is not set up anymore")
+            card_id, reply = self.app.deliver_card(user, **item['payload'])
+        except TrelloNoAnswer as e:
+            # Retried like a failure: a capture that always times out must not loop forever
+            card_id, reply = None, str(e)
+        except TrelloUnavailable as e:
+            self.outbox.postpone(item['id'], str(e))
+            return
+        except CaptureError as e:
+            self.outbox.fail(item['id'], str(e))
+            self.app.forget_capture(item['telegram_id'], item['payload'].get('dedup_key'))
+            self._reply(item, "Something wrong happened: {}. "
+                              "Restart the process please.\nEND.".format(e))
+            return
+        except Exception as e:
+            logger.exception("Outbox item {} failed".format(item['id']))
+            card_id, reply = None, repr(e)
+
+        if card_id is None:
+            if not self.outbox.retry(item['id'], reply):
+                self.app.forget_capture(item['telegram_id'], item['payload'].get('dedup_key'))
+                self._reply(item, "Sorry, I couldn't save it into Trello. Please send it again.")
+            return
+
+        self.outbox.complete(item['id'])
+        self._reply(item, reply)
+
+    def _reply(self, item, text):
+        try:
+            if item['reply_message_id'] is not None:
+                self.bot.edit_message_text(text, chat_id=item['chat_id'],
+                                           message_id=item['reply_message_id'])
+            else:
+                self.bot.send_message(item['chat_id'], text)
+        except Exception:
+            logger.exception("Could not reply for outbox item {}".format(item['id']))
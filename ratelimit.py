@@ -0,0 +1,119 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+from config import (
+    TRELLO_KEY,
+    TRELLO_RATE_LIMIT_PATH,
+    TRELLO_KEY_RATE_LIMIT,
+    TRELLO_TOKEN_RATE_LIMIT,
+    TRELLO_RATE_LIMIT_MAX_WAIT,
+)
+
+_DEFAULT_RETRY_AFTER = 10
+
+
+def _digest(value):
+    # Tokens never end up on disk, only a digest of them
+    return hashlib.sha1(value.encode()).hexdigest()[:16]
+
+
+def parse_retry_after(value):
+    if value is not None and value.strip().isdigit():
+        return int(value)
+    return _DEFAULT_RETRY_AFTER
+
+
+# Token buckets in front of Trello: one per API key (shared by every bot using
+# it) and one per user token, refilled at `requests / seconds`. The state is a
+# SQLite table, so that every process sharing the file draws from the same
+# buckets. Callers wait for a slot instead of being turned down; a 429 empties
+# the bucket it names until its Retry-After is over.
+class TrelloRateLimiter:
+
+    def __init__(self, path=TRELLO_RATE_LIMIT_PATH, key_limit=TRELLO_KEY_RATE_LIMIT,
+                 token_limit=TRELLO_TOKEN_RATE_LIMIT, max_wait=TRELLO_RATE_LIMIT_MAX_WAIT):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.key_limit = key_limit
+        self.token_limit = token_limit
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS buckets ("
+            " name TEXT PRIMARY KEY,"
+            " tokens REAL NOT NULL,"
+            " updated_at REAL NOT NULL,"
+            " blocked_until REAL NOT NULL DEFAULT 0)"
+        )
+
+    def buckets_for(self, token):
+        return 'key:' + _digest(TRELLO_KEY), 'token:' + _digest(token)
+
+    def _limit(self, name):
+        requests, seconds = self.key_limit if name.startswith('key:') else self.token_limit
+        return requests, requests / seconds
+
+    def try_acquire(self, names):
+        # Takes one slot from every bucket, or none: returns how long to wait before retrying
+        with self._lock:
+            now = time.time()
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                states = []
+                wait = 0.0
+                for name in names:
+                    capacity, rate = self._limit(name)
+                    row = self._conn.execute("SELECT tokens, updated_at, blocked_until FROM buckets"
+                                             " WHERE name = ?", (name,)).fetchone()
+                    tokens, blocked_until = (capacity, 0.0) if row is None else \
+                        (min(capacity, row[0] + (now - row[1]) * rate), row[2])
+                    wait = max(wait, blocked_until - now, (1 - tokens) / rate)
+                    states.append((name, tokens, blocked_until))
+                if wait <= 0:
+                    self._conn.executemany(
+                        "INSERT OR REPLACE INTO buckets (name, tokens, updated_at, blocked_until)"
+                        " VALUES (?, ?, ?, ?)",
+                        [(name, tokens - 1, now, blocked_until) for name, tokens, blocked_until in states]
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return max(wait, 0.0)
+
+    def acquire(self, names, max_wait=None):
+        # Queues the caller until a slot is free; False if it would take longer than `max_wait`
+        deadline = time.monotonic() + (self.max_wait if max_wait is None else max_wait)
+        while True:
+            wait = self.try_acquire(names)
+            if wait <= 0:
+                return True
+            if time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    def penalize(self, name, retry_after):
+        with self._lock:
+            now = time.time()
+            self._conn.execute(
+                "INSERT INTO buckets (name, tokens, updated_at, blocked_until) VALUES (?, 0, ?, ?)"
+                " ON CONFLICT (name) DO UPDATE SET tokens = 0, updated_at = excluded.updated_at,"
+                " blocked_until = MAX(blocked_until, excluded.blocked_until)",
+                (name, now, now + retry_after)
+            )
+
+    def penalize_for_response(self, names, status_text, retry_after):
+        # Trello says which budget ran out: the whole API key, or just this token
+        key_bucket, token_bucket = names
+        self.penalize(key_bucket if 'API_KEY_LIMIT_EXCEEDED' in status_text else token_bucket,
+                      retry_after)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
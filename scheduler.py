@@ -0,0 +1,107 @@
+import logging
+import threading
+from collections import deque
+
+from config import DISPATCH_WORKERS, DISPATCH_MAX_PENDING_PER_USER
+from metrics import SCHEDULER_PENDING, SCHEDULER_REJECTED
+
+logger = logging.getLogger(__name__)
+
+
+def update_key(update):
+    # Whose turn an update waits for: its user, else its chat (channel posts)
+    if update.effective_user is not None:
+        return update.effective_user.id
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    return None
+
+
+# Runs tasks on `workers` threads, those of one key (a Telegram user) one
+# after the other in submission order, and different keys side by side.
+# Keys with work are served round-robin, so a user sending a burst doesn't
+# hold the others back, and at most `max_pending` tasks wait per key: past
+# that, submit() turns the task down.
+class KeyedScheduler:
+
+    def __init__(self, workers=DISPATCH_WORKERS, max_pending=DISPATCH_MAX_PENDING_PER_USER, name='dispatch'):
+        self.max_pending = max_pending
+        self.name = name
+        self._queues = {}
+        self._ready = deque()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._stopping = False
+        self._threads = [threading.Thread(target=self._run, name='{}-{}'.format(name, i), daemon=True)
+                         for i in range(workers)]
+
+    def start(self):
+        for t in self._threads:
+            t.start()
+
+    def submit(self, key, fn, *args):
+        # False when `key` already has `max_pending` tasks waiting or running
+        with self._lock:
+            queue = self._queues.get(key)
+            if queue is None:
+                queue = self._queues[key] = deque()
+                # A key is in _ready only while no worker runs one of its tasks
+                self._ready.append(key)
+                self._wakeup.notify()
+            elif len(queue) >= self.max_pending:
+                SCHEDULER_REJECTED.labels(self.name).inc()
+                return False
+            queue.append((fn, args))
+        SCHEDULER_PENDING.labels(self.name).inc()
+        return True
+
+    def pending(self, key=None):
+        with self._lock:
+            if key is not None:
+                return len(self._queues.get(key, ()))
+            return sum(len(q) for q in self._queues.values())
+
+    def _next(self):
+        with self._lock:
+            while not self._ready:
+                if self._stopping:
+                    return None, None
+                self._wakeup.wait()
+            key = self._ready.popleft()
+            return key, self._queues[key][0]
+
+    def _done(self, key):
+        with self._lock:
+            queue = self._queues[key]
+            queue.popleft()
+            if queue:
+                # Back of the line: the other users go first
+                self._ready.append(key)
+                self._wakeup.notify()
+            else:
+                del self._queues[key]
+                if self._stopping and not self._queues:
+                    self._wakeup.notify_all()
+        SCHEDULER_PENDING.labels(self.name).dec()
+
+    def _run(self):
+        while True:
+            key, task = self._next()
+            if task is None:
+                return
+            fn, args = task
+            try:
+                fn(*args)
+            except Exception:
+                logger.exception("Task of {} failed".format(key))
+            finally:
+                self._done(key)
+
+    def stop(self):
+        # Lets the queued tasks finish, then ends the workers
+        with self._lock:
+            self._stopping = True
+            self._wakeup.notify_all()
+        for t in self._threads:
+            if t.is_alive():
+                t.join()
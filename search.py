@@ -0,0 +1,203 @@
+"""
+Full-text index of the cards made by the bots, answering /search without
+asking Trello. Cards are added as they are captured; the cards a board had
+before are pulled once, on its first search or with:
+
+    python -m search --project the_collector --telegram-id 123456
+"""
+import argparse
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from config import SEARCH_PATH, SEARCH_RESULTS, SEARCH_BACKFILL_PAGE
+from trello import TrelloUnauthorized
+
+logger = logging.getLogger(__name__)
+
+_TERM = re.compile(r'\w+', re.UNICODE)
+
+
+def match_query(text):
+    # User input as an FTS5 query: every word must match, the last one as a prefix
+    # (it may still be being typed). Quoting keeps FTS5 operators out of user hands.
+    terms = _TERM.findall(text)
+    if not terms:
+        return None
+    return ' '.join('"{}"'.format(t) for t in terms) + '*'
+
+
+# Cards in a plain table, mirrored by triggers into an FTS5 index of their
+# name, content and list. Searches are scoped to a board: users sharing a board
+# find each other's cards, as they would in Trello.
+class SearchIndex:
+
+    def __init__(self, path=SEARCH_PATH):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS cards ("
+            " card_id TEXT PRIMARY KEY,"
+            " board_id TEXT NOT NULL,"
+            " list_name TEXT,"
+            " name TEXT,"
+            " content TEXT,"
+            " indexed_at REAL NOT NULL);"
+            "CREATE VIRTUAL TABLE IF NOT EXISTS cards_fts USING fts5("
+            " name, content, list_name, content='cards', content_rowid='rowid',"
+            " tokenize='unicode61 remove_diacritics 2');"
+            "CREATE TRIGGER IF NOT EXISTS cards_ai AFTER INSERT ON cards BEGIN"
+            " INSERT INTO cards_fts (rowid, name, content, list_name)"
+            " VALUES (new.rowid, new.name, new.content, new.list_name); END;"
+            "CREATE TRIGGER IF NOT EXISTS cards_ad AFTER DELETE ON cards BEGIN"
+            " INSERT INTO cards_fts (cards_fts, rowid, name, content, list_name)"
+            " VALUES ('delete', old.rowid, old.name, old.content, old.list_name); END;"
+            "CREATE TRIGGER IF NOT EXISTS cards_au AFTER UPDATE ON cards BEGIN"
+            " INSERT INTO cards_fts (cards_fts, rowid, name, content, list_name)"
+            " VALUES ('delete', old.rowid, old.name, old.content, old.list_name);"
+            " INSERT INTO cards_fts (rowid, name, content, list_name)"
+            " VALUES (new.rowid, new.name, new.content, new.list_name); END;"
+            "CREATE TABLE IF NOT EXISTS backfills ("
+            " board_id TEXT PRIMARY KEY,"
+            " cards INTEGER NOT NULL,"
+            " finished_at REAL NOT NULL);"
+        )
+
+    def _upsert(self, board_id, card_id, name, content, list_name, now):
+        self._conn.execute(
+            "INSERT INTO cards (card_id, board_id, list_name, name, content, indexed_at)"
+            " VALUES (?, ?, ?, ?, ?, ?)"
+            " ON CONFLICT (card_id) DO UPDATE SET board_id = excluded.board_id,"
+            " list_name = excluded.list_name, name = excluded.name, content = excluded.content,"
+            " indexed_at = excluded.indexed_at",
+            (card_id, board_id, list_name, name, content, now))
+
+    def add(self, board_id, card_id, name, content, list_name):
+        with self._lock:
+            self._upsert(board_id, card_id, name, content, list_name, time.time())
+
+    def add_many(self, board_id, cards):
+        # cards: (card_id, name, content, list_name), written in a single transaction
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                for card_id, name, content, list_name in cards:
+                    self._upsert(board_id, card_id, name, content, list_name, now)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def update_card(self, board_id, card_id, name=None, content=None, list_name=None):
+        # Adds a card, or changes only the fields given of one already indexed
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO cards (card_id, board_id, list_name, name, content, indexed_at)"
+                " VALUES (?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT (card_id) DO UPDATE SET board_id = excluded.board_id,"
+                " list_name = coalesce(excluded.list_name, list_name), name = coalesce(excluded.name, name),"
+                " content = coalesce(excluded.content, content), indexed_at = excluded.indexed_at",
+                (card_id, board_id, list_name, name, content, time.time()))
+
+    def remove_card(self, card_id):
+        with self._lock:
+            self._conn.execute("DELETE FROM cards WHERE card_id = ?", (card_id,))
+
+    def rename_list(self, board_id, old_name, new_name):
+        with self._lock:
+            self._conn.execute("UPDATE cards SET list_name = ? WHERE board_id = ? AND list_name = ?",
+                               (new_name, board_id, old_name))
+
+    def remove_list(self, board_id, list_name):
+        with self._lock:
+            self._conn.execute("DELETE FROM cards WHERE board_id = ? AND list_name = ?", (board_id, list_name))
+
+    def search(self, board_id, text, limit=SEARCH_RESULTS):
+        # Best matches first, a hit in the card name weighing more than one in its content
+        query = match_query(text)
+        if query is None:
+            return []
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT c.card_id, c.name, c.list_name FROM cards_fts"
+                " JOIN cards c ON c.rowid = cards_fts.rowid"
+                " WHERE cards_fts MATCH ? AND c.board_id = ?"
+                " ORDER BY bm25(cards_fts, 5.0, 1.0, 1.0) LIMIT ?",
+                (query, board_id, limit)).fetchall()
+        return [{'card_id': r[0], 'name': r[1], 'list_name': r[2]} for r in rows]
+
+    def is_backfilled(self, board_id):
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM backfills WHERE board_id = ?",
+                                      (board_id,)).fetchone() is not None
+
+    def backfilled(self, board_id, cards):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO backfills (board_id, cards, finished_at)"
+                               " VALUES (?, ?, ?)", (board_id, cards, time.time()))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def backfill(index, trello, board_id, page_size=SEARCH_BACKFILL_PAGE):
+    # Pages through the open cards of a board, newest first; returns how many were
+    # indexed, or None if Trello refused the token or the board could not be read
+    try:
+        return _backfill(index, trello, board_id, page_size)
+    except TrelloUnauthorized:
+        return None
+
+
+def _backfill(index, trello, board_id, page_size):
+    lists = trello.get_board_lists(board_id)
+    if lists is None:
+        return None
+    list_names = {list_id: l['name'] for list_id, l in lists.items()}
+    count = 0
+    before = None
+    while True:
+        page = trello.get_board_cards(board_id, limit=page_size, before=before,
+                                      fields='name,desc,idList')
+        if page is None:
+            return None
+        index.add_many(board_id, [(c['id'], c['name'], c.get('desc', ''), list_names.get(c.get('idList')))
+                                  for c in page])
+        count += len(page)
+        if len(page) < page_size:
+            break
+        before = min(c['id'] for c in page)
+    index.backfilled(board_id, count)
+    logger.info("Indexed {} cards of board {}".format(count, board_id))
+    return count
+
+
+def main():
+    from app import App
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--project', required=True, help="project of the bot the user set up")
+    parser.add_argument('--telegram-id', type=int, required=True, help="Telegram ID of that user")
+    args = parser.parse_args()
+
+    app = App(args.project)
+    app.load_users()
+    user = app.user_store.get(args.project, args.telegram_id)
+    if user is None:
+        raise SystemExit("User {} has not run /setup on {}".format(args.telegram_id, args.project))
+    count = backfill(app.search_index, app.trello_pool.get(user['trello_token']), user['board_id'])
+    if count is None:
+        raise SystemExit("Trello refused the token of user {}".format(args.telegram_id))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,302 @@
+"""
+Sharded deployment: one ingress process receives the updates of every bot
+(polling or webhook) and routes each one, by its user, to one of the worker
+processes listed in SHARDS. A worker is a regular host whose updates come
+from the ingress; it owns its users' conversations, caches and Trello
+connections, while the SQLite stores are shared through the disk.
+
+    python -m shards worker --shard 0
+    python -m shards worker --shard 1
+    python -m shards ingress
+
+Users are placed on a consistent hash ring of the shard addresses: adding
+a shard moves only the users landing on its arcs, about 1/N of them.
+"""
+import argparse
+import bisect
+import hashlib
+import json
+import logging
+import queue
+import signal
+import threading
+import time
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+from telegram import Update
+from telegram.error import TelegramError
+from telegram.ext import Updater
+
+from config import (BOTS, SHARDS, SHARD_AUTHKEY, SHARD_REPLICAS, SHARD_RETRY_INTERVAL, SHARD_QUEUE_SIZE,
+                    TELEGRAM_MODE, TELEGRAM_BASE_URL, WEBHOOK_URL, WEBHOOK_SECRET_TOKEN)
+from scheduler import update_key
+
+logger = logging.getLogger(__name__)
+
+
+def shard_name(address):
+    return '{}:{}'.format(*address)
+
+
+def _point(text):
+    return int.from_bytes(hashlib.md5(text.encode()).digest()[:8], 'big')
+
+
+# Each node sits at `replicas` points of a 64-bit ring; a key belongs to the
+# first node point at or after its own hash, wrapping around.
+class HashRing:
+
+    def __init__(self, nodes=(), replicas=SHARD_REPLICAS):
+        self.replicas = replicas
+        self._points = []
+        self._nodes = []
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        for i in range(self.replicas):
+            point = _point('{}#{}'.format(node, i))
+            index = bisect.bisect(self._points, point)
+            self._points.insert(index, point)
+            self._nodes.insert(index, node)
+
+    def remove(self, node):
+        kept = [(p, n) for p, n in zip(self._points, self._nodes) if n != node]
+        self._points = [p for p, _ in kept]
+        self._nodes = [n for _, n in kept]
+
+    def node_for(self, key):
+        if not self._points:
+            raise LookupError("The hash ring has no nodes")
+        index = bisect.bisect_left(self._points, _point(str(key))) % len(self._points)
+        return self._nodes[index]
+
+
+# Worker side: accepts the ingress on the shard's address and puts the updates
+# it sends in the queue of their bot, as WebhookServer does for Telegram's.
+class ShardListener:
+
+    def __init__(self, address, authkey=SHARD_AUTHKEY):
+        self.address = tuple(address)
+        self.authkey = authkey
+        self.routes = {}
+        self._listener = None
+        self._thread = None
+        self._connections = set()
+        self._lock = threading.Lock()
+
+    def add_bot(self, project, bot, update_queue):
+        self.routes[project] = (bot, update_queue)
+
+    def start(self):
+        self._listener = Listener(self.address, authkey=self.authkey.encode())
+        self.address = self._listener.address
+        self._thread = threading.Thread(target=self._accept, name='shard-listener', daemon=True)
+        self._thread.start()
+        logger.info("Shard listening on {}".format(shard_name(self.address)))
+
+    def _accept(self):
+        while True:
+            try:
+                conn = self._listener.accept()
+            except (OSError, AuthenticationError):
+                # The listener was closed by stop(); failed handshakes only log
+                if self._listener is None:
+                    return
+                logger.warning("Refused a connection to the shard", exc_info=True)
+                continue
+            with self._lock:
+                self._connections.add(conn)
+            threading.Thread(target=self._receive, args=(conn,), name='shard-receive', daemon=True).start()
+
+    def _receive(self, conn):
+        # One reader per connection: updates reach the queues in the order they were sent
+        try:
+            while True:
+                message = json.loads(conn.recv_bytes().decode('utf-8'))
+                route = self.routes.get(message['project'])
+                if route is None:
+                    logger.warning("Update for unknown bot {}".format(message['project']))
+                    continue
+                bot, update_queue = route
+                update_queue.put(Update.de_json(message['update'], bot))
+        except (EOFError, OSError):
+            pass
+        finally:
+            with self._lock:
+                self._connections.discard(conn)
+            conn.close()
+
+    def stop(self):
+        if self._listener is not None:
+            listener, self._listener = self._listener, None
+            listener.close()
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+
+
+# One connection to a shard, opened on first use and again after failures,
+# fed by its own sender thread. send() only queues the update, so a shard
+# that is down never holds up the dispatcher routing to the others. The
+# sender holds on to an update until the shard takes it: a restarting worker
+# delays its users rather than losing their messages, up to `queue_size`
+# of them, after which new updates are dropped.
+class _ShardClient:
+
+    def __init__(self, address, authkey, retry_interval, stopping, queue_size=SHARD_QUEUE_SIZE):
+        self.address = tuple(address)
+        self.authkey = authkey
+        self.retry_interval = retry_interval
+        self.stopping = stopping
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._conn = None
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='shard-send-' + shard_name(self.address),
+                                        daemon=True)
+        self._thread.start()
+
+    def send(self, data):
+        # Returns False when the update was dropped
+        try:
+            self._queue.put_nowait(data)
+            return True
+        except queue.Full:
+            logger.warning("Shard {} has {} updates waiting, one dropped".format(
+                shard_name(self.address), self._queue.maxsize))
+            return False
+
+    def _run(self):
+        while not self.stopping.is_set():
+            try:
+                data = self._queue.get(timeout=1.0)
+            except queue.Empty:
+                continue
+            self._deliver(data)
+
+    def _deliver(self, data):
+        while not self.stopping.is_set():
+            try:
+                if self._conn is None:
+                    self._conn = Client(self.address, authkey=self.authkey.encode())
+                self._conn.send_bytes(data)
+                return True
+            except OSError:
+                logger.warning("Shard {} unreachable, retrying in {}s".format(
+                    shard_name(self.address), self.retry_interval))
+                self._close()
+                self.stopping.wait(self.retry_interval)
+        return False
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def stop(self):
+        # After `stopping` is set: what the shard hasn't taken yet is lost
+        if self._thread is not None:
+            self._thread.join()
+        self._close()
+
+
+# Receives the updates of every bot and forwards each one to the shard of its
+# user. Its dispatchers have no handlers: they only route.
+class Ingress:
+
+    def __init__(self, shards=SHARDS, mode=TELEGRAM_MODE, authkey=SHARD_AUTHKEY,
+                 retry_interval=SHARD_RETRY_INTERVAL):
+        self.mode = mode
+        self._stopping = threading.Event()
+        self.ring = HashRing(shard_name(a) for a in shards)
+        self.clients = {shard_name(a): _ShardClient(a, authkey, retry_interval, self._stopping) for a in shards}
+        self.webhook = None
+        if mode == 'webhook':
+            from webhook import WebhookServer
+            self.webhook = WebhookServer()
+        self.updaters = []
+
+    def shard_for(self, update):
+        return self.ring.node_for(update_key(update))
+
+    def route(self, project, update):
+        if not isinstance(update, Update):
+            logger.warning("Polling error: {}".format(update))
+            return
+        data = json.dumps({'project': project, 'update': update.to_dict()}).encode('utf-8')
+        if self.clients[self.shard_for(update)].send(data) or update.effective_message is None:
+            return
+        try:
+            update.effective_message.reply_text("Sorry, I can't save messages right now. "
+                                                "Send this one again in a moment.")
+        except TelegramError:
+            logger.info("Could not tell {} their update was dropped".format(update_key(update)))
+
+    def add_bot(self, token, project, **_):
+        updater = Updater(token=token, base_url=TELEGRAM_BASE_URL)
+        updater.dispatcher.process_update = lambda update: self.route(project, update)
+        if self.webhook is not None:
+            self.webhook.add_bot(project, updater.bot, updater.update_queue)
+        self.updaters.append((project, updater))
+
+    def start(self):
+        for client in self.clients.values():
+            client.start()
+        if self.webhook is None:
+            for project, updater in self.updaters:
+                updater.start_polling()
+            return
+
+        for project, updater in self.updaters:
+            threading.Thread(target=updater.dispatcher.start, name='dispatcher-' + project, daemon=True).start()
+        self.webhook.start()
+        if WEBHOOK_URL:
+            for project, updater in self.updaters:
+                updater.bot.set_webhook(url='{}/{}'.format(WEBHOOK_URL.rstrip('/'), project),
+                                        secret_token=WEBHOOK_SECRET_TOKEN)
+
+    def stop(self, signum=None, frame=None):
+        if self.webhook is not None:
+            self.webhook.stop()
+        self._stopping.set()
+        for project, updater in self.updaters:
+            updater.stop()
+            if updater.dispatcher.running:
+                updater.dispatcher.stop()
+        for client in self.clients.values():
+            client.stop()
+
+    def idle(self):
+        for sig in (signal.SIGINT, signal.SIGTERM, signal.SIGABRT):
+            signal.signal(sig, self.stop)
+        logger.info("Ingress routing to {} shards".format(len(self.clients)))
+        while not self._stopping.is_set():
+            time.sleep(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('role', choices=('ingress', 'worker'))
+    parser.add_argument('--shard', type=int, help="index in SHARDS of the worker to run")
+    args = parser.parse_args()
+
+    if args.role == 'ingress':
+        ingress = Ingress()
+        for bot_def in BOTS:
+            ingress.add_bot(**bot_def)
+        ingress.start()
+        ingress.idle()
+        return
+
+    from host import run_bots
+
+    if args.shard is None or not 0 <= args.shard < len(SHARDS):
+        parser.error("--shard must be an index in SHARDS (0 to {})".format(len(SHARDS) - 1))
+    run_bots(shard=args.shard)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,331 @@
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from config import (
+    SYNC_PATH,
+    SYNC_INTERVAL,
+    SYNC_PAGE,
+    TRELLO_WEBHOOK_URL,
+    TRELLO_WEBHOOK_LISTEN,
+    TRELLO_WEBHOOK_PORT,
+    TRELLO_APP_SECRET,
+    TRELLO_WEBHOOK_MAX_BODY,
+)
+from trello import TrelloRateLimited, TrelloUnavailable, TrelloUnauthorized
+
+logger = logging.getLogger(__name__)
+
+# The board actions that change what we keep locally: cards and lists coming, going or renamed
+ACTION_FILTER = ','.join((
+    'createCard', 'copyCard', 'convertToCardFromCheckItem', 'moveCardToBoard',
+    'updateCard', 'deleteCard', 'moveCardFromBoard',
+    'createList', 'updateList', 'moveListToBoard', 'moveListFromBoard',
+))
+
+_CARD_ADDED = ('createCard', 'copyCard', 'convertToCardFromCheckItem', 'moveCardToBoard')
+_CARD_REMOVED = ('deleteCard', 'moveCardFromBoard')
+_LIST_ADDED = ('createList', 'moveListToBoard')
+
+SIGNATURE_HEADER = 'X-Trello-Webhook'
+
+
+# Keeps the local views of boards (list cache, search index, dedup index) in
+# step with Trello by reading, per board, the actions that happened since a
+# cursor: a refresh costs the few events since the last one rather than the
+# whole board. Boards are followed through one of their users, whose token
+# is looked up at each sync. With `follows`, only the boards followed through
+# the users it accepts are synced (a shard syncs those of its own users).
+class BoardSync:
+
+    def __init__(self, trello_pool, user_store, board_lists=None, search_index=None, dedup=None,
+                 path=SYNC_PATH, page_size=SYNC_PAGE, webhook_url=TRELLO_WEBHOOK_URL, follows=None):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.trello_pool = trello_pool
+        self.user_store = user_store
+        self.board_lists = board_lists
+        self.search_index = search_index
+        self.dedup = dedup
+        self.page_size = page_size
+        self.webhook_url = webhook_url
+        self.follows = follows
+        self._tracked = set()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS board_cursors ("
+            " board_id TEXT PRIMARY KEY,"
+            " project TEXT NOT NULL,"
+            " telegram_id INTEGER NOT NULL,"
+            " last_action_id TEXT,"
+            " synced_at REAL)"
+        )
+
+    def track(self, project, tg_id, board_id):
+        # Cheap enough to call on every setup or search: the board is only written once
+        if board_id in self._tracked:
+            return
+        with self._lock:
+            self._conn.execute("INSERT OR IGNORE INTO board_cursors (board_id, project, telegram_id)"
+                               " VALUES (?, ?, ?)", (board_id, project, tg_id))
+            self._tracked.add(board_id)
+
+    def untrack(self, board_id):
+        with self._lock:
+            self._conn.execute("DELETE FROM board_cursors WHERE board_id = ?", (board_id,))
+            self._tracked.discard(board_id)
+
+    def boards(self):
+        with self._lock:
+            return self._conn.execute("SELECT board_id, project, telegram_id, last_action_id"
+                                      " FROM board_cursors").fetchall()
+
+    def _cursor(self, board_id):
+        with self._lock:
+            row = self._conn.execute("SELECT project, telegram_id, last_action_id FROM board_cursors"
+                                     " WHERE board_id = ?", (board_id,)).fetchone()
+        return row
+
+    def _save_cursor(self, board_id, last_action_id):
+        with self._lock:
+            self._conn.execute("UPDATE board_cursors SET last_action_id = ?, synced_at = ? WHERE board_id = ?",
+                               (last_action_id, time.time(), board_id))
+
+    def _trello_for(self, board_id, project, tg_id):
+        user = self.user_store.get(project, tg_id)
+        if user is None or user['board_id'] != board_id:
+            # The user left or moved to another board: someone else will track it if needed
+            self.untrack(board_id)
+            return None
+        return self.trello_pool.get(user['trello_token'])
+
+    def baseline(self, trello, board_id):
+        # Starts the cursor at the latest action, before the board is snapshotted: what
+        # happened earlier is in the snapshot, what happens next will be synced
+        row = self._cursor(board_id)
+        if row is None or row[2] is not None:
+            return
+        actions = trello.get_board_actions(board_id, limit=1, filter=ACTION_FILTER)
+        if actions is None:
+            return
+        self._save_cursor(board_id, actions[0]['id'] if actions else '')
+        if self.webhook_url:
+            trello.create_webhook(self.webhook_url, board_id, "Board sync")
+
+    def sync(self, board_id):
+        # Applies the actions since the cursor; returns how many, or None if the board could not be read
+        row = self._cursor(board_id)
+        if row is None:
+            return None
+        project, tg_id, since = row
+        if self.follows is not None and not self.follows(tg_id):
+            # Another process moves this board's cursor
+            return None
+        trello = self._trello_for(board_id, project, tg_id)
+        if trello is None:
+            return None
+        if since is None:
+            self.baseline(trello, board_id)
+            return 0
+
+        actions = []
+        before = None
+        while True:
+            page = trello.get_board_actions(board_id, since=since or None, before=before,
+                                            limit=self.page_size, filter=ACTION_FILTER)
+            if page is None:
+                return None
+            actions.extend(page)
+            if len(page) < self.page_size:
+                break
+            before = page[-1]['id']
+
+        for action in reversed(actions):
+            try:
+                self.apply(board_id, action)
+            except (KeyError, TypeError):
+                logger.info("Skipped malformed action {} on board {}".format(action.get('id'), board_id))
+        if actions:
+            self._save_cursor(board_id, actions[0]['id'])
+        return len(actions)
+
+    def sync_all(self):
+        for board_id, _, _, _ in self.boards():
+            try:
+                count = self.sync(board_id)
+            except (TrelloRateLimited, TrelloUnavailable):
+                logger.info("Trello is throttling or down, board sync postponed")
+                return
+            except TrelloUnauthorized:
+                logger.info("Trello refused the token following board {}".format(board_id))
+                continue
+            except Exception:
+                logger.exception("Could not sync board {}".format(board_id))
+                continue
+            if count:
+                logger.info("Applied {} actions of board {}".format(count, board_id))
+
+    def apply(self, board_id, action):
+        kind = action['type']
+        data = action['data']
+        old = data.get('old', {})
+
+        if kind in _LIST_ADDED or kind in ('updateList', 'moveListFromBoard'):
+            trello_list = data['list']
+            closed = trello_list.get('closed') is True or kind == 'moveListFromBoard'
+            name = trello_list.get('name')
+            if self.board_lists is not None and (closed or name is not None):
+                self.board_lists.update_list(board_id, trello_list['id'], name, closed)
+            if self.search_index is not None:
+                if closed:
+                    self.search_index.remove_list(board_id, name)
+                elif 'name' in old:
+                    self.search_index.rename_list(board_id, old['name'], name)
+            return
+
+        card = data['card']
+        if kind in _CARD_REMOVED or card.get('closed') is True:
+            if self.search_index is not None:
+                self.search_index.remove_card(card['id'])
+            if self.dedup is not None:
+                self.dedup.forget_card(card['id'])
+            return
+        if self.search_index is None:
+            return
+        if kind in _CARD_ADDED or old.get('closed') is True:
+            self.search_index.update_card(board_id, card['id'], name=card.get('name'), content=card.get('desc'),
+                                          list_name=(data.get('list') or {}).get('name'))
+        else:
+            # Only what changed is in the action: a rename, a new description, another list
+            self.search_index.update_card(board_id, card['id'],
+                                          name=card['name'] if 'name' in old else None,
+                                          content=card['desc'] if 'desc' in old else None,
+                                          list_name=data['listAfter']['name'] if 'idList' in old else None)
+
+
+# Runs BoardSync.sync_all every `interval` seconds, or sooner for a board
+# Trello told us about through a webhook.
+class SyncWorker:
+
+    def __init__(self, board_sync, interval=SYNC_INTERVAL):
+        self.board_sync = board_sync
+        self.interval = interval
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def wake(self, board_id):
+        with self._lock:
+            self._pending.add(board_id)
+        self._wakeup.set()
+
+    def _run(self):
+        next_full = time.monotonic()
+        while not self._stopping.is_set():
+            if time.monotonic() >= next_full:
+                self.board_sync.sync_all()
+                next_full = time.monotonic() + self.interval
+            with self._lock:
+                pending, self._pending = self._pending, set()
+            for board_id in pending:
+                try:
+                    self.board_sync.sync(board_id)
+                except Exception:
+                    logger.exception("Could not sync board {}".format(board_id))
+            self._wakeup.wait(max(0.0, next_full - time.monotonic()))
+            self._wakeup.clear()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='board-sync', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+def webhook_signature(secret, body, callback_url):
+    # What Trello puts in X-Trello-Webhook: base64 HMAC-SHA1 of the body followed by the callback URL
+    digest = hmac.new(secret.encode(), body + callback_url.encode(), hashlib.sha1).digest()
+    return base64.b64encode(digest).decode()
+
+
+class _TrelloWebhookHandler(BaseHTTPRequestHandler):
+
+    def do_HEAD(self):
+        # Trello's check that the callback exists, when the webhook is created
+        self._answer(200)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > self.server.max_body:
+            return self._answer(413)
+        body = self.rfile.read(length)
+        signature = webhook_signature(self.server.secret, body, self.server.callback_url)
+        if not hmac.compare_digest(self.headers.get(SIGNATURE_HEADER, '').encode(), signature.encode()):
+            logger.warning("Trello webhook call without a valid signature")
+            return self._answer(403)
+        try:
+            board_id = json.loads(body.decode('utf-8'))['model']['id']
+        except (ValueError, KeyError, TypeError):
+            return self._answer(400)
+        # The push is only a hint: the worker reads the actions from the cursor, in order
+        self.server.worker.wake(board_id)
+        self._answer(200)
+
+    def _answer(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logger.debug("Trello webhook: " + format % args)
+
+
+# Receives Trello's webhook calls for the tracked boards, behind the same
+# kind of TLS proxy as the Telegram webhook, at TRELLO_WEBHOOK_URL.
+class TrelloWebhookReceiver:
+
+    def __init__(self, worker, listen=TRELLO_WEBHOOK_LISTEN, port=TRELLO_WEBHOOK_PORT,
+                 callback_url=TRELLO_WEBHOOK_URL, secret=TRELLO_APP_SECRET, max_body=TRELLO_WEBHOOK_MAX_BODY):
+        self.worker = worker
+        self.listen = listen
+        self.port = port
+        self.callback_url = callback_url
+        self.secret = secret
+        self.max_body = max_body
+        self._httpd = None
+        self._thread = None
+
+    def start(self):
+        self._httpd = ThreadingHTTPServer((self.listen, self.port), _TrelloWebhookHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.worker = self.worker
+        self._httpd.callback_url = self.callback_url
+        self._httpd.secret = self.secret
+        self._httpd.max_body = self.max_body
+        self.port = self._httpd.server_address[1]
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name='trello-webhook', daemon=True)
+        self._thread.start()
+        logger.info("Trello webhook listening on {}:{}".format(self.listen, self.port))
+
+    def stop(self):
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._thread.join()
+            self._httpd = None
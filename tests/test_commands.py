@@ -0,0 +1,31 @@
+import pytest
+
+from bench.bench_parser import check_equivalence, generate_corpus
+from commands import SHORTCUT_REGEX, extract_commands_from_groups, extract_commands_from_text
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('in #a as *b', ('a', 'b', '')),
+    ('in #_new as *b', ('_new', 'b', '')),
+    ('buy milk in #groceries', ('groceries', 'buy milk ', 'buy milk')),
+    ('buy milk as *milk', (None, 'milk', 'buy milk')),
+    ('buy milk in #_groceries as *milk', ('_groceries', 'milk', 'buy milk')),
+    ('see in #a later\nin #b', ('b', 'see in #a later\n', 'see in #a later')),
+])
+def test_shortcut_groups_parse_like_the_text(text, expected):
+    # The handler gets the filter's groups: they must say what parsing the text says.
+    # A default card name keeps the space before the command, as it always did
+    match = SHORTCUT_REGEX.match(text)
+    assert match is not None
+    assert extract_commands_from_groups(match.groupdict()) == expected
+    assert extract_commands_from_text(text) == expected
+
+
+@pytest.mark.parametrize('text', ['in #a', 'as *b', 'just some text', 'in #a as *b and more'])
+def test_shortcut_filter_leaves_other_messages(text):
+    assert SHORTCUT_REGEX.match(text) is None
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_same_results_as_the_legacy_parser(seed):
+    assert check_equivalence(generate_corpus(2000, seed)) == []
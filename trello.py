@@ -1,50 +1,189 @@
-import base64
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
-from config import TRELLO_KEY
+import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from config import (
+    TRELLO_KEY,
+    TRELLO_POOL_SIZE,
+    TRELLO_MAX_RETRIES,
+    TRELLO_RETRY_BACKOFF,
+    TRELLO_RATE_LIMIT_ENABLED,
+    TRELLO_TIMEOUT,
+    TRELLO_TIMEOUTS,
+    TRELLO_BREAKER_ENABLED,
+)
 import logging
-from bs4 import BeautifulSoup
+from unfurl import default_unfurler, find_url, is_single_url
+from attachments import default_spooler, attachment_name, attachment_mime_type
+from ratelimit import TrelloRateLimiter, parse_retry_after
+from breaker import CircuitBreaker
+from metrics import REGISTRY, TRELLO_CALLS_PER_CARD, observe_trello_call, trello_endpoint
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
 
+def parse_starred_boards(j):
+    results = {}
+    for board in j:
+        if board['starred']:
+            results[board['id']] = {'name': board['name'], 'id': board['id']}
+    return results
+
+
+def parse_board_lists(j):
+    results = {}
+    for l in j:
+        if not l['closed']:
+            results[l['id']] = {'name': l['name'], 'id': l['id']}
+    return results
+
+
+def card_page_query(limit=None, before=None, fields=None):
+    # Paging of the card listings: at most `limit` cards older than the card `before`
+    querystring = {}
+    if limit is not None:
+        querystring['limit'] = limit
+    if before is not None:
+        querystring['before'] = before
+    if fields is not None:
+        querystring['fields'] = fields
+    return querystring or None
+
+
+def request_timeout(method, path):
+    # (connect, read) seconds for a call, see TRELLO_TIMEOUTS
+    return TRELLO_TIMEOUTS.get('{} {}'.format(method, trello_endpoint(path)), TRELLO_TIMEOUT)
+
+
+class TrelloRateLimited(Exception):
+    # Trello kept throttling us: unlike a None result, this says nothing about the token
+    pass
+
+
+class TrelloUnauthorized(Exception):
+    # Trello refused the token (401): the user has to run /setup again. Other
+    # failures return None and may well go away on their own
+    pass
+
+
+class TrelloUnavailable(Exception):
+    # The circuit breaker is open: the call was not even tried
+    pass
+
+
+class TrelloNoAnswer(TrelloUnavailable):
+    # The call was sent, but the connection failed or Trello didn't answer in time.
+    # Unlike an open breaker it may have reached Trello, so it counts as an attempt
+    pass
+
+
 class Trello:
     _URL_PREFIX = 'https://api.trello.com'
-    _URL_QUERYSTRING = {'key': TRELLO_KEY, 'token': ''}
 
-    def __init__(self, token):
+    def __init__(self, token, session=None, unfurler=None, spooler=None, rate_limiter=None,
+                 max_retries=TRELLO_MAX_RETRIES, backoff_factor=TRELLO_RETRY_BACKOFF, breaker=None):
         self.auth_token = token
-        self._URL_QUERYSTRING['token'] = self.auth_token
+        self.session = session if session is not None else requests
+        self._unfurler = unfurler
+        self._spooler = spooler
+        self.rate_limiter = rate_limiter
+        self.breaker = breaker
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self._url_querystring = {'key': TRELLO_KEY, 'token': self.auth_token}
+        self._buckets = rate_limiter.buckets_for(token) if rate_limiter is not None else None
 
     def _make_request(self, path, method='GET', querystring=None,
-                      payload=None, files=None):
+                      payload=None, files=None, headers=None):
         url = self._URL_PREFIX + path
         call_params = {}
         if querystring is None:
-            call_params['params'] = {**self._URL_QUERYSTRING}
+            call_params['params'] = {**self._url_querystring}
         else:
-            call_params['params'] = {**self._URL_QUERYSTRING, **querystring}
+            # A None value would be sent as an empty parameter
+            call_params['params'] = {**self._url_querystring,
+                                     **{k: v for k, v in querystring.items() if v is not None}}
         if payload is not None:
             call_params['data'] = payload
         if files is not None:
             call_params['files'] = files
-        r = requests.request(method, url, **call_params)
+        if headers is not None:
+            call_params['headers'] = headers
+        if self.breaker is not None and not self.breaker.allow():
+            raise TrelloUnavailable("Trello is not answering, {} {} not sent".format(method, path))
+
+        # A streamed body is consumed by the first attempt
+        replayable = not hasattr(payload, 'read')
+        start = time.perf_counter()
+        for attempt in range(self.max_retries + 1):
+            if self._buckets is not None and not self.rate_limiter.acquire(self._buckets):
+                if REGISTRY.enabled:
+                    observe_trello_call(method, path, 'limited', time.perf_counter() - start, attempt)
+                raise TrelloRateLimited("No Trello slot available for {} {}".format(method, path))
+            try:
+                r = self.session.request(method, url, timeout=request_timeout(method, path), **call_params)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if self.breaker is not None:
+                    self.breaker.record(False)
+                raise TrelloNoAnswer("No answer from Trello to {} {}: {}".format(method, path, e)) from e
+            if r.status_code != 429:
+                break
+            # A throttled call never reached Trello, so it is safe to replay whatever the verb,
+            # as long as its body can be sent again
+            retry_after = r.headers.get('Retry-After')
+            if self._buckets is not None:
+                # The limiter queues the replay, for this and every other call on the bucket
+                self.rate_limiter.penalize_for_response(self._buckets, r.text, parse_retry_after(retry_after))
+            if (not replayable) | (attempt == self.max_retries):
+                break
+            if self._buckets is None:
+                delay = self.backoff_factor * (2 ** attempt)
+                if retry_after is not None and retry_after.isdigit():
+                    delay = max(delay, int(retry_after))
+                time.sleep(delay)
+
+        if REGISTRY.enabled:
+            self._observe(method, path, r, start, attempt)
+        if self.breaker is not None:
+            self.breaker.record(r.status_code < 500)
+
         if r.status_code == 200:
             return r.json()
+        elif r.status_code == 429:
+            raise TrelloRateLimited("Trello throttled {} {}: {}".format(method, path, r.text))
+        elif r.status_code == 401:
+            raise TrelloUnauthorized("Trello refused the token for {} {}".format(method, path))
         else:
             logger.debug("Failed call ({}): {}".format(r.status_code, r.text))
             return None
 
+    def _observe(self, method, path, r, start, replays):
+        # Replays are ours (throttling) plus urllib3's (server errors), found in the response
+        retries = getattr(r.raw, 'retries', None)
+        if retries is not None:
+            replays += len(retries.history)
+        observe_trello_call(method, path, r.status_code, time.perf_counter() - start, replays,
+                            sent=int(r.request.headers.get('Content-Length') or 0),
+                            received=len(r.content))
+
+    @property
+    def unfurler(self):
+        return self._unfurler if self._unfurler is not None else default_unfurler()
+
+    @property
+    def spooler(self):
+        return self._spooler if self._spooler is not None else default_spooler()
+
     def get_starred_boards(self):
         j = self._make_request('/1/members/me/boards')
         if j is None:
             return None
-        results = {}
-        for board in j:
-            if board['starred']:
-                results[board['id']] = {'name': board['name'], 'id': board['id']}
-        return results
+        return parse_starred_boards(j)
 
     def get_board_info(self, board_id):
         j = self._make_request('/1/boards/{idBoard}'.format(idBoard=board_id))
@@ -54,17 +193,34 @@ class Trello:
         j = self._make_request('/1/boards/{idBoard}/lists'.format(idBoard=board_id))
         if j is None:
             return None
-        results = {}
-        for l in j:
-            if not l['closed']:
-                results[l['id']] = {'name': l['name'], 'id': l['id']}
-        return results
+        return parse_board_lists(j)
 
-    def get_board_cards(self, board_id):
-        return self._make_request('/1/boards/{idBoard}/cards'.format(idBoard=board_id))
+    def get_board_cards(self, board_id, limit=None, before=None, fields=None):
+        return self._make_request('/1/boards/{idBoard}/cards'.format(idBoard=board_id),
+                                  querystring=card_page_query(limit, before, fields))
 
-    def get_list_cards(self, list_id):
-        return self._make_request('/1/lists/{idList}/cards'.format(idList=list_id))
+    def get_list_cards(self, list_id, limit=None, before=None, fields=None):
+        return self._make_request('/1/lists/{idList}/cards'.format(idList=list_id),
+                                  querystring=card_page_query(limit, before, fields))
+
+    def get_board_actions(self, board_id, since=None, before=None, limit=None, filter=None):
+        # Newest first. `since` and `before` are action IDs (or dates), both excluded
+        querystring = {}
+        for name, value in (('since', since), ('before', before), ('limit', limit), ('filter', filter)):
+            if value is not None:
+                querystring[name] = value
+        return self._make_request('/1/boards/{idBoard}/actions'.format(idBoard=board_id),
+                                  querystring=querystring)
+
+    def create_webhook(self, callback_url, model_id, description=''):
+        # Trello checks the callback answers a HEAD before accepting it
+        j = self._make_request('/1/webhooks', method='POST',
+                               querystring={'callbackURL': callback_url,
+                                            'idModel': model_id,
+                                            'description': description})
+        if j is None:
+            return None
+        return j['id']
 
     def create_list_in_board(self, list_name, board_id):
         j = self._make_request('/1/lists', method='POST',
@@ -82,8 +238,53 @@ class Trello:
                                querystring=querystring)
         return j
 
+    def attach_url(self, card_id, url):
+        return self._make_request('/1/cards/{}/attachments'.format(card_id), method='POST',
+                                  querystring={'url': url, 'setCover': 'false'})
+
+    def attach_file(self, card_id, file_url, set_cover=True):
+        from requests_toolbelt import MultipartEncoder
+
+        url = '/1/cards/{}/attachments'.format(card_id)
+        name = attachment_name(file_url)
+        try:
+            with self.spooler.open(file_url) as spool:
+                encoder = MultipartEncoder(fields={'file': (name, spool, attachment_mime_type(name))})
+                return self._make_request(url, method='POST', payload=encoder,
+                                          querystring=None if set_cover else {'setCover': 'false'},
+                                          headers={'Content-Type': encoder.content_type})
+        except (requests.RequestException, urllib3.exceptions.HTTPError, OSError) as e:
+            # A streamed body can't be replayed: the card is kept, without its attachment
+            logger.info("Could not attach {} to {}: {}".format(name, card_id, e))
+            return None
+
+    def attach_files(self, card_id, file_urls, set_cover=True):
+        # Side by side, as many at once as the spooler lets through
+        workers = max(1, min(len(file_urls), self.spooler.max_concurrent))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(lambda file_url: self.attach_file(card_id, file_url, set_cover),
+                                     file_urls))
+
+    def _create_card_with_file(self, querystring, file_url):
+        # The file is the card's fileSource: card and attachment in one call
+        from requests_toolbelt import MultipartEncoder
+
+        name = attachment_name(file_url)
+        try:
+            with self.spooler.open(file_url) as spool:
+                encoder = MultipartEncoder(fields={'fileSource': (name, spool, attachment_mime_type(name))})
+                return self._make_request('/1/cards', method='POST', querystring=querystring, payload=encoder,
+                                          headers={'Content-Type': encoder.content_type})
+        except (requests.RequestException, urllib3.exceptions.HTTPError, OSError) as e:
+            # Nothing was created: the capture can be tried again as a whole
+            logger.info("Could not create a card with {}: {}".format(name, e))
+            return None
+
     def create_card_in_list(self, list_id, card_name, content, content_type='text'):
-        url = '/1/cards'
+        # A single call for most content: a lone link and files go in as the card's
+        # urlSource/fileSource, a link within text is attached next, album items are attached side by side without
+        # becoming the cover, and the cover Trello gives an image is removed
+        # only when the created card has one.
         querystring = {
             'idList': list_id,
             'name': card_name,
@@ -93,42 +294,100 @@ class Trello:
         if content_type == 'text':
             querystring['desc'] = content
         elif content_type == 'url':
-            soup = BeautifulSoup(requests.get(content).text, 'lxml')
-            title = soup.find_all('title')[0]
             querystring['desc'] = content
-            querystring['name'] = title
-            # querystring['urlSource'] = content
+            # Trello fetches a urlSource itself and fails the card when it is anything else than
+            # a link, so text around a link goes in as a plain card the link is attached to
+            if is_single_url(content):
+                querystring['urlSource'] = content.strip()
+                title = self.unfurler.get_title(content.strip())
+                if title:
+                    querystring['name'] = title
 
-        j = self._make_request(url, method='POST',
-                               querystring=querystring)
+        if content_type in ('image', 'document'):
+            j = self._create_card_with_file(querystring, content)
+        else:
+            j = self._make_request('/1/cards', method='POST', querystring=querystring)
         if j is None:
             return None
         card_id = j['id']
+        calls = 1
 
-        if content_type == 'text':
-            return card_id
-
-        if content_type == 'image':
-            url = '/1/cards/{}/attachments'.format(card_id)
-            files = {'file': requests.get(content).content}
-            _ = self._make_request(url, method='POST',
-                                   files=files)
+        # The card exists: a failure from here on costs it an attachment or its cover
+        # change, and must not lose its ID (the capture would be sent again as a new card)
+        try:
+            if content_type == 'album':
+                calls += len(content)
+                self.attach_files(card_id, content, set_cover=False)
 
-        if content_type == 'url':
-            url = '/1/cards/{}/attachments'.format(card_id)
-            querystring = {'url': content, 'idAttachmentCover': 'null'}
-            _ = self._make_request(url, method='POST',
-                                   querystring=querystring)
+            link = find_url(content) if content_type == 'url' and 'urlSource' not in querystring else None
+            if link is not None:
+                calls += 1
+                self.attach_url(card_id, link)
 
-        if (content_type == 'url') | (content_type == 'image'):
-            _ = self.remove_cover(card_id)
+            if j.get('idAttachmentCover'):
+                calls += 1
+                self.remove_cover(card_id)
+        except (TrelloRateLimited, TrelloUnavailable, TrelloUnauthorized, requests.RequestException) as e:
+            logger.info("Card {} saved, but not finished: {}".format(card_id, e))
 
+        TRELLO_CALLS_PER_CARD.labels(content_type).observe(calls)
         return card_id
 
-        # extension = content.split(".")[-1]
-        # filename = card_name
-        # querystring['fileSource'] = "data:image/{extension};" \
-        #                             "name={filename};base64,".format(extension=extension,
-        #                                                              filename=filename) + \
-        #                             base64.b64encode(requests.get(content).content).decode()[:1000]
 
+# One client per token, all sharing a single keep-alive session: captures
+# don't pay a new TCP+TLS handshake each time, and tokens never leak across users.
+# They share the circuit breaker too: when Trello stops answering, it does for everyone
+class TrelloPool:
+
+    def __init__(self, pool_size=TRELLO_POOL_SIZE,
+                 max_retries=TRELLO_MAX_RETRIES,
+                 backoff_factor=TRELLO_RETRY_BACKOFF,
+                 unfurler=None,
+                 spooler=None,
+                 rate_limiter=None,
+                 breaker=None):
+        if rate_limiter is None and TRELLO_RATE_LIMIT_ENABLED:
+            rate_limiter = TrelloRateLimiter()
+        if breaker is None and TRELLO_BREAKER_ENABLED:
+            breaker = CircuitBreaker(self.probe)
+        # Server errors only: throttled calls are replayed by Trello._make_request, which
+        # knows whether their body can be sent again (urllib3 would resend a drained upload)
+        retry = Retry(total=max_retries,
+                      backoff_factor=backoff_factor,
+                      status_forcelist=(500, 502, 503, 504),
+                      respect_retry_after_header=rate_limiter is None,
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=pool_size,
+                              pool_block=True,
+                              max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount(Trello._URL_PREFIX, adapter)
+        self.unfurler = unfurler
+        self.spooler = spooler
+        self.rate_limiter = rate_limiter
+        self.breaker = breaker
+        self.backoff_factor = backoff_factor
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def probe(self):
+        # Any answer but a server error means Trello is back, the 401 of this token-less call included
+        r = self.session.get(Trello._URL_PREFIX + '/1/members/me', params={'key': TRELLO_KEY},
+                             timeout=TRELLO_TIMEOUT)
+        return r.status_code < 500
+
+    def get(self, token):
+        with self._lock:
+            client = self._clients.get(token)
+            if client is None:
+                client = Trello(token, session=self.session, unfurler=self.unfurler,
+                                spooler=self.spooler, rate_limiter=self.rate_limiter,
+                                backoff_factor=self.backoff_factor, breaker=self.breaker)
+                self._clients[token] = client
+            return client
+
+    def close(self):
+        with self._lock:
+            self._clients.clear()
+        self.session.close()
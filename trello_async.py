@@ -0,0 +1,366 @@
+import asyncio
+import logging
+import shutil
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from config import (
+    TRELLO_KEY,
+    TRELLO_POOL_SIZE,
+    TRELLO_MAX_RETRIES,
+    TRELLO_RETRY_BACKOFF,
+    ATTACHMENT_SPOOL_THRESHOLD,
+    ATTACHMENT_MAX_CONCURRENT_UPLOADS,
+    ATTACHMENT_CONNECT_TIMEOUT,
+    ATTACHMENT_READ_TIMEOUT,
+    TRELLO_RATE_LIMIT_ENABLED,
+)
+from trello import (Trello, TrelloRateLimited, TrelloUnavailable, TrelloUnauthorized, TrelloNoAnswer,
+                    card_page_query, request_timeout, parse_starred_boards, parse_board_lists)
+from ratelimit import TrelloRateLimiter, parse_retry_after
+from metrics import REGISTRY, TRELLO_CALLS_PER_CARD, observe_trello_call
+from unfurl import default_unfurler, find_url, is_single_url
+from attachments import attachment_name, attachment_mime_type
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+_RETRY_STATUSES = (429, 500, 502, 503, 504)
+_IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+
+
+# Same surface as Trello, every method being a coroutine
+class AsyncTrello:
+    _URL_PREFIX = Trello._URL_PREFIX
+
+    def __init__(self, token, session, max_retries=TRELLO_MAX_RETRIES,
+                 backoff_factor=TRELLO_RETRY_BACKOFF, unfurler=None, upload_slots=None,
+                 rate_limiter=None, breaker=None):
+        self.auth_token = token
+        self.session = session
+        self.rate_limiter = rate_limiter
+        self.breaker = breaker
+        self._buckets = rate_limiter.buckets_for(token) if rate_limiter is not None else None
+        self.upload_slots = upload_slots if upload_slots is not None else \
+            asyncio.Semaphore(ATTACHMENT_MAX_CONCURRENT_UPLOADS)
+        self._unfurler = unfurler
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self._url_querystring = {'key': TRELLO_KEY, 'token': self.auth_token}
+
+    async def _acquire(self):
+        # The buckets are a SQLite file every process locks: waiting for it must not hold the loop
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.rate_limiter.max_wait
+        while True:
+            wait = await loop.run_in_executor(None, self.rate_limiter.try_acquire, self._buckets)
+            if wait <= 0:
+                return
+            if loop.time() + wait > deadline:
+                raise TrelloRateLimited("No Trello slot available")
+            await asyncio.sleep(wait)
+
+    async def _make_request(self, path, method='GET', querystring=None,
+                            payload=None, files=None):
+        url = self._URL_PREFIX + path
+        params = {**self._url_querystring}
+        if querystring is not None:
+            # aiohttp refuses None values
+            params.update((k, v) for k, v in querystring.items() if v is not None)
+        if self.breaker is not None and not self.breaker.allow():
+            raise TrelloUnavailable("Trello is not answering, {} {} not sent".format(method, path))
+        connect_timeout, read_timeout = request_timeout(method, path)
+        timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+
+        # A streamed upload is consumed by the first attempt
+        replayable = not isinstance(payload, aiohttp.FormData)
+        start = time.perf_counter()
+        for attempt in range(self.max_retries + 1):
+            data = payload
+            if files is not None:
+                data = aiohttp.FormData()
+                for name, value in files.items():
+                    data.add_field(name, value, filename=name)
+            if self._buckets is not None:
+                await self._acquire()
+            try:
+                async with self.session.request(method, url, params=params, data=data, timeout=timeout) as r:
+                    if r.status == 200:
+                        j = await r.json()
+                        self._observe(method, path, r.status, start, attempt, r.content_length)
+                        self._record(True)
+                        return j
+                    retry_after = r.headers.get('Retry-After')
+                    if (r.status == 429) & (self._buckets is not None):
+                        # The limiter queues the replay, for this and every other call on the bucket
+                        await asyncio.get_running_loop().run_in_executor(
+                            None, self.rate_limiter.penalize_for_response, self._buckets, await r.text(),
+                            parse_retry_after(retry_after))
+                        if replayable & (attempt < self.max_retries):
+                            continue
+                    # Same policy as the sync client: throttled calls are always replayed,
+                    # server errors only when the verb is idempotent, and neither with a drained body
+                    retryable = replayable & ((r.status == 429) |
+                                              ((r.status in _RETRY_STATUSES) & (method in _IDEMPOTENT_METHODS)))
+                    if (not retryable) | (attempt == self.max_retries):
+                        self._observe(method, path, r.status, start, attempt, r.content_length)
+                        self._record(r.status < 500)
+                        if r.status == 429:
+                            raise TrelloRateLimited("Trello throttled {} {}".format(method, path))
+                        if r.status == 401:
+                            raise TrelloUnauthorized("Trello refused the token for {} {}".format(method, path))
+                        logger.debug("Failed call ({}): {}".format(r.status, await r.text()))
+                        return None
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                self._record(False)
+                raise TrelloNoAnswer("No answer from Trello to {} {}: {!r}".format(method, path, e)) from e
+            delay = self.backoff_factor * (2 ** attempt)
+            if retry_after is not None and retry_after.isdigit():
+                delay = max(delay, int(retry_after))
+            await asyncio.sleep(delay)
+
+    def _record(self, ok):
+        if self.breaker is not None:
+            self.breaker.record(ok)
+
+    def _observe(self, method, path, status, start, replays, received=None):
+        if REGISTRY.enabled:
+            observe_trello_call(method, path, status, time.perf_counter() - start, replays,
+                                received=received or 0)
+
+    @property
+    def unfurler(self):
+        return self._unfurler if self._unfurler is not None else default_unfurler()
+
+    async def _spool(self, url, spool):
+        if urlsplit(url).scheme in ('', 'file'):
+            # A file already on disk, e.g. from a chat export, as AttachmentSpooler reads it
+            await asyncio.get_running_loop().run_in_executor(None, self._copy_file, urlsplit(url).path, spool)
+            return
+        # Same timeouts as the sync spooler
+        timeout = aiohttp.ClientTimeout(sock_connect=ATTACHMENT_CONNECT_TIMEOUT, sock_read=ATTACHMENT_READ_TIMEOUT)
+        async with self.session.get(url, timeout=timeout) as r:
+            r.raise_for_status()
+            async for chunk in r.content.iter_chunked(64 * 1024):
+                spool.write(chunk)
+        spool.seek(0)
+
+    @staticmethod
+    def _copy_file(path, spool):
+        with open(path, 'rb') as f:
+            shutil.copyfileobj(f, spool, 64 * 1024)
+        spool.seek(0)
+
+    async def attach_file(self, card_id, file_url, set_cover=True):
+        name = attachment_name(file_url)
+        async with self.upload_slots:
+            with tempfile.SpooledTemporaryFile(max_size=ATTACHMENT_SPOOL_THRESHOLD) as spool:
+                try:
+                    await self._spool(file_url, spool)
+                    data = aiohttp.FormData()
+                    data.add_field('file', spool, filename=name,
+                                   content_type=attachment_mime_type(name))
+                    return await self._make_request('/1/cards/{}/attachments'.format(card_id),
+                                                    method='POST', payload=data,
+                                                    querystring=None if set_cover else {'setCover': 'false'})
+                except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+                    logger.info("Could not attach {} to {}: {!r}".format(name, card_id, e))
+                    return None
+
+    async def attach_files(self, card_id, file_urls, set_cover=True):
+        return await asyncio.gather(*(self.attach_file(card_id, file_url, set_cover) for file_url in file_urls))
+
+    async def _create_card_with_file(self, querystring, file_url):
+        name = attachment_name(file_url)
+        async with self.upload_slots:
+            with tempfile.SpooledTemporaryFile(max_size=ATTACHMENT_SPOOL_THRESHOLD) as spool:
+                try:
+                    await self._spool(file_url, spool)
+                    data = aiohttp.FormData()
+                    data.add_field('fileSource', spool, filename=name,
+                                   content_type=attachment_mime_type(name))
+                    return await self._make_request('/1/cards', method='POST', querystring=querystring,
+                                                    payload=data)
+                except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+                    logger.info("Could not create a card with {}: {!r}".format(name, e))
+                    return None
+
+    async def get_starred_boards(self):
+        j = await self._make_request('/1/members/me/boards')
+        if j is None:
+            return None
+        return parse_starred_boards(j)
+
+    async def get_board_info(self, board_id):
+        return await self._make_request('/1/boards/{idBoard}'.format(idBoard=board_id))
+
+    async def get_board_lists(self, board_id):
+        j = await self._make_request('/1/boards/{idBoard}/lists'.format(idBoard=board_id))
+        if j is None:
+            return None
+        return parse_board_lists(j)
+
+    async def get_board_cards(self, board_id, limit=None, before=None, fields=None):
+        return await self._make_request('/1/boards/{idBoard}/cards'.format(idBoard=board_id),
+                                        querystring=card_page_query(limit, before, fields))
+
+    async def get_list_cards(self, list_id, limit=None, before=None, fields=None):
+        return await self._make_request('/1/lists/{idList}/cards'.format(idList=list_id),
+                                        querystring=card_page_query(limit, before, fields))
+
+    async def create_list_in_board(self, list_name, board_id):
+        j = await self._make_request('/1/lists', method='POST',
+                                     querystring={"name": list_name,
+                                                  "idBoard": board_id,
+                                                  "pos": "bottom"})
+        if j is None:
+            return None
+        return j['id']
+
+    async def remove_cover(self, card_id):
+        return await self._make_request('/1/cards/{}'.format(card_id), method='PUT',
+                                        querystring={'idAttachmentCover': 'null'})
+
+    async def attach_url(self, card_id, url):
+        return await self._make_request('/1/cards/{}/attachments'.format(card_id), method='POST',
+                                        querystring={'url': url, 'setCover': 'false'})
+
+    async def create_card_in_list(self, list_id, card_name, content, content_type='text'):
+        # Same calls as Trello.create_card_in_list
+        querystring = {
+            'idList': list_id,
+            'name': card_name,
+            'pos': 'top'
+        }
+
+        if content_type == 'text':
+            querystring['desc'] = content
+        elif content_type == 'url':
+            querystring['desc'] = content
+            if is_single_url(content):
+                querystring['urlSource'] = content.strip()
+                # The unfurler reads a bounded prefix of the page and is mostly served from its cache
+                title = await asyncio.get_running_loop().run_in_executor(None, self.unfurler.get_title,
+                                                                         content.strip())
+                if title:
+                    querystring['name'] = title
+
+        if content_type in ('image', 'document'):
+            j = await self._create_card_with_file(querystring, content)
+        else:
+            j = await self._make_request('/1/cards', method='POST', querystring=querystring)
+        if j is None:
+            return None
+        card_id = j['id']
+        calls = 1
+
+        # As in Trello.create_card_in_list, the card ID is kept whatever fails next
+        try:
+            if content_type == 'album':
+                calls += len(content)
+                await self.attach_files(card_id, content, set_cover=False)
+
+            link = find_url(content) if content_type == 'url' and 'urlSource' not in querystring else None
+            if link is not None:
+                calls += 1
+                await self.attach_url(card_id, link)
+
+            if j.get('idAttachmentCover'):
+                calls += 1
+                await self.remove_cover(card_id)
+        except (TrelloRateLimited, TrelloUnavailable, TrelloUnauthorized,
+                aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.info("Card {} saved, but not finished: {}".format(card_id, e))
+
+        TRELLO_CALLS_PER_CARD.labels(content_type).observe(calls)
+        return card_id
+
+
+# Async clients per token over one aiohttp session. The session is bound to the
+# loop it is created on, so it's opened lazily from within that loop.
+class AsyncTrelloPool:
+
+    def __init__(self, pool_size=TRELLO_POOL_SIZE, unfurler=None, rate_limiter=None, breaker=None):
+        if rate_limiter is None and TRELLO_RATE_LIMIT_ENABLED:
+            rate_limiter = TrelloRateLimiter()
+        self.pool_size = pool_size
+        self.unfurler = unfurler
+        self.rate_limiter = rate_limiter
+        # Shared with the sync pool when given: Trello is either answering or not
+        self.breaker = breaker
+        self.session = None
+        self.upload_slots = None
+        self._clients = {}
+
+    def get(self, token):
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit_per_host=self.pool_size))
+            self.upload_slots = asyncio.Semaphore(ATTACHMENT_MAX_CONCURRENT_UPLOADS)
+        client = self._clients.get(token)
+        if client is None:
+            client = AsyncTrello(token, self.session, unfurler=self.unfurler,
+                                 upload_slots=self.upload_slots, rate_limiter=self.rate_limiter,
+                                 breaker=self.breaker)
+            self._clients[token] = client
+        return client
+
+    async def close(self):
+        self._clients.clear()
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+# An event loop on its own thread: dispatcher threads hand coroutines to it
+# and return straight away, so captures stay in flight without holding a worker
+class EventLoopThread:
+
+    def __init__(self, trello_pool=None):
+        self.loop = asyncio.new_event_loop()
+        self.trello_pool = trello_pool if trello_pool is not None else AsyncTrelloPool()
+        self._turns = {}
+        self._thread = threading.Thread(target=self.loop.run_forever, name='trello-async', daemon=True)
+        self._thread.start()
+
+    async def _in_turn(self, key, coro):
+        # Coroutines sharing a key run one after the other, in the order they were submitted
+        # (asyncio.Lock wakes its waiters first in, first out). Only touched from the loop.
+        turn = self._turns.get(key)
+        if turn is None:
+            turn = self._turns[key] = [asyncio.Lock(), 0]
+        turn[1] += 1
+        try:
+            async with turn[0]:
+                return await coro
+        finally:
+            turn[1] -= 1
+            if not turn[1]:
+                del self._turns[key]
+
+    def submit(self, coro, key=None):
+        if key is not None:
+            coro = self._in_turn(key, coro)
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        future.add_done_callback(self._log_failure)
+        return future
+
+    def run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def run_blocking(self, fn, *args, **kwargs):
+        return self.loop.run_in_executor(None, lambda: fn(*args, **kwargs))
+
+    @staticmethod
+    def _log_failure(future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.error("Async capture failed", exc_info=future.exception())
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.trello_pool.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
@@ -0,0 +1,189 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+import requests
+
+from cpu import default_cpu_pool
+from config import (
+    UNFURL_MAX_BYTES,
+    UNFURL_CONNECT_TIMEOUT,
+    UNFURL_READ_TIMEOUT,
+    UNFURL_CACHE_PATH,
+    UNFURL_CACHE_TTL,
+)
+
+logger = logging.getLogger(__name__)
+
+_CHUNK_SIZE = 8192
+_DEFAULT_PORTS = {'http': ':80', 'https': ':443'}
+
+
+# The first http(s) link among the words of a text, or None
+def find_url(text):
+    for word in text.split():
+        try:
+            parts = urlsplit(word)
+        except ValueError:
+            continue
+        if parts.scheme in ('http', 'https') and parts.netloc:
+            return word
+    return None
+
+
+# A message that is one http(s) link and nothing else: Trello can take it as urlSource
+def is_single_url(text):
+    words = text.split()
+    return len(words) == 1 and find_url(words[0]) is not None
+
+
+def normalize_url(url):
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc.lower()
+    default_port = _DEFAULT_PORTS.get(scheme)
+    if default_port is not None and netloc.endswith(default_port):
+        netloc = netloc[:-len(default_port)]
+    query = sorted((k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+                   if not k.startswith('utm_'))
+    return urlunsplit((scheme, netloc, parts.path or '/', urlencode(query), ''))
+
+
+def parse_page_meta(html):
+    # <title> first, OpenGraph as fallback and for the description.
+    # bs4 is imported on the first link only: it's most of the bots' import time
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(html, 'lxml')
+    meta = {}
+    for tag in soup.find_all('meta'):
+        prop = tag.get('property') or tag.get('name')
+        if prop in ('og:title', 'og:description') and tag.get('content'):
+            meta.setdefault(prop[3:], tag['content'].strip())
+    title = soup.find('title')
+    if title is not None and title.text.strip():
+        meta['title'] = title.text.strip()
+    return meta
+
+
+def _head_is_complete(head):
+    lowered = head.lower()
+    return (b'</head' in lowered) | ((b'</title' in lowered) & (b'og:title' in lowered))
+
+
+# Titles of shared links. Only the first `max_bytes` of a page are read, and
+# less when its <head> ends earlier; results are cached on disk by normalized
+# URL and revalidated with ETag/Last-Modified once older than `ttl`.
+class Unfurler:
+
+    def __init__(self, cache_path=UNFURL_CACHE_PATH, max_bytes=UNFURL_MAX_BYTES,
+                 connect_timeout=UNFURL_CONNECT_TIMEOUT, read_timeout=UNFURL_READ_TIMEOUT,
+                 ttl=UNFURL_CACHE_TTL, session=None, cpu_pool=None):
+        if os.path.dirname(cache_path):
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        self.max_bytes = max_bytes
+        self.timeout = (connect_timeout, read_timeout)
+        self.ttl = ttl
+        self.session = session if session is not None else requests.Session()
+        self._cpu_pool = cpu_pool
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(cache_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS unfurls ("
+            " url TEXT PRIMARY KEY,"
+            " title TEXT,"
+            " description TEXT,"
+            " etag TEXT,"
+            " last_modified TEXT,"
+            " fetched_at REAL NOT NULL)"
+        )
+
+    def _cached(self, key):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT title, description, etag, last_modified, fetched_at FROM unfurls WHERE url = ?",
+                (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {'title': row[0], 'description': row[1], 'etag': row[2],
+                'last_modified': row[3], 'fetched_at': row[4]}
+
+    def _remember(self, key, meta, etag, last_modified):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO unfurls (url, title, description, etag, last_modified, fetched_at)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (key, meta.get('title'), meta.get('description'), etag, last_modified, time.time())
+            )
+
+    def _read_head(self, response):
+        head = b''
+        for chunk in response.iter_content(chunk_size=_CHUNK_SIZE):
+            head += chunk
+            if (len(head) >= self.max_bytes) | _head_is_complete(head):
+                break
+        return head[:self.max_bytes]
+
+    @property
+    def cpu_pool(self):
+        return self._cpu_pool if self._cpu_pool is not None else default_cpu_pool()
+
+    def unfurl(self, url):
+        key = normalize_url(url)
+        cached = self._cached(key)
+        if cached is not None and cached['fetched_at'] + self.ttl > time.time():
+            return cached
+
+        headers = {}
+        if cached is not None:
+            if cached['etag']:
+                headers['If-None-Match'] = cached['etag']
+            if cached['last_modified']:
+                headers['If-Modified-Since'] = cached['last_modified']
+
+        try:
+            with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as r:
+                if r.status_code == 304 and cached is not None:
+                    self._remember(key, cached, cached['etag'], cached['last_modified'])
+                    return cached
+                if r.status_code != 200:
+                    logger.info("Could not unfurl {} ({})".format(url, r.status_code))
+                    return cached
+                head = self._read_head(r)
+                etag, last_modified = r.headers.get('ETag'), r.headers.get('Last-Modified')
+        except requests.RequestException as e:
+            logger.info("Could not unfurl {}: {}".format(url, e))
+            return cached
+
+        # Parsed in another process: the GIL stays with the threads waiting on I/O
+        meta = self.cpu_pool.run('parse_page_meta', parse_page_meta, head)
+        if meta is None:
+            return cached
+        self._remember(key, meta, etag, last_modified)
+        return meta
+
+    def get_title(self, url):
+        meta = self.unfurl(url)
+        return None if meta is None else meta.get('title')
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+        self.session.close()
+
+
+_default_unfurler = None
+_default_unfurler_lock = threading.Lock()
+
+
+def default_unfurler():
+    global _default_unfurler
+    with _default_unfurler_lock:
+        if _default_unfurler is None:
+            _default_unfurler = Unfurler()
+        return _default_unfurler
@@ -0,0 +1,156 @@
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+from collections import OrderedDict
+
+from config import USER_STORE_BACKEND, USER_STORE_PATH, USER_STORE_CACHE_SIZE
+
+logger = logging.getLogger(__name__)
+
+_USER_FIELDS = ('telegram_id', 'trello_token', 'board_id', 'board_name', 'inbox_list_id')
+_MISSING = object()
+
+
+def legacy_pickle_path(project_name):
+    return "./data/{}_user_setup.p".format(project_name)
+
+
+# User setups in a SQLite table keyed by (project, telegram_id): a /setup is a
+# single-row upsert and records are loaded on first lookup, then kept in a
+# small LRU cache (unknown users included, so strangers don't hit the disk).
+class SqliteUserStore:
+
+    def __init__(self, path=USER_STORE_PATH, cache_size=USER_STORE_CACHE_SIZE):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS user_setups ("
+            " project TEXT NOT NULL,"
+            " telegram_id INTEGER NOT NULL,"
+            " trello_token TEXT NOT NULL,"
+            " board_id TEXT,"
+            " board_name TEXT,"
+            " inbox_list_id TEXT,"
+            " PRIMARY KEY (project, telegram_id))"
+        )
+
+    def _remember(self, key, record):
+        self._cache[key] = record
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def get(self, project, tg_id):
+        key = (project, tg_id)
+        with self._lock:
+            record = self._cache.get(key, _MISSING)
+            if record is not _MISSING:
+                self._cache.move_to_end(key)
+                return record
+            row = self._conn.execute(
+                "SELECT {} FROM user_setups WHERE project = ? AND telegram_id = ?".format(', '.join(_USER_FIELDS)),
+                (project, tg_id)
+            ).fetchone()
+            record = dict(zip(_USER_FIELDS, row)) if row is not None else None
+            self._remember(key, record)
+            return record
+
+    def put(self, project, record):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO user_setups (project, {}) VALUES (?, ?, ?, ?, ?, ?)".format(
+                    ', '.join(_USER_FIELDS)),
+                (project,) + tuple(record[f] for f in _USER_FIELDS)
+            )
+            self._remember((project, record['telegram_id']), dict(record))
+
+    def count(self, project):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM user_setups WHERE project = ?",
+                                      (project,)).fetchone()[0]
+
+    def migrate_from_pickle(self, project, path):
+        # One-shot: the pickle is renamed once imported, so it's never read again
+        try:
+            with open(path, "rb") as f:
+                user_setups = pickle.load(f)
+        except FileNotFoundError:
+            return 0
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO user_setups (project, {}) VALUES (?, ?, ?, ?, ?, ?)".format(
+                        ', '.join(_USER_FIELDS)),
+                    [(project,) + tuple(r.get(f) for f in _USER_FIELDS) for r in user_setups.values()]
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._cache.clear()
+        os.replace(path, path + ".migrated")
+        logger.info("Migrated {} users of {} from {}".format(len(user_setups), project, path))
+        return len(user_setups)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+# The historical backend: the whole dict in one pickle per project. Kept for
+# small deployments; writes go through a temp file so a crash can't corrupt it.
+class PickleUserStore:
+
+    def __init__(self):
+        self._user_setups = {}
+        self._lock = threading.Lock()
+
+    def _load(self, project):
+        if project not in self._user_setups:
+            try:
+                with open(legacy_pickle_path(project), "rb") as f:
+                    self._user_setups[project] = pickle.load(f)
+            except FileNotFoundError:
+                self._user_setups[project] = {}
+        return self._user_setups[project]
+
+    def get(self, project, tg_id):
+        with self._lock:
+            return self._load(project).get(tg_id)
+
+    def put(self, project, record):
+        with self._lock:
+            user_setups = self._load(project)
+            user_setups[record['telegram_id']] = dict(record)
+            path = legacy_pickle_path(project)
+            with open(path + ".tmp", "wb") as f:
+                pickle.dump(user_setups, f)
+            os.replace(path + ".tmp", path)
+
+    def count(self, project):
+        with self._lock:
+            return len(self._load(project))
+
+    def migrate_from_pickle(self, project, path):
+        return 0
+
+    def close(self):
+        pass
+
+
+def open_user_store(backend=USER_STORE_BACKEND):
+    if backend == 'sqlite':
+        return SqliteUserStore()
+    elif backend == 'pickle':
+        return PickleUserStore()
+    raise ValueError("Unknown user store backend: {}".format(backend))
@@ -0,0 +1,126 @@
+import argparse
+import hmac
+import json
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telegram import Update
+
+from config import (
+    WEBHOOK_LISTEN,
+    WEBHOOK_PORT,
+    WEBHOOK_SECRET_TOKEN,
+    WEBHOOK_MAX_BODY,
+)
+
+logger = logging.getLogger(__name__)
+
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class _WebhookHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        route = self.server.routes.get(self.path.rstrip('/'))
+        if route is None:
+            return self._answer(404)
+
+        secret_token = self.headers.get(SECRET_TOKEN_HEADER, '')
+        if not hmac.compare_digest(secret_token.encode(), self.server.secret_token.encode()):
+            logger.warning("Webhook call to {} without a valid secret token".format(self.path))
+            return self._answer(403)
+
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > self.server.max_body:
+            return self._answer(413)
+        try:
+            data = json.loads(self.rfile.read(length).decode('utf-8'))
+        except ValueError:
+            return self._answer(400)
+
+        # The dispatcher does the work: Telegram only waits for the update to be queued
+        bot, update_queue = route
+        update_queue.put(Update.de_json(data, bot))
+        self._answer(200)
+
+    def _answer(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logger.debug("Webhook: " + format % args)
+
+
+# Receives the updates of every bot on one port, each at its own path, and
+# hands them to that bot's dispatcher. Meant to listen locally behind the
+# proxy terminating TLS for Telegram.
+class WebhookServer:
+
+    def __init__(self, listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT,
+                 secret_token=WEBHOOK_SECRET_TOKEN, max_body=WEBHOOK_MAX_BODY):
+        self.listen = listen
+        self.port = port
+        self.secret_token = secret_token
+        self.max_body = max_body
+        self.routes = {}
+        self._httpd = None
+        self._thread = None
+
+    def add_bot(self, path, bot, update_queue):
+        self.routes['/' + path.strip('/')] = (bot, update_queue)
+
+    def start(self):
+        self._httpd = ThreadingHTTPServer((self.listen, self.port), _WebhookHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.routes = self.routes
+        self._httpd.secret_token = self.secret_token
+        self._httpd.max_body = self.max_body
+        self.port = self._httpd.server_address[1]
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name='webhook', daemon=True)
+        self._thread.start()
+        logger.info("Webhook listening on {}:{}".format(self.listen, self.port))
+
+    def stop(self):
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._thread.join()
+            self._httpd = None
+
+
+def read_updates(path):
+    # A recorded update, a list of them, or one per line
+    with open(path) as f:
+        text = f.read()
+    try:
+        data = json.loads(text)
+    except ValueError:
+        return [json.loads(line) for line in text.splitlines() if line.strip()]
+    return data if isinstance(data, list) else [data]
+
+
+def replay(url, updates, secret_token=WEBHOOK_SECRET_TOKEN):
+    import requests
+
+    with requests.Session() as session:
+        for update in updates:
+            r = session.post(url, json=update, headers={SECRET_TOKEN_HEADER: secret_token})
+            print("update {}: {}".format(update.get('update_id'), r.status_code))
+
+
+def main():
+    # Local testing: post recorded updates to a running host, as Telegram would
+    parser = argparse.ArgumentParser(description="Post recorded Telegram updates to the webhook")
+    parser.add_argument('updates', help="JSON file with an update, a list of them, or one per line")
+    parser.add_argument('--project', required=True, help="project name of the bot receiving them")
+    parser.add_argument('--url', default='http://{}:{}'.format(WEBHOOK_LISTEN, WEBHOOK_PORT))
+    parser.add_argument('--secret-token', default=WEBHOOK_SECRET_TOKEN)
+    args = parser.parse_args()
+
+    replay('{}/{}'.format(args.url.rstrip('/'), args.project), read_updates(args.updates), args.secret_token)
+
+
+if __name__ == '__main__':
+    main()